@@ -6,6 +6,9 @@ import os
 import socketserver
 import sys
 
+import profiling
+import tracing
+import wire
 from registry import Registry
 
 # LOGGING
@@ -22,11 +25,12 @@ file_handler = logging.FileHandler(filePath)
 stdout_handler = logging.StreamHandler(sys.stdout)
 handlers = [file_handler, stdout_handler]
 
-logging.basicConfig(format='%(asctime)s:%(process)d:%(name)s:%(levelname)s:%(message)s',
+logging.basicConfig(format=tracing.LOG_FORMAT,
                     datefmt='%Y-%m-%dT%H:%M:%S%z',
                     level=logging.DEBUG,
                     handlers=handlers)
 logger = logging.getLogger('Broker')
+tracing.setup(logger)
 
 # INPUT PARAMETERS
 
@@ -42,6 +46,18 @@ except ValueError:
     logger.log(level=logging.ERROR, msg='Invalid port argument')
     exit(-1)
 
+# OPTIONAL FEATURES
+
+# Profiler started and stopped by SIGUSR1, see profiling: 'sample' samples the stacks of all the threads,
+#   'cprofile' profiles the threads answering the requests. SIGUSR2 dumps the stacks of the threads and
+#   takes a memory snapshot
+profiler = os.environ.get('PROFILER', 'sample')
+if profiler not in profiling.PROFILERS:
+    logger.log(level=logging.ERROR, msg='Invalid PROFILER value')
+    exit(-1)
+
+profiling.setup(logger, profiler)
+
 # INITIALIZING REGISTRY
 
 registry = Registry(logger)
@@ -50,24 +66,48 @@ registry = Registry(logger)
 class BrokerRequestHandler(socketserver.DatagramRequestHandler):
     """
     Class that extends a DatagramRequestHandler. It contains one method responsible for
-        answering single requests.
+        answering single requests, in the text protocol or in the binary protocol of wire.
     """
 
     def handle(self):
         """
         method that handles a single request. Uses the attributes self.request and self.client_address.
         """
+        profiling.checkpoint()
+
+        # the messages of the binary protocol start with a byte that cannot start a text message
+        if wire.is_binary(self.request[0]):
+            self.wfile.write(self.handle_binary())
+            return
+
         # Read the request content and the address it came from
-        msg = str(self.request[0].strip(), "utf-8")
+        try:
+            msg = str(self.request[0].strip(), "utf-8")
+        except UnicodeDecodeError:
+            msg = ''
+
+        # the clients and the servers can append the context of their trace to any message
+        msg, context = tracing.split_context(msg)
 
         # if it is a query it can be answered directly
         if msg == "query":
-            result = registry.get_string()  # address and port
+            result = registry.get_string(self.client_address[0])  # address and port, nearest first
             logger.log(level=logging.INFO, msg="Answered to query")
-        # otherwise the msg content and the address are passed to the registry
+            tracing.event('query', context, servers=result.count('$') + 1 if result else 0)
+        # the stats of the servers are only requested by monitoring tools
+        elif msg == "status":
+            result = registry.get_status_string()
+            logger.log(level=logging.INFO, msg="Answered to status query")
+        # otherwise the msg content and the address are passed to the registry, the stats are optional
         else:
-            name, addr_string = msg.split('|', maxsplit=1)
-            result = registry.add_server(name, addr_string)
+            try:
+                name, address, port, *stats = msg.split('|', maxsplit=3)
+                result = registry.add_server(name, f'{address}|{port}', stats[0] if stats else '')
+                tracing.event('register', context, server=name, result=result)
+            except ValueError as e:
+                # malformed registration, or a field the binary protocol could not represent
+                logger.log(level=logging.WARN, msg=f'Invalid message from {self.client_address[0]}: {e}')
+                result = "invalid"
 
         if result == "":
             result = "empty"
@@ -75,6 +115,44 @@ class BrokerRequestHandler(socketserver.DatagramRequestHandler):
         # the result (list of servers, or state of registration) is returned to the client
         self.wfile.write(bytes(result, "utf-8"))
 
+    def handle_binary(self):
+        """
+        method that handles a single request of the binary protocol
+        :return: the bytes of the answer, an ERROR message if the request is not valid
+        """
+        try:
+            opcode, fields = wire.decode(self.request[0])
+        except wire.ProtocolError as e:
+            logger.log(level=logging.WARN, msg=f'Invalid binary message from {self.client_address[0]}: {e}')
+            return wire.encode_error(str(e))
+
+        if opcode == wire.QUERY:
+            context, = fields
+            logger.log(level=logging.INFO, msg="Answered to binary query")
+            tracing.event('query', context, protocol='binary')
+            return registry.get_binary(self.client_address[0])
+
+        if opcode == wire.STATUS:
+            logger.log(level=logging.INFO, msg="Answered to binary status query")
+            return wire.encode_servers_status(registry.get_status())
+
+        if opcode == wire.REGISTER:
+            name, address, port, stats, context = fields
+            # the address is joined with the port by the registry, and sent to the text clients
+            if name == '' or any(c in address for c in '|$'):
+                logger.log(level=logging.WARN, msg=f'Invalid binary registration from {self.client_address[0]}')
+                return wire.encode_error('Invalid name or address')
+
+            try:
+                result = registry.add_server(name, f'{address}|{port}', stats)
+            except ValueError as e:
+                logger.log(level=logging.WARN, msg=f'Invalid binary registration from {self.client_address[0]}: {e}')
+                return wire.encode_error(str(e))
+            tracing.event('register', context, server=name, result=result, protocol='binary')
+            return wire.encode_result(result)
+
+        return wire.encode_error(f'Unexpected opcode {opcode}')
+
 
 # Creates and UDPServer bound to (localAddress, localPort) that answers using the class defined above
 try:
@@ -0,0 +1,377 @@
+"""
+This module contains the profiling hooks of the long running processes, used to look at a process that
+    misbehaves without restarting it: a statistical profiler sampling the stacks of all the threads, a
+    cProfile session, a dump of the stacks of all the threads, and tracemalloc snapshots with their
+    difference from the previous one
+Nothing runs while profiling is off. The hooks are triggered by signals: SIGUSR1 starts and stops the
+    profiler chosen with the PROFILER environment variable ('sample', the default, or 'cprofile'), and
+    SIGUSR2 dumps the stacks and takes a memory snapshot, tracemalloc being started by the first one.
+    The game servers also accept the commands in COMMANDS on their stats port.
+Each result is written to a file in the profiles folder, next to the logs folder, named after the
+    process and the time
+"""
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+# Folder of the output files
+PROFILES_PATH = './profiles'
+
+# Profilers that SIGUSR1 can start
+PROFILERS = ['sample', 'cprofile']
+
+# Seconds between two samples of the statistical profiler
+SAMPLE_INTERVAL = 0.005
+
+# Frames kept by tracemalloc for each allocation, and lines of the memory and cProfile reports
+MEMORY_FRAMES = 10
+REPORT_LINES = 30
+
+_logger = None
+_lock = threading.Lock()
+
+_sampler = None  # the running Sampler, or None
+_session = None  # the running CProfileSession, or None
+_snapshot = None  # the last memory snapshot, or None
+
+# The _Binding of the current thread to the cProfile lent to it
+_local = threading.local()
+
+
+def _output_path(kind, extension):
+    """
+    :return: The path of a new output file
+    """
+    os.makedirs(PROFILES_PATH, exist_ok=True)
+    return os.path.join(PROFILES_PATH, f'{os.getpid()}-{time.strftime("%Y%m%dT%H%M%S")}-{kind}.{extension}')
+
+
+def _thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+class Sampler(threading.Thread):
+    """
+    This class samples the stacks of all the threads every SAMPLE_INTERVAL seconds, and counts the samples
+        of each stack. The stacks are written in the folded format of flame graphs: the frames from the
+        root separated by ';', then the number of samples
+    """
+
+    def __init__(self):
+        super().__init__(name='Sampler', daemon=True)
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = time.monotonic()
+        self._stopped = threading.Event()
+
+    def run(self):
+        names = _thread_names()
+
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            if len(frames) != len(names):
+                names = _thread_names()
+
+            for ident, frame in frames.items():
+                if ident == self.ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+
+                stack.append(names.get(ident, str(ident)).replace(';', ','))
+                self.counts[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        """
+        Stops sampling and writes the stacks
+        :return: The path of the file written
+        """
+        self._stopped.set()
+        self.join()
+
+        path = _output_path('cpu', 'folded')
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+        # the functions on top of the stacks in most samples, the threads that were waiting included
+        leaves = collections.Counter()
+        for stack, count in self.counts.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        top = ', '.join(f'{function} {count}' for function, count in leaves.most_common(5))
+        _log(logging.INFO, f'Sampled {self.samples} times in {time.monotonic() - self.started:.1f} s, '
+                           f'written to {path}. Most sampled: {top}')
+        return path
+
+
+class CProfileSession:
+    """
+    This class holds the cProfile profilers of a session, one for each running thread, since a profiler
+        only sees the thread that enabled it. The threads that call checkpoint regularly borrow a profiler
+        and enable it while the session runs, and disable it at the first checkpoint after it has stopped.
+    The profiler of a thread that ends is given back and lent to the next thread, so the threads created
+        for each request or each game share as many profilers as there are threads at once
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self.started = time.monotonic()
+        self._idle = []
+
+    def acquire(self):
+        """
+        :return: An idle profiler of the session, a new one if none is idle
+        """
+        with _lock:
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            profile = cProfile.Profile()
+            self.profiles.append(profile)
+            return profile
+
+    def release(self, profile):
+        """
+        Gives back a profiler, disabled or enabled by a thread that has ended
+        """
+        with _lock:
+            self._idle.append(profile)
+
+    def stop(self):
+        """
+        Stops the session and writes the statistics of all its threads
+        :return: The path of the binary statistics, readable with pstats
+        """
+        with _lock:
+            profiles = list(self.profiles)
+
+        stats = None
+        for profile in profiles:
+            snapshot = _ProfileSnapshot(profile)
+            if stats is None:
+                stats = pstats.Stats(snapshot)
+            else:
+                stats.add(snapshot)
+
+        if stats is None:
+            _log(logging.WARN, 'No thread was profiled by cProfile')
+            return None
+
+        path = _output_path('cprofile', 'pstats')
+        stats.dump_stats(path)
+        with open(f'{path[:-len(".pstats")]}.txt', 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+
+        _log(logging.INFO, f'Profiled {len(profiles)} threads with cProfile for '
+                           f'{time.monotonic() - self.started:.1f} s, written to {path}')
+        return path
+
+
+class _Binding:
+    """
+    The profiler lent to a thread. It is kept in the thread local storage, so it is deleted when the
+        thread ends, and the profiler is given back to its session
+    """
+    __slots__ = ['profile', 'session']
+
+    def __init__(self, profile, session):
+        self.profile = profile
+        self.session = session
+
+    def __del__(self):
+        self.session.release(self.profile)
+
+
+class _ProfileSnapshot:
+    """
+    The statistics collected by a profiler so far. pstats reads a profiler with create_stats, that also
+        disables it, which may only be done by the thread of the profiler
+    """
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+def _log(level, msg):
+    if _logger is not None:
+        _logger.log(level=level, msg=msg)
+
+
+def checkpoint():
+    """
+    Called regularly by the threads that can be profiled with cProfile, for example at every round of a
+        game: the profiler of the thread is enabled while a session runs, and disabled afterwards
+    """
+    session = _session
+    binding = getattr(_local, 'binding', None)
+
+    if binding is not None and binding.session is not session:
+        binding.profile.disable()
+        _local.binding = None
+        binding = None
+
+    if binding is None and session is not None:
+        binding = _Binding(session.acquire(), session)
+        _local.binding = binding
+        binding.profile.enable()
+
+
+def toggle_sampler():
+    """
+    Starts the statistical profiler, or stops it and writes its results
+    :return: A message for the user
+    """
+    global _sampler
+
+    with _lock:
+        sampler, _sampler = _sampler, (Sampler() if _sampler is None else None)
+
+    if sampler is None:
+        _sampler.start()
+        _log(logging.INFO, 'Statistical profiler started')
+        return 'Statistical profiler started\n'
+    return f'Statistical profiler stopped, written to {sampler.stop()}\n'
+
+
+def toggle_cprofile():
+    """
+    Starts a cProfile session, or stops it and writes its results
+    :return: A message for the user
+    """
+    global _session
+
+    with _lock:
+        session, _session = _session, (CProfileSession() if _session is None else None)
+
+    if session is None:
+        _log(logging.INFO, 'cProfile session started')
+        return 'cProfile session started, the threads are profiled from their next checkpoint\n'
+    return f'cProfile session stopped, written to {session.stop()}\n'
+
+
+def dump_stacks():
+    """
+    Writes the current stack of every thread
+    :return: A message for the user
+    """
+    names = _thread_names()
+    path = _output_path('stacks', 'txt')
+
+    with open(path, 'w') as f:
+        for ident, frame in sys._current_frames().items():
+            f.write(f'Thread {names.get(ident, "?")} ({ident}):\n')
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'  File "{code.co_filename}", line {frame.f_lineno}, in {code.co_name}\n')
+                frame = frame.f_back
+            f.writelines(reversed(stack))
+            f.write('\n')
+
+    _log(logging.INFO, f'Stacks of {len(names)} threads written to {path}')
+    return f'Stacks written to {path}\n'
+
+
+def memory_snapshot():
+    """
+    Starts tracing the allocations, or takes a snapshot and writes the biggest allocations, and how they
+        changed since the previous snapshot
+    :return: A message for the user
+    """
+    global _snapshot
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_FRAMES)
+        _log(logging.INFO, 'Memory tracing started')
+        return 'Memory tracing started, the next snapshot will report the allocations\n'
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    path = _output_path('memory', 'txt')
+
+    with open(path, 'w') as f:
+        f.write(f'Traced memory: {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n\nBiggest allocations:\n')
+        f.writelines(f'{stat}\n' for stat in snapshot.statistics('lineno')[:REPORT_LINES])
+
+        if _snapshot is not None:
+            f.write('\nDifference from the previous snapshot:\n')
+            f.writelines(f'{stat}\n' for stat in snapshot.compare_to(_snapshot, 'lineno')[:REPORT_LINES])
+
+    _snapshot = snapshot
+    _log(logging.INFO, f'Memory snapshot written to {path}, {current / 1024:.1f} KiB traced')
+    return f'Memory snapshot written to {path}\n'
+
+
+def stop_memory():
+    """
+    Stops tracing the allocations
+    :return: A message for the user
+    """
+    global _snapshot
+
+    tracemalloc.stop()
+    _snapshot = None
+    _log(logging.INFO, 'Memory tracing stopped')
+    return 'Memory tracing stopped\n'
+
+
+# The commands of the stats port of the game servers
+COMMANDS = {
+    'profile': toggle_sampler,
+    'cprofile': toggle_cprofile,
+    'stacks': dump_stacks,
+    'memory': memory_snapshot,
+    'memory-stop': stop_memory,
+}
+
+
+def _on_signal(action):
+    """
+    :return: A signal handler running action in a new thread, since a handler interrupts the main thread
+        at any point, possibly while it holds the lock of this module
+    """
+    def handler(signum, frame):
+        threading.Thread(target=action, daemon=True).start()
+    return handler
+
+
+def _dump_all():
+    dump_stacks()
+    memory_snapshot()
+
+
+def setup(logger, profiler):
+    """
+    Installs the signal handlers, on the systems that have SIGUSR1 and SIGUSR2. Must be called by the main
+        thread
+    :param logger: the logger the actions are reported to
+    :param profiler: The profiler started by SIGUSR1, one of PROFILERS
+    """
+    global _logger
+    _logger = logger
+
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    toggle = toggle_cprofile if profiler == 'cprofile' else toggle_sampler
+    signal.signal(signal.SIGUSR1, _on_signal(toggle))
+    signal.signal(signal.SIGUSR2, _on_signal(_dump_all))
@@ -0,0 +1,215 @@
+"""
+Module containing the ProximityIndex class, used by the registry to order the servers by their network
+    proximity to the client querying it
+"""
+import ipaddress
+import socket
+
+
+class _Node:
+    """
+    A node of the binary trie, the servers are stored in the leaves, at the depth of the number of bits of
+        their address
+    """
+    __slots__ = ['children', 'servers']
+
+    def __init__(self):
+        self.children = [None, None]
+        self.servers = None  # the names of the servers with this address, only set in the leaves
+
+
+class ProximityIndex:
+    """
+    This class indexes the addresses of the servers in a binary trie, one for IPv4 and one for IPv6, where
+        each level is one bit of the address.
+    The servers sharing the longest prefix with the address of a client are the ones found by following
+        the bits of the client's address as deep as possible: the servers below the deepest node reached
+        come first, then the ones below the sibling of each node on the way back to the root, so the
+        servers are ordered by decreasing length of the common prefix. The servers in the same region as
+        the nearest one are then moved before the others, keeping their order.
+    The order only depends on the deepest node reached, so the answer is cached for each of them, and for
+        each function rendering it, and a query costs one walk down the trie. The cache is cleared when a
+        server is added or removed.
+    Servers whose address cannot be resolved to an IP address come last, in the order they were added.
+    The registry calls add and remove while holding its write lock, and nearest while holding its read
+        lock: concurrent queries may only store the same answer in the cache at once, which is safe.
+    """
+
+    def __init__(self):
+        self._roots = {4: _Node(), 6: _Node()}
+        self._addresses = {}  # Map<String, IPv4Address or IPv6Address>
+        self._entries = {}  # Map<String, Object>, the representation of each server in the answers
+        self._regions = {}  # Map<String, String>
+        self._unplaced = []  # the servers whose address could not be resolved, in the order they were added
+        self._cache = {}  # Map<(_Node, Function), Object>
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def address(self, name):
+        """
+        :param name: The name of an indexed server
+        :return: The IP address it was indexed with, or None if it could not be resolved
+        """
+        return self._addresses.get(name)
+
+    def add(self, name, ip, entry, region=None):
+        """
+        Indexes a server, replacing its previous address and region
+        :param name: The name of the server
+        :param ip: The IP address of the server returned by resolve, or None if it could not be resolved
+        :param entry: The representation of the server in the answers, passed to the render functions
+        :param region: An optional region tag given by the server
+        """
+        self.remove(name)
+        self._cache.clear()
+        self._entries[name] = entry
+        self._regions[name] = region
+
+        if ip is None:
+            self._unplaced.append(name)
+            return
+
+        self._addresses[name] = ip
+        node = self._roots[ip.version]
+        for bit in _bits(ip):
+            if node.children[bit] is None:
+                node.children[bit] = _Node()
+            node = node.children[bit]
+
+        if node.servers is None:
+            node.servers = []
+        node.servers.append(name)
+
+    def remove(self, name):
+        """
+        Removes a server from the index, and the nodes left without servers below them
+        :param name: The name of the server, nothing is done if it is not indexed
+        """
+        if name not in self._entries:
+            return
+
+        self._cache.clear()
+        self._entries.pop(name)
+        self._regions.pop(name)
+        if name in self._unplaced:
+            self._unplaced.remove(name)
+            return
+
+        ip = self._addresses.pop(name)
+        path = [self._roots[ip.version]]
+        for bit in _bits(ip):
+            path.append(path[-1].children[bit])
+
+        leaf = path[-1]
+        leaf.servers.remove(name)
+        if len(leaf.servers) > 0:
+            return
+
+        leaf.servers = None
+        for bit, (parent, child) in reversed(list(zip(_bits(ip), zip(path, path[1:])))):
+            if child.servers is not None or child.children != [None, None]:
+                break
+            parent.children[bit] = None
+
+    def nearest(self, address, render):
+        """
+        :param address: The IP address of a client, as a string
+        :param render: A function taking the list of the entries of all the servers, the nearest to the
+            address first, and returning the answer
+        :return: The answer returned by render
+        """
+        ip = _parse(address)
+        if ip is None:
+            return render([self._entries[name] for name in self._all()])
+
+        # the deepest node sharing a prefix with the address, and the siblings left on the way
+        node = self._roots[ip.version]
+        siblings = []
+        for bit in _bits(ip):
+            child = node.children[bit]
+            if child is None:
+                break
+            siblings.append(node.children[1 - bit])
+            node = child
+
+        cached = self._cache.get((node, render))
+        if cached is not None:
+            return cached
+
+        names = _collect(node, [])
+        for sibling in reversed(siblings):
+            _collect(sibling, names)
+
+        # the servers of the other IP version, and the ones not resolved, come last
+        other = self._roots[10 - ip.version]
+        _collect(other, names)
+        names.extend(self._unplaced)
+
+        if len(names) > 0 and self._regions.get(names[0]) is not None:
+            region = self._regions[names[0]]
+            names = [n for n in names if self._regions[n] == region] + \
+                    [n for n in names if self._regions[n] != region]
+
+        answer = render([self._entries[name] for name in names])
+        self._cache[(node, render)] = answer
+        return answer
+
+    def _all(self):
+        names = _collect(self._roots[4], [])
+        _collect(self._roots[6], names)
+        names.extend(self._unplaced)
+        return names
+
+
+def _collect(node, names):
+    """
+    Appends the names of the servers below a node to a list, in the order of their addresses
+    :return: The list
+    """
+    stack = [node] if node is not None else []
+    while len(stack) > 0:
+        node = stack.pop()
+        if node.servers is not None:
+            names.extend(node.servers)
+        # the child of bit 1 is pushed first, so that the child of bit 0 is visited first
+        stack.extend(child for child in reversed(node.children) if child is not None)
+    return names
+
+
+def _bits(ip):
+    """
+    :return: The bits of an IP address, the most significant first
+    """
+    value = int(ip)
+    return [(value >> shift) & 1 for shift in range(ip.max_prefixlen - 1, -1, -1)]
+
+
+def _parse(address):
+    """
+    :return: The IPv4 or IPv6 address in a string, IPv4 addresses mapped in IPv6 are converted to IPv4,
+        or None if the string is not an IP address
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        return ip.ipv4_mapped
+    return ip
+
+
+def resolve(address):
+    """
+    :param address: The address of a server, an IP address or a host name
+    :return: Its IP address, or None if it cannot be resolved. Host names are resolved with a blocking
+        call, that must not be made while holding a lock
+    """
+    ip = _parse(address)
+    if ip is not None:
+        return ip
+
+    try:
+        return _parse(socket.gethostbyname(address))
+    except OSError:
+        return None
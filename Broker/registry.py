@@ -4,30 +4,43 @@ Module containing the Registry class, and the accessory RepeatTimer class for re
 import logging
 from threading import Timer
 
+import wire
+from proximity import ProximityIndex, resolve
 from rwlock import ReadWriteLock, WriteRWLock, ReadRWLock
 
 N_MINUTES = 5
 
+# Maximum bytes of the name and of the address of a server
+MAX_FIELD = 255
+
 
 class Registry:
     """
     This class implements a registry, where server can be registered based on their name and address.
-    Internally it maps a name (string) to a pair of string and bool, representing the concatenation of
-        address and port interlaved by a '|', and if the server has been renewed since the last removal
-        of stale entries.
+    Internally it maps a name (string) to a triple of string, bool and string, representing the
+        concatenation of address and port interlaved by a '|', if the server has been renewed since the
+        last removal of stale entries, and the stats sent by the server with its last registration.
     Consistency is guaranteed by an instance of a ReadWriteLock, which allows parallel reads and locking
         writes.
     Removal of stale entries is performed by the RepeatTimer, that calls self.remove_old every N_MINUTES
-        minutes. This function removes entries that have not been renewed since the last cleanup.
+        minutes. This function removes entries that have not been renewed since the last cleanup. Without
+        the timer, remove_old is called by the owner of the registry, for example by a simulation on a
+        virtual clock.
+    The servers are also indexed by address in a ProximityIndex, with the region they send in their stats,
+        to answer each client with the servers nearest to it first, in the text or in the binary protocol.
+        Servers whose name contains '|' or '$', which can only be registered with the binary protocol, are
+        left out of the text answers since they cannot be represented there.
     """
 
-    def __init__(self, logger):
+    def __init__(self, logger, timer=True):
         """
         Initializes the instance of the registry with all required components, logger, ReadWriteLock
             and RepeatTimer.
         :param logger: the logger object to use in this class
+        :param timer: If False the RepeatTimer is not started, and remove_old must be called by the owner
         """
-        self._registry = {}  # Map<String, (String, Bool)>
+        self._registry = {}  # Map<String, (String, Bool, String)>
+        self._index = ProximityIndex()
 
         self._lock = ReadWriteLock(withPromotion=True)
         self._readLock = ReadRWLock(self._lock)
@@ -39,14 +52,17 @@ class Registry:
 
         self._logger = logger
 
-        self._timer = RepeatTimer(N_MINUTES * 60, self.remove_old)
-        self._timer.start()
+        self._timer = None
+        if timer:
+            self._timer = RepeatTimer(N_MINUTES * 60, self.remove_old)
+            self._timer.start()
 
     def stop_timer(self):
         """
         Stops the RepeatTimer, used for teardown of the class
         """
-        self._timer.cancel()
+        if self._timer is not None:
+            self._timer.cancel()
 
     def remove_old(self):
         """
@@ -60,31 +76,53 @@ class Registry:
                 t = self._registry.get(name)
                 if not t[1]:  # stale entry
                     self._registry.pop(name)
+                    self._index.remove(name)
                     self._logger.log(level=logging.DEBUG, msg=f'Stale server {name} removed')
                 else:  # reset entry
-                    self._registry.update({name: (t[0], False)})
+                    self._registry.update({name: (t[0], False, t[2])})
                     self._logger.log(level=logging.DEBUG, msg=f'Non-stale server {name} kept')
 
         self._generate_string()
 
-    def add_server(self, name, addr):
+    def add_server(self, name, addr, stats=''):
         """
         This function tries to add a server to the registry. Some combination of read and write lock
             is needed for the different situations.
         :param name: A string representing the name the server, also used as the key in the dictionary
         :param addr: A string representing the address and port of the server concatenated with a '|'
             character
+        :param stats: A string of 'key=value' pairs separated by ';' describing the activity of the server,
+            it is not compared with the registered one but replaces it. The 'region' key is the region tag
+            of the server
+        :raise ValueError: If the port is not an integer from 1 to 65535, or the name or the address are
+            longer than MAX_FIELD bytes, since the binary protocol could not represent them
         :return: A string representing the result of the operation:
             'okay' if the server was added successfully
             'renewed' if the server was already registered (its attribute has been manually set to True)
             'taken' if a server with the same name but different address already exists
         """
+        host, _, port = addr.rpartition('|')
+        entry = (name, host, int(port))
+        if not 0 < entry[2] < 1 << 16:
+            raise ValueError(f'Invalid port {port}')
+        if len(name.encode()) > MAX_FIELD or len(host.encode()) > MAX_FIELD:
+            raise ValueError('Name or address too long')
+
         self._lock.acquire_read()
         if name in self._registry.keys():
             if self._registry.get(name)[0] == addr:  # renew
+                moved = _region(self._registry.get(name)[2]) != _region(stats)
+                ip = self._index.address(name)  # the same address, already resolved
                 self._lock.release_read()
                 with self._writeLock:
-                    self._registry.update({name: (addr, True)})
+                    # the entry could have been removed as stale since the read lock was released, it is
+                    #   then added back to the index too
+                    removed = name not in self._registry
+                    self._registry.update({name: (addr, True, stats)})
+                    if moved or name not in self._index:
+                        self._index.add(name, ip, entry, _region(stats))
+                if removed:
+                    self._generate_string()
                 result = "renewed"
                 self._logger.log(level=logging.INFO, msg=f"Server {name} renewed")
             else:  # taken
@@ -94,8 +132,11 @@ class Registry:
                                  msg=f"Server {name} already taken with address different from {addr}")
         else:  # add
             self._lock.release_read()
+            # host names are resolved before taking the lock, since it could take long
+            ip = resolve(host)
             with self._writeLock:
-                self._registry.update({name: (addr, True)})
+                self._registry.update({name: (addr, True, stats)})
+                self._index.add(name, ip, entry, _region(stats))
             self._generate_string()
             result = "okay"
             self._logger.log(level=logging.INFO, msg=f'Server {name} added')
@@ -107,14 +148,82 @@ class Registry:
         Generates the string representation that will be returned to the client.
         """
         with self._readLock:
-            listOfEntries = [f'{name}|{self._registry.get(name)[0]}' for name in self._registry.keys()]
+            listOfEntries = [f'{name}|{self._registry.get(name)[0]}' for name in self._registry.keys()
+                             if _text_safe(name)]
             self._to_string = '$'.join(listOfEntries)
 
-    def get_string(self):
+    def get_string(self, client=None):
         """
+        :param client: The IP address of the client, if given the servers nearest to it come first
         :return: the string representation to transmit to the client
         """
-        return self._to_string
+        if client is None:
+            return self._to_string
+
+        with self._readLock:
+            return self._index.nearest(client, _text_answer)
+
+    def get_binary(self, client):
+        """
+        :param client: The IP address of the client, the servers nearest to it come first
+        :return: the SERVERS message of the binary protocol to transmit to the client
+        """
+        with self._readLock:
+            return self._index.nearest(client, _binary_answer)
+
+    def get_status_string(self):
+        """
+        :return: the string with the name and the last stats of each server, in the same format as
+            get_string. It is generated on request, since the stats change at every renewal
+        """
+        with self._readLock:
+            return '$'.join(f'{name}|{entry[2]}' for name, entry in self._registry.items() if _text_safe(name))
+
+    def get_status(self):
+        """
+        :return: the list of pairs of name and last stats of each server
+        """
+        with self._readLock:
+            return [(name, entry[2]) for name, entry in self._registry.items()]
+
+
+def _text_safe(name):
+    return '|' not in name and '$' not in name
+
+
+def _text_answer(entries):
+    """
+    :param entries: A list of triples of name, address and port
+    :return: The answer to a query in the text protocol
+    """
+    return '$'.join(f'{name}|{address}|{port}' for name, address, port in entries if _text_safe(name))
+
+
+def _binary_answer(entries):
+    """
+    :param entries: A list of triples of name, address and port
+    :return: The answer to a query in the binary protocol
+    """
+    encoded = []
+    for entry in entries:
+        # the entries are checked at registration, an invalid one must not break the whole answer
+        try:
+            encoded.append(wire.encode_server(*entry))
+        except wire.ProtocolError:
+            continue
+    return wire.encode_servers(encoded)
+
+
+def _region(stats):
+    """
+    :param stats: The stats sent by a server
+    :return: The value of the 'region' key of the stats, or None
+    """
+    for item in stats.split(';'):
+        key, _, value = item.partition('=')
+        if key == 'region':
+            return value
+    return None
 
 
 # Perpetual timer with set delay
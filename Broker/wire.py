@@ -0,0 +1,242 @@
+"""
+This module contains the binary protocol of the messages exchanged with the brokers, used alongside the
+    text protocol: a broker answers each message in the protocol it was sent with, so old servers and
+    clients keep working
+Every message starts with a header of three bytes: MAGIC, the VERSION of the protocol and the opcode.
+    MAGIC can never start a text message, since it is not a valid first byte of a UTF-8 character. The
+    fields follow, strings prefixed by their length in bytes, integers in network byte order, and the
+    addresses packed as 4 or 16 bytes when they are IP addresses, so no character needs escaping.
+    - QUERY and STATUS: [context]
+    - REGISTER: name, address, port, stats, [context]
+    - SERVERS, the answer to QUERY: count, then name, address and port of each server
+    - SERVERS_STATUS, the answer to STATUS: count, then name and stats of each server
+    - RESULT, the answer to REGISTER: one byte among RESULTS
+    - ERROR: message, sent by a broker that cannot decode a message
+    The optional context is the one of tracing.py, present when the message does not end before it.
+Messages are decoded from a memoryview, so the fields are read without copying the datagram
+"""
+import socket
+import struct
+
+MAGIC = 0xB7
+VERSION = 1
+
+# Opcodes of the requests and of the answers
+QUERY = 0x01
+STATUS = 0x02
+REGISTER = 0x03
+SERVERS = 0x81
+SERVERS_STATUS = 0x82
+RESULT = 0x83
+ERROR = 0xFF
+
+# The results of a registration, in the order of their codes
+RESULTS = ['okay', 'renewed', 'taken']
+
+# Kinds of the packed addresses
+HOST_NAME = 0
+IPV4 = 4
+IPV6 = 6
+
+_HEADER = struct.Struct('!BBB')
+_U8 = struct.Struct('!B')
+_U16 = struct.Struct('!H')
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a message is not a valid message of this protocol
+    """
+
+
+def is_binary(data):
+    """
+    :param data: The bytes of a received message
+    :return: True if the message uses this protocol, False if it uses the text protocol
+    """
+    return len(data) > 0 and data[0] == MAGIC
+
+
+# ENCODING
+
+def _header(opcode):
+    return _HEADER.pack(MAGIC, VERSION, opcode)
+
+
+def _string(value, size=_U8):
+    encoded = value.encode('utf-8')
+    if len(encoded) >= 1 << (8 * size.size):
+        raise ProtocolError(f'Field too long: {value[:32]!r}')
+    return size.pack(len(encoded)) + encoded
+
+
+def _address(address):
+    """
+    :param address: An IP address or a host name
+    :return: The kind of the address followed by the address, packed if it is an IP address
+    """
+    for kind, family in [(IPV4, socket.AF_INET), (IPV6, socket.AF_INET6)]:
+        try:
+            return _U8.pack(kind) + socket.inet_pton(family, address)
+        except OSError:
+            pass
+    return _U8.pack(HOST_NAME) + _string(address)
+
+
+def _context(context):
+    return _string(context) if context is not None else b''
+
+
+def encode_query(context=None):
+    return _header(QUERY) + _context(context)
+
+
+def encode_status(context=None):
+    return _header(STATUS) + _context(context)
+
+
+def encode_register(name, address, port, stats='', context=None):
+    """
+    :param name: The name of the server
+    :param address: The address the clients use to connect to the server
+    :param port: The port the clients use to connect to the server
+    :param stats: The stats of the server, as in the text protocol
+    :param context: The tracing context of the request, or None
+    :return: The bytes of the message
+    """
+    return _header(REGISTER) + _string(name) + _address(address) + _port(port) + _string(stats, _U16) + \
+        _context(context)
+
+
+def _port(port):
+    if not 0 < port < 1 << 16:
+        raise ProtocolError(f'Invalid port {port}')
+    return _U16.pack(port)
+
+
+def encode_server(name, address, port):
+    """
+    :return: The bytes of one server in a SERVERS message, so that they can be encoded once and reused
+    :raise ProtocolError: If a field does not fit in the message
+    """
+    return _string(name) + _address(address) + _port(port)
+
+
+def encode_servers(entries):
+    """
+    :param entries: A list of servers encoded by encode_server
+    :return: The bytes of the message
+    """
+    return _header(SERVERS) + _U16.pack(len(entries)) + b''.join(entries)
+
+
+def encode_servers_status(servers):
+    """
+    :param servers: A list of pairs of name and stats
+    :return: The bytes of the message
+    """
+    return _header(SERVERS_STATUS) + _U16.pack(len(servers)) + \
+        b''.join(_string(name) + _string(stats, _U16) for name, stats in servers)
+
+
+def encode_result(result):
+    """
+    :param result: One of RESULTS
+    :return: The bytes of the message
+    """
+    return _header(RESULT) + _U8.pack(RESULTS.index(result))
+
+
+def encode_error(message):
+    return _header(ERROR) + _string(message)
+
+
+# DECODING
+
+class _Reader:
+    """
+    This class reads the fields of a message in order, from a memoryview of its bytes
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def remaining(self):
+        return len(self.view) - self.offset
+
+    def take(self, size):
+        if self.remaining() < size:
+            raise ProtocolError('Truncated message')
+        field = self.view[self.offset:self.offset + size]
+        self.offset += size
+        return field
+
+    def integer(self, size=_U8):
+        return size.unpack_from(self.take(size.size))[0]
+
+    def string(self, size=_U8):
+        try:
+            return str(self.take(self.integer(size)), 'utf-8')
+        except UnicodeDecodeError:
+            raise ProtocolError('Invalid string')
+
+    def address(self):
+        kind = self.integer()
+        if kind == IPV4:
+            return socket.inet_ntop(socket.AF_INET, self.take(4))
+        if kind == IPV6:
+            return socket.inet_ntop(socket.AF_INET6, self.take(16))
+        if kind == HOST_NAME:
+            return self.string()
+        raise ProtocolError(f'Invalid address kind {kind}')
+
+    def context(self):
+        return self.string() if self.remaining() > 0 else None
+
+    def end(self):
+        if self.remaining() > 0:
+            raise ProtocolError('Unexpected bytes at the end of the message')
+
+
+def decode(data):
+    """
+    :param data: The bytes of a message of this protocol
+    :return: A pair of the opcode and a tuple with the fields of the message:
+        - QUERY, STATUS: (context,)
+        - REGISTER: (name, address, port, stats, context)
+        - SERVERS: (list of (name, address, port),)
+        - SERVERS_STATUS: (list of (name, stats),)
+        - RESULT: (result,), one of RESULTS
+        - ERROR: (message,)
+    :raise ProtocolError: If the message is not valid, or has a different version
+    """
+    reader = _Reader(data)
+    magic, version, opcode = _HEADER.unpack_from(reader.take(_HEADER.size))
+    if magic != MAGIC:
+        raise ProtocolError('Not a binary message')
+    if version != VERSION:
+        raise ProtocolError(f'Unsupported version {version}, the supported version is {VERSION}')
+
+    if opcode in (QUERY, STATUS):
+        fields = (reader.context(),)
+    elif opcode == REGISTER:
+        fields = (reader.string(), reader.address(), reader.integer(_U16), reader.string(_U16),
+                  reader.context())
+    elif opcode == SERVERS:
+        fields = ([(reader.string(), reader.address(), reader.integer(_U16))
+                   for _ in range(reader.integer(_U16))],)
+    elif opcode == SERVERS_STATUS:
+        fields = ([(reader.string(), reader.string(_U16)) for _ in range(reader.integer(_U16))],)
+    elif opcode == RESULT:
+        code = reader.integer()
+        if code >= len(RESULTS):
+            raise ProtocolError(f'Invalid result {code}')
+        fields = (RESULTS[code],)
+    elif opcode == ERROR:
+        fields = (reader.string(),)
+    else:
+        raise ProtocolError(f'Unknown opcode {opcode}')
+
+    reader.end()
+    return opcode, fields
@@ -1,28 +1,64 @@
 """
 Scripts that launches the Client when executed
 """
+import asyncio
+import codecs
+import collections
+import json
 import logging
 import os
+import selectors
 import socket
 import sys
+import threading
+import time
 
 import validators
 from validators import ValidationFailure
 
+import tracing
+import wire
+
 # INPUT PARAMETERS
 
 if len(sys.argv) != 3:
     print('Invalid arguments. Usage: [client <brokerAddress> <brokerPort>]')
     exit(-1)
 
-brokerAddress = sys.argv[1]
-
 try:
     brokerPort = int(sys.argv[2])
+
+    # brokerAddress can be a comma separated list of brokers, each one optionally with its own port
+    brokers = []
+    for entry in sys.argv[1].split(','):
+        address, _, port = entry.partition(':')
+        brokers.append((address, int(port) if port else brokerPort))
 except ValueError:
     print('Invalid port argument')
     exit(-1)
 
+# OPTIONAL FEATURES
+
+# Protocol of the queries, 'text' or 'binary' (see wire), the brokers must support the binary one. The
+#   answers are accepted in both protocols
+brokerProtocol = os.environ.get('BROKER_PROTOCOL', 'text')
+if brokerProtocol not in ['text', 'binary']:
+    print('Invalid BROKER_PROTOCOL value')
+    exit(-1)
+
+# CONSTANTS
+
+# Seconds to wait for the first valid answer of the brokers
+QUERY_TIMEOUT = 30
+
+# File keeping the last list of servers received from the brokers, and seconds it is shown for
+CACHE_PATH = './cache/servers.json'
+CACHE_TTL = 300
+
+# Seconds given to all the servers to accept the probe connection, the slower ones are shown as not
+#   responding
+PROBE_TIMEOUT = 2
+
 # GLOBAL VARIABLES
 
 manual_address = False
@@ -41,10 +77,15 @@ if not os.path.exists('./logs'):
     os.makedirs('./logs')
 
 logging.basicConfig(filename=f'logs/{os.getpid()}.log',
-                    format='%(asctime)s:%(process)d:%(name)s:%(levelname)s:%(message)s',
+                    format=tracing.LOG_FORMAT,
                     datefmt='%Y-%m-%dT%H:%M:%S%z',
                     level=logging.DEBUG)
 logger = logging.getLogger('Client')
+tracing.setup(logger)
+
+# All the requests of this client are traced together, from the query of the brokers to the end of
+#   the game, so the logs of the brokers and of the server can be merged with the client's
+trace = tracing.new_trace()
 
 
 # EXIT CODES
@@ -52,39 +93,192 @@ logger = logging.getLogger('Client')
 # -2    user chooses not to retry connection to the server
 # -3    game ends because the server stops responding
 
-def _query_broker():
+def _parse_answer(data):
+    """
+    :param data: The bytes of the answer of a broker to the query
+    :return: A list of pairs containing the name of the server in the first element, and the pair of
+        address string and integer port in the second element
+    :raise ValueError: If the answer is not a valid list of servers
     """
-    This function queries the Broker and returns the result.
+    if wire.is_binary(data):
+        opcode, fields = wire.decode(data)
+        if opcode != wire.SERVERS:
+            raise ValueError(f'unexpected answer {fields}')
+        return [(name, (address, port)) for name, address, port in fields[0]]
+
+    received = str(data, "utf-8")
+
+    # if "empty" is received no servers are registered
+    if received == "empty":
+        return []
+
+    servers = []
+    for serv in received.split('$'):
+        fields = serv.split('|')
+        if len(fields) != 3:
+            raise ValueError(f'invalid server entry {serv!r}')
+        servers.append((fields[0], (fields[1], int(fields[2]))))
+
+    # [(<str:name>, (<str:addr>, <int:port>)]
+    return servers
+
+
+def _query_brokers():
+    """
+    This function queries all the brokers at once and returns the first valid answer.
     :return: A list of pairs containing the name of the server in the first element,
         and the pair of address string and integer port in the second element; and a bool.
-        If the broker is not available an empty list is returned and the bool is False.
-        If the broker is available with no registered servers an empty list is returned
+        If no broker is available an empty list is returned and the bool is False.
+        If a broker is available with no registered servers an empty list is returned
             and the bool is True.
     """
+    context = tracing.new_context(trace)
+    sent = time.monotonic()
+
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(30)
-        # sends agreed "query" string to broker
-        sock.sendto(bytes("query" + "\n", "utf-8"), (brokerAddress, brokerPort))
+        # sends agreed "query" string to all the brokers, a broker that cannot be resolved is skipped
+        if brokerProtocol == 'binary':
+            query = wire.encode_query(context)
+        else:
+            query = bytes(tracing.add_context("query", context) + "\n", "utf-8")
 
-        try:
-            received = str(sock.recv(1024), "utf-8")
+        tracing.event('query.send', context, brokers=len(brokers))
+        for broker in brokers:
+            try:
+                sock.sendto(query, broker)
+            except socket.error as e:
+                logger.log(level=logging.WARN, msg=f'Cannot query broker {broker[0]}:{broker[1]}: {e}')
 
-            # if "empty" is received no servers are registered
-            if received == "empty":
-                return [], True
-        except (socket.timeout, socket.error):
-            # Broker is not available
-            return [], False
-        except KeyboardInterrupt:
-            logger.log(level=logging.INFO, msg='User terminated the process')
-            exit(-1)
+        deadline = time.monotonic() + QUERY_TIMEOUT
+        while (remaining := deadline - time.monotonic()) > 0:
+            sock.settimeout(remaining)
+            try:
+                data, sender = sock.recvfrom(65536)
+            except socket.timeout:
+                break
+            except socket.error:
+                # an unreachable broker is reported on the socket, the others can still answer
+                continue
+
+            try:
+                servers = _parse_answer(data)
+            except (UnicodeDecodeError, ValueError) as e:
+                logger.log(level=logging.WARN, msg=f'Invalid answer from broker {sender[0]}:{sender[1]}: {e}')
+                continue
+
+            logger.log(level=logging.INFO, msg=f'Broker {sender[0]}:{sender[1]} answered first')
+            tracing.event('query.answer', context, broker=f'{sender[0]}:{sender[1]}',
+                          rtt_us=int((time.monotonic() - sent) * 1e6))
+            return servers, True
+
+    # Broker is not available
+    return [], False
+
+
+def _load_cache():
+    """
+    Reads the list of servers saved by the last successful query, if it is recent enough
+    :return: A pair of the list of servers, as returned by _query_brokers, and its age in seconds; or
+        None if there is no valid cache
+    """
+    try:
+        with open(CACHE_PATH) as f:
+            cache = json.load(f)
+        age = time.time() - cache['time']
+        servers = [(name, (address, int(port))) for name, address, port in cache['servers']]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.log(level=logging.DEBUG, msg=f'No valid server cache: {e}')
+        return None
+
+    if not 0 <= age <= CACHE_TTL:
+        return None
+    return servers, age
+
+
+def _save_cache(servers):
+    """
+    Saves a list of servers received from the brokers, replacing the previous one at once so that other
+        clients never read a partial file
+    :param servers: A list of servers, as returned by _query_brokers
+    """
+    temporary = f'{CACHE_PATH}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with open(temporary, 'w') as f:
+            json.dump({'time': time.time(), 'servers': [[name, addr, port] for name, (addr, port) in servers]}, f)
+        os.replace(temporary, CACHE_PATH)
+    except OSError as e:
+        logger.log(level=logging.WARN, msg=f'Cannot save the server cache: {e}')
+
+
+class Refresh(threading.Thread):
+    """
+    This class queries the brokers in the background and saves their answer in the cache, so that the
+        user does not wait for the brokers while the cached list is recent enough
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.result = None
 
-    # Parsing the response
-    s_strings = received.split('$')
-    s_tuples = [serv.split('|') for serv in s_strings]
+    def run(self):
+        self.result = _query_brokers()
+        if self.result[1]:
+            _save_cache(self.result[0])
 
-    # return [(<str:name>, (<str:addr>, <int:port>)], True
-    return [(serv[0], (serv[1], int(serv[2]))) for serv in s_tuples], True
+
+async def _probe(address):
+    """
+    Measures the time taken to open a TCP connection to a server, which is closed right away
+    :param address: A pair of address string and integer port
+    :return: The round trip time in seconds, or None if the connection was refused
+    """
+    start = time.monotonic()
+    try:
+        _, writer = await asyncio.open_connection(*address)
+    except OSError:
+        return None
+
+    rtt = time.monotonic() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return rtt
+
+
+async def _probe_all(servers):
+    """
+    Probes all the servers at the same time, for at most PROBE_TIMEOUT seconds in total
+    :param servers: A list of pairs of name and address, as returned by _query_brokers
+    :return: A list with the round trip time of each server in seconds, 'unreachable' if the connection
+        failed, or 'not responding' if it did not complete in time
+    """
+    tasks = [asyncio.create_task(_probe(address)) for _, address in servers]
+    done, pending = await asyncio.wait(tasks, timeout=PROBE_TIMEOUT)
+
+    for task in pending:
+        task.cancel()
+
+    return [('unreachable' if task.result() is None else task.result()) if task in done else 'not responding'
+            for task in tasks]
+
+
+def _rank_servers(servers):
+    """
+    Probes the servers and sorts them by round trip time, the servers that could not be reached last
+    :param servers: A list of pairs of name and address, as returned by _query_brokers
+    :return: A list of triples containing the name, the address and the round trip time (or the reason
+        it is missing) of each server
+    """
+    ranked = [(name, address, rtt) for (name, address), rtt in zip(servers, asyncio.run(_probe_all(servers)))]
+    ranked.sort(key=lambda server: server[2] if isinstance(server[2], float) else float('inf'))
+
+    for name, address, rtt in ranked:
+        logger.log(level=logging.DEBUG, msg=f'Probed {name} at {address[0]}:{address[1]}: '
+                                            f'{f"{rtt * 1000:.1f} ms" if isinstance(rtt, float) else rtt}')
+    return ranked
 
 
 def _valid_addr(address_tuple):
@@ -126,7 +320,7 @@ def _get_input_address():
     """
     while True:
         try:
-            input_addr = input("Input the desired server's address and port separated by a space: ")
+            input_addr = stdin.input("Input the desired server's address and port separated by a space: ")
         except (EOFError, KeyboardInterrupt):
             logger.log(level=logging.INFO, msg='User terminated the process')
             exit(-1)
@@ -140,8 +334,127 @@ def _get_input_address():
             print('Invalid address and/or port inserted')
 
 
+class LineReader:
+    """
+    This class reads the lines typed by the user directly from the file descriptor of stdin.
+    The input() function reads stdin through a buffer, so the lines read ahead (as happens when stdin is
+        not a terminal) would be hidden from the selector of the game loop: all the lines are read with
+        this class instead, and the lines read ahead are kept in it
+    """
+
+    def __init__(self, fd):
+        """
+        :param fd: The file descriptor to read
+        """
+        self.fd = fd
+        self.lines = collections.deque()
+        self._partial = b''  # the last line, until its newline is read
+        self._closed = False
+
+    def fill(self):
+        """
+        Reads the data available on the file descriptor, blocking if there is none
+        :raise EOFError: If the end of the file was reached, and all the lines have been read
+        """
+        if self._closed:
+            raise EOFError
+
+        data = os.read(self.fd, 1024)
+        if data == b'':
+            # a last line without newline is still a line
+            self._closed = True
+            if self._partial == b'':
+                raise EOFError
+            data = b'\n'
+
+        *complete, self._partial = (self._partial + data).split(b'\n')
+        self.lines.extend(line.decode('utf-8', errors='replace').rstrip('\r') for line in complete)
+
+    def input(self, prompt):
+        """
+        Equivalent of the input() function
+        :param prompt: The string written before reading
+        :return: The next line, without its newline
+        :raise EOFError: If there are no more lines
+        """
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        while len(self.lines) == 0:
+            self.fill()
+        return self.lines.popleft()
+
+
+# Reader of all the input of the user
+stdin = LineReader(sys.stdin.fileno())
+
+
+def _play(sock, context):
+    """
+    Displays the messages of the server and sends it the lines typed by the user, until the connection is
+        closed. The socket and stdin are watched by a selector, so the messages are displayed as soon as
+        they arrive, even while the user is typing. The messages are decoded incrementally, so that a
+        character split between two reads is not broken. A line is sent only if the server has sent a
+        message after the previous line, the lines typed ahead wait for the next message, so two answers
+        never reach the server merged
+    :param sock: The socket connected to the server
+    :param context: The trace context of the game session
+    :raise ConnectionError: When the server closes the connection
+    :raise EOFError: When stdin is closed, and the server asks for a line after the last one
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    prompted = False  # True if the server has sent a message after the last line sent
+    prompt = ''  # the last line displayed, shown again after an empty line
+    received = None  # the time of the last message of the server
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(stdin.fd, selectors.EVENT_READ)
+
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is sock:
+                    data = sock.recv(4096)
+
+                    # Server has closed the connection
+                    if data == b'':
+                        raise ConnectionError('Connection closed by the server')
+
+                    text = decoder.decode(data)
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                    prompt = (prompt + text).rpartition('\n')[2]
+                    prompted = True
+                    received = time.monotonic()
+                else:
+                    try:
+                        stdin.fill()
+                    except EOFError:
+                        # the lines already read are still sent
+                        selector.unregister(stdin.fd)
+
+            # the lines waiting for a message of the server, including those read before the game
+            while prompted and len(stdin.lines) > 0:
+                move = stdin.lines.popleft()
+                if len(move) != 0:
+                    sock.sendall(move.encode('utf-8'))
+                    prompted = False
+                    tracing.event('answer.send', context, think_us=int((time.monotonic() - received) * 1e6))
+                else:
+                    print("Invalid move")
+                    sys.stdout.write(prompt)
+                    sys.stdout.flush()
+
+            if prompted and len(stdin.lines) == 0 and stdin.fd not in selector.get_map():
+                raise EOFError
+
+
 # SCRIPT START
 
+# the brokers are queried while the user makes their choice
+refresh = Refresh()
+refresh.start()
+
 # OBTAINING A SERVER ADDRESS
 # The user is prompted to either query the broker or input a server address
 # If the query is successful, the user is asked to choose one of the available servers
@@ -154,7 +467,7 @@ while not valid_address:
     manual_address = False
 
     try:
-        choice = input("Choose:\n [1] Query the broker\n [2] Manually input an address\nYour choice: ")
+        choice = stdin.input("Choose:\n [1] Query the broker\n [2] Manually input an address\nYour choice: ")
     except (EOFError, KeyboardInterrupt):
         logger.log(level=logging.INFO, msg='User terminated the process')
         exit(-1)
@@ -168,9 +481,24 @@ while not valid_address:
         continue
 
     if query_broker:
+        discovery = tracing.new_context(trace)
+        tracing.event('discovery.start', discovery)
+
+        # a recent cached list is shown right away while the brokers are still being queried, otherwise
+        #   the answer of the brokers is awaited
+        cached = _load_cache() if refresh.is_alive() else None
+        if cached is not None:
+            servers, age = cached
+            valid_response = True
+            print(f"Showing the servers available {age:.0f} seconds ago, the list is being refreshed.")
+            logger.log(level=logging.INFO, msg=f'Using the server cache from {age:.0f} seconds ago')
+        else:
+            refresh.join()
+            servers, valid_response = refresh.result
 
-        # attempts wuery
-        servers, valid_response = _query_broker()
+            # the next query asks the brokers again
+            refresh = Refresh()
+            refresh.start()
 
         if not valid_response:
             print("Broker not available, please try again or manually input a server address.")
@@ -182,14 +510,24 @@ while not valid_address:
             logger.log(level=logging.INFO, msg='No servers on Broker')
             continue
 
-        # lists servers to the user and asks for their pick
+        # all the servers are probed at the same time, and listed from the fastest one
+        print("Measuring the round trip time to the servers...")
+        servers = _rank_servers(servers)
+        tracing.event('discovery.end', discovery, source='cache' if cached is not None else 'brokers',
+                      servers=len(servers))
+        reachable = [s for s in servers if isinstance(s[2], float)]
+
+        # lists servers to the user and asks for their pick, 0 picks the fastest one
         while not valid_address:
             print("Servers currently available:")
+            if len(reachable) > 0:
+                print(f" [0]:\tConnect to the fastest server ({reachable[0][0]})")
             for i, s in enumerate(servers):
-                print(f" [{i + 1}]:\t{s[0]}")
+                rtt = f'{s[2] * 1000:.0f} ms' if isinstance(s[2], float) else s[2]
+                print(f" [{i + 1}]:\t{s[0]}\t({rtt})")
 
             try:
-                n = input("Choose the server you want to connect to: ")
+                n = stdin.input("Choose the server you want to connect to: ")
                 index = int(n)
             except (EOFError, KeyboardInterrupt):
                 logger.log(level=logging.INFO, msg='User terminated the process')
@@ -198,6 +536,9 @@ while not valid_address:
                 print("Please type a number from the list")
                 continue
 
+            if index == 0 and len(reachable) > 0:
+                index = 1
+
             if 1 <= index <= len(servers):
                 print(f"Chosen {servers[index - 1][0]}. Will attempt connection...")
                 server_address = servers[index - 1][1]
@@ -216,6 +557,9 @@ while not valid_address:
 # At this point the server_address variable contains the pair (addr, port)
 logger.log(level=logging.INFO, msg=f'Chosen server at address {server_address[0]}:{server_address[1]}')
 
+# the game session is a span of the trace, the server receives its context right after the connection
+session = tracing.new_context(trace)
+
 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
     s.settimeout(None)
 
@@ -223,12 +567,15 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
     #   decides to stop attempting
     while not connected_to_server:
         try:
+            tracing.event('connect.start', session, server=f'{server_address[0]}:{server_address[1]}')
             s.connect(server_address)
+            s.sendall(tracing.handshake(session))
+            tracing.event('connect.end', session)
             connected_to_server = True
             print("Connected to server!")
             logger.log(level=logging.INFO, msg='Connected to server')
         except (socket.timeout, socket.error):
-            choice = input("Cannot connect to the server. Do you want to try again? [y/n]: ")
+            choice = stdin.input("Cannot connect to the server. Do you want to try again? [y/n]: ")
             logger.log(level=logging.WARN, msg='Cannot connect to chosen Server')
             if choice != 'y':
                 print("Terminating...")
@@ -240,29 +587,18 @@ with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             exit(-1)
 
     # A connection to the server is established
-    # Each message coming from the server is displayed to the user, the user's response
-    #   is read from stdin and sent to the server
+    # Each message coming from the server is displayed to the user as soon as it arrives, and the
+    #   user's lines are sent to the server
     # This stops when the user terminates the process or the connection is closed
-    while True:
-        try:
-            prompt = s.recv(1024).decode('utf-8')
-
-            # Server has closed the connection
-            if prompt == '':
-                raise socket.timeout
-
-            while True:
-                move = input(prompt)
-                if len(move) != 0:
-                    s.sendall(move.encode('utf-8'))
-                    break
-                else:
-                    print("Invalid move")
-        except (socket.timeout, socket.error):
-            print("Server stopped responding, terminating...")
-            logger.log(level=logging.INFO, msg='Connectino with the Server was closed')
-            exit(-3)
-        except (EOFError, KeyboardInterrupt):
-            print("Terminating...")
-            logger.log(level=logging.INFO, msg='User terminated the process')
-            exit(-1)
+    try:
+        _play(s, session)
+    except (socket.timeout, socket.error):
+        print("\nServer stopped responding, terminating...")
+        logger.log(level=logging.INFO, msg='Connectino with the Server was closed')
+        tracing.event('session.end', session, reason='closed')
+        exit(-3)
+    except (EOFError, KeyboardInterrupt):
+        print("\nTerminating...")
+        logger.log(level=logging.INFO, msg='User terminated the process')
+        tracing.event('session.end', session, reason='user')
+        exit(-1)
@@ -0,0 +1,173 @@
+"""
+This module contains the log where the game servers append a compact binary record of every game
+Each file starts with a HEADER, followed by records of RECORD.size bytes, so that it can be read as an
+    array of fixed-width structures (see Tools/game_analytics.py). All the numbers are little-endian.
+The records are batched in memory and written by a single thread, so the game threads never wait for the
+    disk, and the files are rotated once they reach a maximum size
+"""
+import logging
+import os
+import struct
+import threading
+import time
+
+# Identifier and version of the format, written at the beginning of each file
+MAGIC = b'GAMEREC\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sHH4x')
+
+# Fields of a record:
+#   game (uint8), outcome (uint8), flags (uint8), size of the board (uint8), number of moves (uint16),
+#   start of the game as a unix timestamp (float64), duration of the game in milliseconds (uint32),
+#   milliseconds each player took to answer (2 x uint32), and the first MAX_MOVES moves (uint8 each)
+MAX_MOVES = 32
+RECORD = struct.Struct(f'<BBBBH2xdIII4x{MAX_MOVES}s')
+
+# Games
+TIC_TAC_TOE = 1
+ROCK_PAPER_SCISSORS = 2
+
+# Outcomes
+DRAW = 0
+PLAYER_1 = 1
+PLAYER_2 = 2
+TIMED_OUT = 3
+ABORTED = 4
+
+# Flags
+AGAINST_BOT = 1
+
+# Moves of Rock-Paper-Scissors, each round is stored as 3 * move of player 1 + move of player 2
+RPS_MOVES = ['rock', 'paper', 'scissors']
+
+# Records written at once, seconds after which a partial batch is written anyway, and size of a file
+#   after which a new one is started
+BATCH_SIZE = 256
+FLUSH_SECONDS = 1
+MAX_FILE_BYTES = 64 * 1024 * 1024
+
+
+class GameLog:
+    """
+    This class appends the records to the files in a directory. Each process writes its own files, named
+        after its pid and the time they were started, so that pre-fork workers never share a file
+    """
+
+    def __init__(self, directory, logger):
+        """
+        :param directory: The directory of the files, created if it does not exist
+        :param logger: the logger object to use in this class
+        """
+        self._directory = directory
+        self._logger = logger
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._stopped = False
+
+        self._file = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the pending records and closes the file, used for teardown of the class
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def append(self, record):
+        """
+        Queues a record, it is written by the thread of the class
+        :param record: The packed record
+        """
+        with self._condition:
+            self._pending.append(record)
+            if len(self._pending) >= BATCH_SIZE:
+                self._condition.notify()
+
+    def _run(self):
+        """
+        Executed by the thread of the class, until stop is called
+        """
+        while True:
+            with self._condition:
+                if not self._stopped and len(self._pending) < BATCH_SIZE:
+                    self._condition.wait(FLUSH_SECONDS)
+                batch = self._pending
+                self._pending = []
+                stopped = self._stopped
+
+            if len(batch) > 0:
+                try:
+                    self._write(b''.join(batch))
+                except OSError as e:
+                    self._logger.log(level=logging.ERROR, msg=f'Cannot write {len(batch)} game records: {e}')
+
+            if stopped:
+                break
+
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, data):
+        """
+        Appends the records to the current file, starting a new one if it is full
+        """
+        if self._file is not None and self._file.tell() + len(data) > MAX_FILE_BYTES:
+            self._file.close()
+            self._file = None
+
+        if self._file is None:
+            path = os.path.join(self._directory, f'games-{os.getpid()}-{time.time_ns()}.rec')
+            self._file = open(path, 'ab')
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self._logger.log(level=logging.DEBUG, msg=f'Writing game records to {path}')
+
+        self._file.write(data)
+        self._file.flush()
+
+
+# The log of this process, None if the records are disabled
+_log = None
+
+
+def open_log(directory, logger):
+    """
+    Starts writing the records of the games of this process in a directory
+    """
+    global _log
+    _log = GameLog(directory, logger)
+    _log.start()
+
+
+def close_log():
+    """
+    Writes the pending records of this process
+    """
+    if _log is not None:
+        _log.stop()
+
+
+def record(game, outcome, started, moves, think, board_size=0, against_bot=False):
+    """
+    Appends the record of a game to the log of this process, if the records are enabled
+    :param game: TIC_TAC_TOE or ROCK_PAPER_SCISSORS
+    :param outcome: One of the outcome constants
+    :param started: The start of the game as a unix timestamp
+    :param moves: A list of integers between 0 and 255, only the first MAX_MOVES are stored
+    :param think: A list with the seconds each player took to answer
+    :param board_size: The size of the side of the board, 0 for games without a board
+    :param against_bot: True if the second player is the bot
+    """
+    if _log is None:
+        return
+
+    _log.append(RECORD.pack(game, outcome, AGAINST_BOT if against_bot else 0, board_size, min(len(moves), 65535),
+                            started, min(int((time.time() - started) * 1000), 2 ** 32 - 1),
+                            int(think[0] * 1000), int(think[1] * 1000), bytes(moves[:MAX_MOVES])))
@@ -0,0 +1,119 @@
+"""
+This module contains the index used to pair the queued players by rating
+"""
+import bisect
+import heapq
+import itertools
+
+
+class SkillQueue:
+    """
+    This class pairs the queued players whose ratings are close enough.
+    A player accepts an opponent whose rating differs by at most the initial gap, and the accepted gap
+        widens at a constant rate while they wait. A pair is formed as soon as one of the two players
+        accepts the other.
+    The players are kept sorted by rating, so the closest opponent of each player is one of their two
+        neighbours. Each pair of neighbours is pushed on a heap with the time it becomes acceptable, so
+        finding the next pair takes logarithmic time. Adding or removing a player is a binary search and
+        an insertion or deletion in a list, linear in the number of queued players, but moving the
+        pointers of a list is cheap at the queue sizes of a server. Entries of pairs that are no longer
+        neighbours are discarded when they reach the top of the heap
+    """
+
+    def __init__(self, gap, growth):
+        """
+        :param gap: The rating gap accepted by a player as soon as they are queued
+        :param growth: The points the accepted gap widens by for every second of wait, greater than 0
+        """
+        self._gap = gap
+        self._growth = growth
+
+        self._sorted = []  # sorted list of (rating, sequence number, connection)
+        self._entries = {}  # Map<socket, (rating, int, float)>, the key of each player and their queue time
+        self._pairs = []  # heap of (time, sequence number, connection, connection)
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def add(self, conn, rating, queued):
+        """
+        :param conn: The connection of the player
+        :param rating: The rating of the player
+        :param queued: The time.monotonic() the player started waiting
+        """
+        seq = next(self._counter)
+        self._entries[conn] = (rating, seq, queued)
+        i = bisect.bisect_left(self._sorted, (rating, seq))
+        self._sorted.insert(i, (rating, seq, conn))
+
+        if i > 0:
+            self._push(self._sorted[i - 1][2], conn)
+        if i + 1 < len(self._sorted):
+            self._push(conn, self._sorted[i + 1][2])
+
+    def remove(self, conn):
+        """
+        :param conn: The connection of a queued player, removing a player not in the queue has no effect
+        """
+        entry = self._entries.pop(conn, None)
+        if entry is None:
+            return
+
+        i = bisect.bisect_left(self._sorted, entry[:2])
+        del self._sorted[i]
+
+        # the neighbours of the removed player are now next to each other
+        if 0 < i < len(self._sorted):
+            self._push(self._sorted[i - 1][2], self._sorted[i][2])
+
+    def pop_pair(self, now):
+        """
+        Removes the next acceptable pair of players from the queue
+        :param now: The current time.monotonic()
+        :return: A pair of connections and the rating gap between them, or None if no pair is acceptable
+        """
+        while len(self._pairs) > 0 and self._pairs[0][0] <= now:
+            _, _, low, high = heapq.heappop(self._pairs)
+            if not self._adjacent(low, high):
+                continue
+
+            gap = self._entries[high][0] - self._entries[low][0]
+            self.remove(low)
+            self.remove(high)
+            return (low, high), gap
+
+        return None
+
+    def next_deadline(self):
+        """
+        :return: The time.monotonic() when the next pair may become acceptable, or None
+        """
+        while len(self._pairs) > 0 and not self._adjacent(self._pairs[0][2], self._pairs[0][3]):
+            heapq.heappop(self._pairs)
+
+        return self._pairs[0][0] if len(self._pairs) > 0 else None
+
+    def _push(self, low, high):
+        """
+        Schedules a pair of neighbours, at the time the player who has waited longer accepts the gap
+        """
+        low_rating, _, low_queued = self._entries[low]
+        high_rating, _, high_queued = self._entries[high]
+
+        excess = high_rating - low_rating - self._gap
+        ready = min(low_queued, high_queued)
+        if excess > 0:
+            ready += excess / self._growth
+
+        heapq.heappush(self._pairs, (ready, next(self._counter), low, high))
+
+    def _adjacent(self, low, high):
+        """
+        :return: True if both players are queued, and next to each other in the sorted list
+        """
+        if low not in self._entries or high not in self._entries:
+            return False
+
+        i = bisect.bisect_left(self._sorted, self._entries[low][:2])
+        return i + 1 < len(self._sorted) and self._sorted[i + 1][2] is high
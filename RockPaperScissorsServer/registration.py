@@ -0,0 +1,269 @@
+"""
+This module contains the client used by the game servers to stay registered on the brokers
+"""
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+
+import tracing
+import wire
+
+# Seconds to wait for the answer of a broker, doubled after each failed attempt up to MAX_TIMEOUT
+BASE_TIMEOUT = 0.5
+MAX_TIMEOUT = 8
+
+# Maximum seconds between two attempts on a broker that does not answer
+MAX_BACKOFF = 60
+
+
+def answer_timeout(failures):
+    """
+    :param failures: The number of attempts in a row that a broker did not answer
+    :return: The seconds to wait for the answer of the broker to the next attempt
+    """
+    return min(BASE_TIMEOUT * 2 ** failures, MAX_TIMEOUT)
+
+
+def retry_delay(failures, rng=random):
+    """
+    :param failures: The number of attempts in a row that a broker did not answer, at least 1
+    :param rng: The random generator of the jitter
+    :return: The seconds until the next attempt on the broker, with exponential backoff and jitter
+    """
+    delay = min(BASE_TIMEOUT * 2 ** failures, MAX_BACKOFF)
+    return rng.uniform(delay / 2, delay)
+
+
+def renewal_delay(interval, rng=random):
+    """
+    :param interval: Maximum seconds between two renewals on the same broker
+    :param rng: The random generator of the jitter
+    :return: The seconds until the next renewal on a broker that answered
+    """
+    return interval * rng.uniform(0.8, 1)
+
+
+class Broker:
+    """
+    This class holds the state of the registration on a single broker
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.resolved = None
+        self.registered = False
+        self.confirming = False
+        self.failures = 0
+        self.next_attempt = 0
+
+        # the context and the time of the last registration sent
+        self.context = None
+        self.sent = None
+
+
+class BrokerRegistration:
+    """
+    This class keeps the server registered on a list of brokers, from a single thread and a single UDP
+        socket.
+    Each broker is handled independently: a broker that does not answer is retried with exponential
+        backoff, without delaying the registration on the others, so the server stays discoverable as
+        long as one of them is up.
+    Renewals are spread with random jitter, so that servers started together do not hit the brokers
+        at the same time, and always happen before the interval expires.
+    A broker answering 'okay' to a renewal has lost its registry, as it happens when it is restarted:
+        the registration is sent again right away to make sure it is stored.
+    """
+
+    def __init__(self, name, address, port, brokers, interval, logger, status=None, region=None, binary=False,
+                 clock=time.monotonic, rng=random):
+        """
+        :param name: The name of the server
+        :param address: The address string the clients use to connect to the server
+        :param port: The port the clients use to connect to the server
+        :param brokers: A list of pairs of address and port of the brokers
+        :param interval: Maximum seconds between two renewals on the same broker
+        :param logger: the logger object to use in this class
+        :param status: An optional function without arguments, returning a string of 'key=value' pairs
+            separated by ';' that is sent to the brokers with every registration
+        :param region: An optional region tag, sent with the stats as 'region=<region>'. The brokers list
+            the servers of the same region as the nearest one to a client first
+        :param binary: If True the registrations are sent with the binary protocol of wire, that the
+            brokers must support, otherwise with the text protocol
+        :param clock: The function returning the current time in seconds, that the attempts are scheduled
+            with. Only replaced by simulations, that schedule the attempts on a virtual clock
+        :param rng: The random generator of the jitter
+        """
+        self._server = (name, address, port)
+        self._binary = binary
+        self._status = status
+        self._region = region
+        self._brokers = [Broker(broker) for broker in brokers]
+        self._interval = interval
+        self._logger = logger
+        self._clock = clock
+        self._rng = rng
+
+        # the registrations of this process form one trace, each attempt on a broker is a span of it
+        self._trace = tracing.new_trace()
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """
+        Starts registering, the first registration is sent immediately
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops registering, used for teardown of the class
+        """
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self):
+        """
+        Executed by the thread of the class, until stop is called
+        """
+        while not self._stop.is_set():
+            now = self._clock()
+            due = [broker for broker in self._brokers if broker.next_attempt <= now]
+
+            if len(due) > 0:
+                self._register(due)
+            else:
+                self._stop.wait(min(broker.next_attempt for broker in self._brokers) - now)
+
+    def _register(self, brokers):
+        """
+        Sends the registration to the given brokers at once, and waits for their answers
+        :param brokers: The list of Broker objects to register on
+        """
+        deadlines = {}
+
+        stats = [self._status()] if self._status is not None else []
+        if self._region is not None:
+            stats.append(f'region={self._region}')
+        stats = ';'.join(stats)
+
+        for broker in brokers:
+            try:
+                # the address is resolved at every attempt, since the broker could move
+                broker.resolved = (socket.gethostbyname(broker.address[0]), broker.address[1])
+                broker.context = tracing.new_context(self._trace)
+                broker.sent = self._clock()
+                self._sock.sendto(self._encode(stats, broker.context), broker.resolved)
+                tracing.event('register.send', broker.context, broker=f'{broker.address[0]}:{broker.address[1]}')
+            except OSError as e:
+                self._logger.log(level=logging.DEBUG, msg=f'Cannot reach Broker {broker.address}: {e}')
+                self._failed(broker)
+                continue
+
+            deadlines[broker] = self._clock() + answer_timeout(broker.failures)
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._sock, selectors.EVENT_READ)
+
+            while len(deadlines) > 0 and not self._stop.is_set():
+                remaining = min(deadlines.values()) - self._clock()
+
+                if remaining <= 0 or len(selector.select(remaining)) == 0:
+                    # the brokers whose deadline has passed have failed this attempt
+                    now = self._clock()
+                    for broker in [b for b, deadline in deadlines.items() if deadline <= now]:
+                        deadlines.pop(broker)
+                        self._failed(broker)
+                    continue
+
+                try:
+                    received, addr = self._sock.recvfrom(1024)
+                except OSError:
+                    continue
+
+                broker = next((b for b in deadlines if b.resolved == addr), None)
+                if broker is None:
+                    # late answer to a previous attempt
+                    continue
+
+                deadlines.pop(broker)
+                result = self._decode(received)
+                tracing.event('register.answer', broker.context, result=result,
+                              rtt_us=int((self._clock() - broker.sent) * 1e6))
+                self._answered(broker, result)
+
+    def _encode(self, stats, context):
+        """
+        :param stats: The stats sent with the registration, or an empty string
+        :param context: The context of the attempt
+        :return: The bytes of the registration
+        """
+        if self._binary:
+            return wire.encode_register(*self._server, stats, context)
+
+        message = '|'.join(str(field) for field in self._server)
+        if stats:
+            message += f'|{stats}'
+        return bytes(tracing.add_context(message, context), "utf-8")
+
+    @staticmethod
+    def _decode(received):
+        """
+        :param received: The bytes of the answer of a broker
+        :return: The result of the registration, as in the text protocol, or an error message
+        """
+        if not wire.is_binary(received):
+            return str(received, "utf-8", errors="replace")
+
+        try:
+            opcode, fields = wire.decode(received)
+        except wire.ProtocolError as e:
+            return f'invalid answer: {e}'
+        return fields[0] if opcode == wire.RESULT else f'error: {fields[0]}'
+
+    def _answered(self, broker, received):
+        """
+        Handles the answer of a broker, and schedules the next renewal
+        """
+        restarted = False
+
+        match received:
+            case "okay":
+                if broker.registered and not broker.confirming:
+                    restarted = True
+                    self._logger.log(level=logging.WARN, msg=f'Broker {broker.address} restarted, registering again')
+                else:
+                    self._logger.log(level=logging.INFO, msg=f'Registered on Broker {broker.address}')
+            case "taken":
+                self._logger.log(level=logging.WARN, msg=f'Name already taken on Broker {broker.address}')
+            case "renewed":
+                self._logger.log(level=logging.INFO, msg=f'Renewed on Broker {broker.address}')
+            case _:
+                self._logger.log(level=logging.WARN, msg=f'Unexpected answer from Broker {broker.address}: {received}')
+
+        broker.registered = received in ["okay", "renewed"]
+        broker.confirming = restarted
+        broker.failures = 0
+
+        if restarted:
+            broker.next_attempt = self._clock()
+        else:
+            broker.next_attempt = self._clock() + renewal_delay(self._interval, self._rng)
+
+    def _failed(self, broker):
+        """
+        Schedules the next attempt on a broker that did not answer, with exponential backoff and jitter
+        """
+        broker.failures += 1
+        broker.registered = False
+        self._logger.log(level=logging.DEBUG, msg=f'Try number {broker.failures} on Broker {broker.address} failed')
+
+        if broker.failures == 1:
+            self._logger.log(level=logging.WARN, msg=f'Could not connect to Broker {broker.address}')
+
+        broker.next_attempt = self._clock() + retry_delay(broker.failures, self._rng)
@@ -0,0 +1,130 @@
+"""
+This module contains the helper used by the game threads to ask the players for their answers
+"""
+import os
+import selectors
+import socket
+import time
+
+import metrics
+import profiling
+import tracing
+
+# Writing to this pipe wakes up all the rounds waiting for answers, so that the games can be handed off
+#   to another process. It is never read, so it stays readable once written
+_handoff_read, _handoff_write = os.pipe()
+
+
+class HandoffRequested(Exception):
+    """
+    Raised by ask_players when the game has to be handed off to another process.
+    It carries the answers already received, and game_loop adds the rest of the state of the game.
+    """
+
+    def __init__(self, answers):
+        super().__init__('Game handed off')
+        self.answers = answers
+        self.state = {}
+
+
+def request_handoff():
+    """
+    Interrupts all the rounds waiting for answers, in this process, and all those started after this call
+    """
+    os.write(_handoff_write, b'!')
+
+
+def ask_players(players, prompt, parse, answers=None, resume=False, session=None, think=None):
+    """
+    This function prompts all the players at once and collects their answers concurrently, so that a
+        round lasts as long as the slowest player instead of the sum of their times.
+    A player giving an invalid answer is prompted again, until all answers are valid or the deadline
+        of the turn expires.
+    :param players: A list of player connections
+    :param prompt: A function taking the index of a player and a bool (whether their last answer was
+        invalid), and returning the string to send them
+    :param parse: A function taking the index of a player and their answer, and returning the parsed
+        answer, or None if it is invalid
+    :param answers: An optional list with the answers already known, for example the ones of a bot.
+        Players whose answer is not None are not prompted
+    :param resume: True if the round was interrupted by a handoff, in which case the players still
+        have the prompt sent before the handoff, and are not prompted again
+    :param session: The Session enforcing the deadlines of the game, or None to wait indefinitely
+    :param think: An optional list with a number for each player, the seconds each player takes to give
+        a valid answer are added to it
+    :return: The list of the parsed answers, in the same order as the players
+    :raises socket.timeout: if a deadline of the session expires
+    :raises ConnectionError: if a player closes the connection
+    :raises HandoffRequested: if the game has to be handed off to another process
+    """
+    profiling.checkpoint()
+    answers = list(answers) if answers is not None else [None] * len(players)
+
+    # the time each player was prompted, unknown for the prompts sent before a handoff
+    prompted = [None] * len(players)
+    asked = time.monotonic()
+
+    if session is not None:
+        session.start_turn()
+
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(_handoff_read, selectors.EVENT_READ, None)
+
+            for i, player in enumerate(players):
+                if answers[i] is None:
+                    if not resume:
+                        player.sendall(prompt(i, False).encode())
+                        prompted[i] = time.monotonic()
+                    selector.register(player, selectors.EVENT_READ, i)
+
+            while len(selector.get_map()) > 1:
+                handoff = False
+                for key, _ in selector.select():
+                    if key.data is None:
+                        # the answers ready in the same batch are read first, so that none is lost
+                        handoff = True
+                        continue
+
+                    i = key.data
+                    data = players[i].recv(1024)
+
+                    if data == b'':
+                        raise ConnectionError(f'Player {i + 1} closed the connection')
+
+                    # the trace context of a player that was paired before it arrived, maybe followed by
+                    #   their answer
+                    data = tracing.receive_handshake(players[i], data)
+                    if len(data) == 0:
+                        continue
+
+                    if prompted[i] is not None:
+                        metrics.ANSWER_TIME.observe(time.monotonic() - prompted[i])
+                    metrics.ANSWERS.add()
+
+                    answer = parse(i, data.decode().strip())
+                    tracing.event('answer', tracing.context_of(players[i]), valid=answer is not None,
+                                  wait_us=int((time.monotonic() - prompted[i]) * 1e6) if prompted[i] else '-')
+                    if answer is None:
+                        metrics.INVALID_ANSWERS.add()
+                        players[i].sendall(prompt(i, True).encode())
+                        prompted[i] = time.monotonic()
+                    else:
+                        answers[i] = answer
+                        if think is not None:
+                            think[i] += time.monotonic() - asked
+                        selector.unregister(players[i])
+
+                # a round completed by this batch is returned, the handoff waits for the next one
+                if handoff and len(selector.get_map()) > 1:
+                    raise HandoffRequested(answers)
+    except OSError as e:
+        # the connections are shut down when a deadline expires
+        if session is not None and session.expired is not None:
+            raise socket.timeout(session.expired) from e
+        raise
+    finally:
+        if session is not None:
+            session.end_turn()
+
+    return answers
@@ -0,0 +1,87 @@
+"""
+This module contains the bot opponent for the Rock-Paper-Scissors server
+"""
+import random
+
+MOVES = ['rock', 'paper', 'scissors']
+INDEX = {move: i for i, move in enumerate(MOVES)}
+
+# the move beating each move, by index
+COUNTER = [1, 2, 0]
+
+# counts are halved when one reaches this value, so they fit in a byte and old habits fade out
+MAX_COUNT = 255
+
+
+class BotPlayer:
+    """
+    This class replaces the second player connection when a lone player is paired with the bot.
+    The bot predicts the next move of its opponent with a Markov model of their history: it counts
+        which move followed each of the 9 pairs of previous moves (order 2), and each single previous
+        move (order 1). The most frequent follow-up in the longest known context is assumed to be the
+        next move, and the bot plays the move beating it.
+    The whole model is a 36 bytes array and the last two moves, so each update is O(1) and the memory
+        of a session is bounded no matter how long the match is.
+    The shutdown and close methods mirror the ones of a socket, so that the game thread can treat the
+        bot like any other player when the game ends.
+    """
+
+    __slots__ = ('_counts', '_prev', '_last')
+
+    def __init__(self):
+        # 27 order 2 counts followed by 9 order 1 counts
+        self._counts = bytearray(36)
+        self._prev = None
+        self._last = None
+
+    def choose_move(self):
+        """
+        :return: A string representing the move of the bot for the current round
+        """
+        for base in self._contexts():
+            counts = self._counts[base:base + 3]
+            best = max(counts)
+            if best > 0:
+                predicted = random.choice([i for i in range(3) if counts[i] == best])
+                return MOVES[COUNTER[predicted]]
+
+        return random.choice(MOVES)
+
+    def observe(self, move):
+        """
+        Updates the model with the move the opponent played in the last round
+        :param move: A string representing the (valid) move of the opponent
+        """
+        move = INDEX[move]
+
+        for base in self._contexts():
+            self._counts[base + move] += 1
+            if self._counts[base + move] == MAX_COUNT:
+                for i in range(base, base + 3):
+                    self._counts[i] //= 2
+
+        self._prev = self._last
+        self._last = move
+
+    def _contexts(self):
+        """
+        :return: The offsets in self._counts of the contexts known for the next move, longest first
+        """
+        if self._last is None:
+            return ()
+        if self._prev is None:
+            return (27 + self._last * 3,)
+        return ((self._prev * 3 + self._last) * 3, 27 + self._last * 3)
+
+    def play_again(self):
+        """
+        The bot is always up for another game
+        :return: A string representing its decision
+        """
+        return 'yes'
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
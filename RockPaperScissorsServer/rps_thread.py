@@ -3,148 +3,186 @@ This module contains the game logic for the Rock-Paper-Scissors server
 """
 import logging
 import socket
+import time
 
+import game_records
+import metrics
+import ratings
+from rounds import ask_players
+from rps_bot import BotPlayer
+from timeouts import shutdown_quietly
 
-def game_thread(players, logger):
+
+def game_thread(players, logger, match=None, session=None, names=None):
     """
     This function is called when the new thread is launched. It will run a new game unless
         the players communicate otherwise
-    :param players: a list containing two player connections
+    :param players: a list containing two player connections, the second one can be a BotPlayer
     :param logger: The logger object to use in these functions
+    :param match: The Match object to publish the updates for spectators on, or None
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param names: A list with the names of the players, None or '' for the bot and the anonymous players
     """
     try:
-        while game_loop(players, logger):
+        while game_loop(players, logger, match, session, names):
             pass
     except OSError:
         pass
     finally:
-        players[0].shutdown(socket.SHUT_RDWR)
-        players[0].close()
-        players[1].shutdown(socket.SHUT_RDWR)
-        players[1].close()
+        if match is not None:
+            match.close()
+        if session is not None:
+            session.close()
+
+        for player in players:
+            shutdown_quietly(player)
+            player.close()
 
     logger.log(level=logging.INFO, msg='Thread terminated')
 
 
-def game_loop(players, logger):
+def game_loop(players, logger, match=None, session=None, names=None):
     """
     This function executes a single game of Rock-Paper-Scissors, the first player to three points wins.
-    Each turn player_1 is shown the current score and asked for their move. The same then happens for
-        player_2. Then, the moves are compared and the score is adjusted.
+    Each turn both players are shown the current score and asked for their move at the same time.
+        Then, the moves are compared and the score is adjusted.
     When one player wins, both players are asked if they want to play again. If both want to then True
         is returned
     :param players: a list containing two player connections
     :param logger: The logger object to use in these functions
-    :return: A bool representing whether the players want to play again
+    :param match: The Match object to publish the updates for spectators on, or None
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param names: A list with the names of the players, the game is rated only if both have one
+    :return: A bool representing whether the players want to play again. If False, the connections
+        must be closed by the caller
     """
     objective = 3
 
-    p1 = players[0]
     p2 = players[1]
 
     p1_wins = 0
     p2_wins = 0
 
-    while p1_wins < 3 and p2_wins < 3:
+    # the record of the game
+    moves = []
+    started = time.time()
+    think = [0.0, 0.0]
+    against_bot = isinstance(p2, BotPlayer)
 
-        # Ask player_1 for their move
-        try:
-            p1_move = ask_for_move(p1, [p1_wins, p2_wins])
-        except (socket.timeout, socket.error):
-            logger.log(level=logging.WARN, msg='Game terminated, player 1 not responding')
-            p1.shutdown(socket.SHUT_RDWR)
-            p1.close()
-            p2.shutdown(socket.SHUT_RDWR)
-            p2.close()
-            return False
+    while p1_wins < objective and p2_wins < objective:
 
-        # Ask player_2 for their move
+        # Ask both players for their move
         try:
-            p2_move = ask_for_move(p2, [p2_wins, p1_wins])
-        except (socket.timeout, socket.error):
-            logger.log(level=logging.WARN, msg='Game terminated, player 2 not responding')
-            p1.shutdown(socket.SHUT_RDWR)
-            p1.close()
-            p2.shutdown(socket.SHUT_RDWR)
-            p2.close()
+            p1_move, p2_move = ask_for_moves(players, [p1_wins, p2_wins], session, think)
+        except (socket.timeout, socket.error) as e:
+            logger.log(level=logging.WARN, msg=f'Game terminated, {e}')
+            metrics.game_terminated(e)
+            game_records.record(game_records.ROCK_PAPER_SCISSORS,
+                                game_records.TIMED_OUT if isinstance(e, socket.timeout) else game_records.ABORTED,
+                                started, moves, think, against_bot=against_bot)
             return False
 
+        moves.append(3 * game_records.RPS_MOVES.index(p1_move) + game_records.RPS_MOVES.index(p2_move))
+
+        # The bot learns from the moves of its opponent
+        if isinstance(p2, BotPlayer):
+            p2.observe(p1_move)
+
         # Compare moves and assign point
-        if p1_move == p2_move:
-            continue
-        elif (p1_move, p2_move) in [('rock', 'scissors'), ('scissors', 'paper'), ('paper', 'rock')]:
+        winner = round_winner(p1_move, p2_move)
+        if winner == 1:
             p1_wins += 1
-            continue
-        else:
+        elif winner == 2:
             p2_wins += 1
-            continue
 
-    if p1_wins == 3:
-        winner = p1
-        loser = p2
-    else:
-        winner = p2
-        loser = p1
+        if match is not None:
+            match.publish(f'Player 1 played {p1_move}, player 2 played {p2_move}\n'
+                          f'Score: {p1_wins} - {p2_wins}\n')
+
+    metrics.GAMES_COMPLETED.add()
+    game_records.record(game_records.ROCK_PAPER_SCISSORS,
+                        game_records.PLAYER_1 if p1_wins == objective else game_records.PLAYER_2,
+                        started, moves, think, against_bot=against_bot)
+
+    notes = ratings.rate_game(names, 1 if p1_wins == objective else 0)
+
+    if match is not None:
+        match.publish(f'Player {1 if p1_wins == objective else 2} won the game!\n')
 
     # Ask both players if they want to play again
     try:
-        winner_dec = play_again(winner, True)
-        loser_dec = play_again(loser, False)
-    except (socket.timeout, socket.error):
-        logger.log(level=logging.WARN, msg='Game terminated, players not responding')
-        p1.shutdown(socket.SHUT_RDWR)
-        p1.close()
-        p2.shutdown(socket.SHUT_RDWR)
-        p2.close()
+        p1_dec, p2_dec = play_again(players, [p1_wins == objective, p2_wins == objective], session, notes)
+    except (socket.timeout, socket.error) as e:
+        logger.log(level=logging.WARN, msg=f'Game terminated, {e}')
+        metrics.game_terminated(e)
         return False
 
-    return (winner_dec == loser_dec) and (winner_dec == 'yes')
+    return (p1_dec == p2_dec) and (p1_dec == 'yes')
 
 
-def play_again(player, winner):
+def round_winner(p1_move, p2_move):
     """
-    This function asks a player whether they want to play another game.
-    :param player: A socket connection
-    :param winner: A bool representing if the player has won or not
-    :return: A string representing their decision
+    This function applies the rules of the game to the moves of a round
+    :param p1_move: The move of the first player, 'rock', 'paper' or 'scissors'
+    :param p2_move: The move of the second player
+    :return: 0 if the round is drawn, 1 if the first player wins it, 2 if the second player wins it
+    """
+    if p1_move == p2_move:
+        return 0
+    if (p1_move, p2_move) in [('rock', 'scissors'), ('scissors', 'paper'), ('paper', 'rock')]:
+        return 1
+    return 2
+
+
+def play_again(players, winners, session=None, notes=None):
+    """
+    This function asks both players at the same time whether they want to play another game.
+    :param players: A list containing two player connections
+    :param winners: A list of two bools representing if each player has won or not
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param notes: An optional list of two strings shown to each player before the question, like their
+        new rating
+    :return: A list of two strings representing their decisions
     """
-    while True:
-        if winner:
-            message = 'You won! Do you want to play again? [yes, no] '
-        else:
-            message = 'You lost! Do you want to play again? [yes, no] '
-        player.sendall(message.encode())
 
-        response = player.recv(1024).decode().strip()
+    def prompt(i, error):
+        message = notes[i] if notes is not None and not error else ''
+        if winners[i]:
+            return message + 'You won! Do you want to play again? [yes, no] '
+        else:
+            return message + 'You lost! Do you want to play again? [yes, no] '
 
+    def parse(i, response):
         if response in ['yes', 'no']:
             return response
 
+    return ask_players(players, prompt, parse, session=session,
+                       answers=[p.play_again() if isinstance(p, BotPlayer) else None for p in players])
+
 
-def ask_for_move(player, wins):
+def ask_for_moves(players, wins, session=None, think=None):
     """
-    This function shows the current score to a player and asks for their move for
-        the current turn
-    :param player: A socket connection
-    :param wins: A list of two items containing the wins of the player in the first
-        element, and the wins of their opponent in the second element
-    :return: A string representing their (valid) move
+    This function shows the current score to both players and asks for their move for
+        the current turn, at the same time
+    :param players: A list containing two player connections
+    :param wins: A list of two items containing the wins of the first and of the second player
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param think: An optional list of two numbers, the seconds each player takes to answer are added to it
+    :return: A list of two strings representing their (valid) moves
     """
 
-    error = False
-
-    while True:
+    def prompt(i, error):
         if error:
             error_string = 'Invalid move!\n'
         else:
             error_string = ''
 
-        player.sendall(f'{error_string}Your score: {wins[0]}\nOpponent\'s score: {wins[1]}\n'
-                       f'Input your next move [rock, paper, scissors]: '.encode())
-
-        move = player.recv(1024).decode().strip()
+        return f'{error_string}Your score: {wins[i]}\nOpponent\'s score: {wins[1 - i]}\n' \
+               f'Input your next move [rock, paper, scissors]: '
 
+    def parse(i, move):
         if move in ['rock', 'paper', 'scissors']:
             return move
 
-        error = True
+    return ask_players(players, prompt, parse, session=session, think=think,
+                       answers=[p.choose_move() if isinstance(p, BotPlayer) else None for p in players])
@@ -0,0 +1,296 @@
+"""
+This module contains the hub that lets spectators watch the running matches
+"""
+import logging
+import selectors
+import socket
+import threading
+
+# Bytes that can be waiting to be sent to a single spectator, slower spectators are dropped
+MAX_BUFFER = 64 * 1024
+
+
+class Match:
+    """
+    This class represents a match that can be watched. The game thread publishes the updates, that are
+        encoded once and queued for all the spectators of the match.
+    """
+
+    def __init__(self, hub, match_id, title):
+        self.id = match_id
+        self.title = title
+        self.last = b''
+        self.spectators = set()
+        self._hub = hub
+
+    def publish(self, text):
+        """
+        Queues an update for all the spectators. It never blocks on their connections
+        :param text: The update to send
+        """
+        self._hub.publish(self, text.encode())
+
+    def close(self):
+        """
+        Notifies the spectators that the match has ended, and removes the match from the hub
+        """
+        self._hub.close_match(self)
+
+
+class Spectator:
+    """
+    This class holds the connection of a spectator and the bytes waiting to be sent to them
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = bytearray()
+        self.match = None
+        self.closing = False
+
+
+class SpectatorHub:
+    """
+    This class accepts the spectators on its own port and sends them the updates of the match they chose.
+    All the spectator connections are non-blocking and handled by a single thread with a selector: game
+        threads only append their updates to the buffers of the spectators and wake the thread up, so a
+        slow spectator can never delay the players. A spectator whose buffer exceeds MAX_BUFFER is dropped.
+    """
+
+    def __init__(self, port, logger):
+        """
+        :param port: The port the spectators connect to
+        :param logger: the logger object to use in this class
+        """
+        self._port = port
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._matches = {}  # Map<Int, Match>
+        self._next_id = 1
+        self._dirty = set()
+
+        self._selector = None
+        self._listener = None
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_write.setblocking(False)
+        self._thread = None
+
+    def start(self):
+        """
+        Starts listening for spectators. Matches can be opened even before this is called
+        """
+        self._listener = socket.create_server(('0.0.0.0', self._port))
+        self._listener.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops listening and drops all the spectators, used for teardown of the class
+        """
+        if self._thread is None:
+            return
+
+        self._thread = None
+        self._wake()
+
+    def open_match(self, title):
+        """
+        :param title: A short description of the match, shown to the spectators choosing what to watch
+        :return: The Match object the game thread publishes its updates on
+        """
+        with self._lock:
+            match = Match(self, self._next_id, title)
+            self._matches[match.id] = match
+            self._next_id += 1
+        return match
+
+    def publish(self, match, data):
+        """
+        Appends an update to the buffers of all the spectators of a match
+        :param match: The Match object
+        :param data: The encoded update
+        """
+        with self._lock:
+            match.last = data
+            for spectator in match.spectators:
+                self._queue(spectator, data)
+
+        self._wake()
+
+    def close_match(self, match):
+        """
+        Removes a match, its spectators are disconnected once they have received its last updates
+        :param match: The Match object
+        """
+        with self._lock:
+            self._matches.pop(match.id, None)
+            for spectator in match.spectators:
+                self._queue(spectator, b'The match has ended\n')
+                spectator.closing = True
+
+        self._wake()
+
+    def _queue(self, spectator, data):
+        """
+        Appends data to the buffer of a spectator, or marks them to be dropped if it is full.
+        Must be called holding self._lock
+        """
+        if len(spectator.buffer) + len(data) > MAX_BUFFER:
+            spectator.buffer.clear()
+            spectator.closing = True
+        else:
+            spectator.buffer += data
+        self._dirty.add(spectator)
+
+    def _wake(self):
+        try:
+            self._wake_write.send(b'!')
+        except BlockingIOError:
+            # the thread has not consumed the previous wake ups yet, it will flush anyway
+            pass
+
+    def _run(self):
+        """
+        Executed by the thread of the hub, until stop is called
+        """
+        while self._thread is not None:
+            for key, events in self._selector.select():
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj is self._wake_read:
+                    self._wake_read.recv(4096)
+                    with self._lock:
+                        dirty = list(self._dirty)
+                        self._dirty.clear()
+                    for spectator in dirty:
+                        self._flush(spectator)
+                else:
+                    # the spectator could have been dropped earlier in the same batch
+                    spectator = key.data
+                    if events & selectors.EVENT_READ and spectator.conn.fileno() != -1:
+                        self._read(spectator)
+                    if events & selectors.EVENT_WRITE and spectator.conn.fileno() != -1:
+                        self._flush(spectator)
+
+        for key in list(self._selector.get_map().values()):
+            if isinstance(key.data, Spectator):
+                self._drop(key.data)
+        self._selector.close()
+        self._listener.close()
+
+    def _accept(self):
+        try:
+            conn, addr = self._listener.accept()
+        except BlockingIOError:
+            return
+
+        conn.setblocking(False)
+        spectator = Spectator(conn)
+        self._selector.register(conn, selectors.EVENT_READ, spectator)
+        self._logger.log(level=logging.INFO, msg='Accepted connection from Spectator')
+
+        self._send_list(spectator)
+
+    def _send_list(self, spectator):
+        """
+        Sends a spectator the list of the running matches, and asks them which one to watch
+        """
+        with self._lock:
+            if len(self._matches) == 0:
+                message = 'No matches are running at the moment, type anything to refresh: '
+            else:
+                message = 'Running matches:\n' + \
+                          ''.join(f' [{m.id}]:\t{m.title}\n' for m in self._matches.values()) + \
+                          'Choose the match you want to watch: '
+            self._queue(spectator, message.encode())
+            self._dirty.discard(spectator)
+
+        self._flush(spectator)
+
+    def _read(self, spectator):
+        """
+        Handles the data sent by a spectator: their choice of the match to watch, or the closing of the
+            connection
+        """
+        try:
+            data = spectator.conn.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if data == b'':
+            self._drop(spectator)
+            return
+
+        # spectators can only choose a match, anything sent later is ignored
+        if spectator.match is not None:
+            return
+
+        try:
+            match_id = int(data.decode().strip())
+        except (UnicodeDecodeError, ValueError):
+            match_id = None
+
+        with self._lock:
+            match = self._matches.get(match_id)
+            if match is not None:
+                spectator.match = match
+                match.spectators.add(spectator)
+                self._queue(spectator, f'Watching {match.title}\n'.encode() + match.last)
+                self._dirty.discard(spectator)
+
+        if match is None:
+            self._send_list(spectator)
+        else:
+            self._flush(spectator)
+
+    def _flush(self, spectator):
+        """
+        Sends as much of the buffer of a spectator as the connection accepts without blocking, and waits
+            for the connection to be writable again if something is left
+        """
+        if spectator.conn.fileno() == -1:
+            return
+
+        with self._lock:
+            try:
+                sent = spectator.conn.send(spectator.buffer)
+                del spectator.buffer[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                spectator.buffer.clear()
+                spectator.closing = True
+
+            pending = len(spectator.buffer) > 0
+            closing = spectator.closing
+
+        if closing and not pending:
+            self._drop(spectator)
+        elif pending:
+            self._selector.modify(spectator.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, spectator)
+        else:
+            self._selector.modify(spectator.conn, selectors.EVENT_READ, spectator)
+
+    def _drop(self, spectator):
+        """
+        Closes the connection of a spectator, nothing is done if it is already closed
+        """
+        if spectator.conn.fileno() == -1:
+            return
+
+        with self._lock:
+            if spectator.match is not None:
+                spectator.match.spectators.discard(spectator)
+            self._dirty.discard(spectator)
+
+        self._selector.unregister(spectator.conn)
+        spectator.conn.close()
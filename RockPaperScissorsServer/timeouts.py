@@ -0,0 +1,217 @@
+"""
+This module contains the timer wheel that enforces all the deadlines of a game server, and the Session
+    class holding the deadlines of a single game
+"""
+import logging
+import socket
+import threading
+import time
+
+# Seconds a player has to give a valid answer, invalid answers do not extend it
+TURN_SECONDS = 90
+
+# Seconds a game thread can run, including the rematches
+GAME_SECONDS = 30 * 60
+
+# Seconds a player can wait in the queue for an opponent
+IDLE_SECONDS = 10 * 60
+
+# Resolution of the timer wheel in seconds, and its shape
+TICK = 0.1
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer:
+    """
+    This class represents a scheduled callback, it is returned by TimerWheel.schedule to cancel it
+    """
+
+    __slots__ = ('expires', 'callback', 'bucket')
+
+    def __init__(self, expires, callback):
+        self.expires = expires
+        self.callback = callback
+        self.bucket = None
+
+
+class TimerWheel:
+    """
+    This class implements a hierarchical timer wheel. Each of the LEVELS wheels has SLOTS buckets, and a
+        bucket of level k covers TICK * SLOTS ** k seconds, so that with the default shape timers up to
+        about 19 days can be scheduled.
+    A timer is placed in the bucket of the lowest level that reaches its expiry. Every TICK seconds the
+        next bucket of level 0 expires, and whenever a wheel completes a turn the next bucket of the level
+        above is emptied and its timers are moved to the lower levels.
+    Scheduling and cancelling a timer are O(1), and so is the amortized cost of expiring it.
+    Callbacks run in the thread of the wheel, so they must not block.
+    """
+
+    def __init__(self, logger):
+        """
+        :param logger: the logger object to use in this class
+        """
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._start = time.monotonic()
+        self._tick = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the wheel, the timers still scheduled never expire. Used for teardown of the class
+        """
+        self._stop.set()
+
+    def schedule(self, delay, callback):
+        """
+        :param delay: Seconds after which the callback is called
+        :param callback: A function without arguments
+        :return: The Timer object, to cancel it
+        """
+        with self._lock:
+            timer = Timer(self._tick + max(1, round(delay / TICK)), callback)
+            self._place(timer)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels a timer, if it has not expired yet
+        :param timer: The Timer object returned by schedule
+        """
+        with self._lock:
+            if timer.bucket is not None:
+                timer.bucket.discard(timer)
+                timer.bucket = None
+
+    def _place(self, timer):
+        """
+        Puts a timer in its bucket. Must be called holding self._lock
+        """
+        remaining = timer.expires - self._tick
+        level = 0
+        while level < LEVELS - 1 and remaining >= SLOTS ** (level + 1):
+            level += 1
+
+        # timers beyond the last level wait there for one more turn
+        slot = (timer.expires // SLOTS ** level) % SLOTS
+        timer.bucket = self._wheels[level][slot]
+        timer.bucket.add(timer)
+
+    def _advance(self):
+        """
+        Moves the wheel forward by one tick
+        :return: The list of the timers that expired. Must be called holding self._lock
+        """
+        self._tick += 1
+
+        # cascade the buckets of the higher levels whose turn has come
+        level = 1
+        while level < LEVELS and self._tick % SLOTS ** level == 0:
+            bucket = self._wheels[level][(self._tick // SLOTS ** level) % SLOTS]
+            timers = list(bucket)
+            bucket.clear()
+            for timer in timers:
+                self._place(timer)
+            level += 1
+
+        bucket = self._wheels[0][self._tick % SLOTS]
+        expired = [timer for timer in bucket if timer.expires <= self._tick]
+        for timer in expired:
+            bucket.discard(timer)
+            timer.bucket = None
+        return expired
+
+    def _run(self):
+        """
+        Executed by the thread of the wheel, until stop is called
+        """
+        while not self._stop.wait(max(0, self._start + (self._tick + 1) * TICK - time.monotonic())):
+            with self._lock:
+                expired = self._advance()
+
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    self._logger.log(level=logging.ERROR, msg=f'Timer callback failed: {e}')
+
+
+def shutdown_quietly(conn):
+    """
+    Shuts down a connection, ignoring the errors if it is already closed. Any thread blocked on it
+        wakes up
+    :param conn: A socket connection, or a BotPlayer
+    """
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def peer_closed(conn):
+    """
+    Checks whether the other end has closed a connection, without blocking and without consuming any
+        data that was sent on it
+    :param conn: A socket connection
+    :return: True if the connection has been closed or reset by the other end
+    """
+    try:
+        return conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+
+class Session:
+    """
+    This class holds the deadlines of a game: one for the whole game, and one for the current turn.
+    When a deadline expires the connections of the players are shut down, which wakes up the game thread
+        blocked on them, and the reason is stored in self.expired.
+    """
+
+    def __init__(self, wheel, players):
+        """
+        :param wheel: The TimerWheel enforcing the deadlines
+        :param players: A list of player connections
+        """
+        self.expired = None
+        self._wheel = wheel
+        self._players = players
+        self._turn = None
+        self._game = wheel.schedule(GAME_SECONDS, lambda: self.expire('the game lasted too long'))
+
+    def start_turn(self):
+        """
+        Starts the deadline for the players to answer
+        """
+        self.end_turn()
+        self._turn = self._wheel.schedule(TURN_SECONDS, lambda: self.expire('a player did not answer in time'))
+
+    def end_turn(self):
+        if self._turn is not None:
+            self._wheel.cancel(self._turn)
+            self._turn = None
+
+    def expire(self, reason):
+        """
+        Ends the session, shutting down the connections of the players
+        :param reason: A string describing which deadline expired
+        """
+        self.expired = reason
+        for player in self._players:
+            shutdown_quietly(player)
+
+    def close(self):
+        """
+        Cancels all the deadlines, used when the game ends
+        """
+        self.end_turn()
+        self._wheel.cancel(self._game)
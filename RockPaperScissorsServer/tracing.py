@@ -0,0 +1,149 @@
+"""
+This module contains the identifiers used to follow a player's session across the client, the brokers
+    and the game servers, and the monotonic timestamps added to the log lines
+A trace identifies a session (or the registrations of a server process), and a span one request of it.
+    They travel as a context string '<trace>-<span>': appended as '|trace=<context>' to the messages sent
+    to the brokers, and in a 'TRACE <context>' line sent by the client right after connecting to a
+    game server. Every traced event is logged as 'trace=<context> event=<name> <key>=<value> ...', with
+    the time of CLOCK_MONOTONIC in microseconds, which is shared by all the processes of a machine, so
+    Tools/trace_timeline.py can merge the logs of all the entities into one timeline per session
+"""
+import logging
+import re
+import secrets
+import threading
+import time
+import weakref
+
+# Format of the log lines of all the entities
+LOG_FORMAT = '%(asctime)s:%(mono)d:%(process)d:%(name)s:%(levelname)s:%(message)s'
+
+CONTEXT_PATTERN = re.compile(r'[0-9a-f]{16}-[0-9a-f]{8}')
+
+# Suffix of the traced messages sent to the brokers, and prefix of the handshake line of the clients
+MESSAGE_SUFFIX = '|trace='
+HANDSHAKE = b'TRACE '
+
+
+def _record_factory(factory):
+    def record(*args, **kwargs):
+        log_record = factory(*args, **kwargs)
+        log_record.mono = time.monotonic_ns() // 1000
+        return log_record
+    return record
+
+
+# The monotonic time is added to all the log records of the process
+logging.setLogRecordFactory(_record_factory(logging.getLogRecordFactory()))
+
+# The logger of the traced events, None until setup is called
+_logger = None
+
+# The context of each connection of a traced player, dropped with the connection
+_contexts = weakref.WeakKeyDictionary()
+_contexts_lock = threading.Lock()
+
+
+def setup(logger):
+    """
+    :param logger: The logger the traced events are written to
+    """
+    global _logger
+    _logger = logger
+
+
+def new_trace():
+    """
+    :return: A new trace identifier
+    """
+    return secrets.token_hex(8)
+
+
+def new_context(trace):
+    """
+    :param trace: A trace identifier
+    :return: The context of a new span of the trace
+    """
+    return f'{trace}-{secrets.token_hex(4)}'
+
+
+def event(name, context, **fields):
+    """
+    Logs a traced event, nothing is logged if the context is None
+    :param name: The name of the event
+    :param context: The context of the span the event belongs to
+    :param fields: Values logged with the event, durations are in microseconds by convention
+    """
+    if _logger is None or context is None:
+        return
+
+    values = ''.join(f' {key}={value}' for key, value in fields.items())
+    _logger.log(level=logging.INFO, msg=f'trace={context} event={name}{values}')
+
+
+def add_context(msg, context):
+    """
+    :param msg: A message for the brokers
+    :param context: The context of the request
+    :return: The message carrying the context
+    """
+    return f'{msg}{MESSAGE_SUFFIX}{context}'
+
+
+def split_context(msg):
+    """
+    :param msg: A message received by a broker
+    :return: The message without the context, and the context or None if the message is not traced
+    """
+    body, separator, context = msg.rpartition(MESSAGE_SUFFIX)
+    if separator and CONTEXT_PATTERN.fullmatch(context):
+        return body, context
+    return msg, None
+
+
+def handshake(context):
+    """
+    :param context: The context of a session
+    :return: The line a client sends to a game server right after connecting
+    """
+    return HANDSHAKE + context.encode() + b'\n'
+
+
+def receive_handshake(conn, data):
+    """
+    Checks whether the data received from a player starts with the handshake line, and binds its context
+        to the connection in that case
+    :param conn: The connection of the player
+    :param data: The bytes received
+    :return: The bytes following the handshake line, received in the same segment when the player
+        answered right after connecting, or the data unchanged if it does not start with the handshake.
+        Empty if there is nothing else to handle
+    """
+    if not data.startswith(HANDSHAKE):
+        return data
+
+    line, _, rest = data.partition(b'\n')
+    context = line[len(HANDSHAKE):].decode(errors='replace').strip()
+    if CONTEXT_PATTERN.fullmatch(context):
+        bind(conn, context)
+        event('session.join', context)
+    return rest
+
+
+def bind(conn, context):
+    """
+    :param conn: The connection of a player
+    :param context: The context of their session, or None
+    """
+    if context is not None:
+        with _contexts_lock:
+            _contexts[conn] = context
+
+
+def context_of(conn):
+    """
+    :param conn: The connection of a player, or a BotPlayer
+    :return: The context of the session of the player, or None if they are not traced
+    """
+    with _contexts_lock:
+        return _contexts.get(conn)
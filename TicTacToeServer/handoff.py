@@ -0,0 +1,78 @@
+"""
+This module contains the functions used to hand off the listening socket, the queued players and the
+    running games to a new server process, so that the server can be upgraded without dropping them
+The sockets are passed with SCM_RIGHTS over a Unix socket of type SOCK_SEQPACKET, one message for each
+    socket or game, and each message carries a compact JSON description of what it contains
+"""
+import json
+import socket
+
+import tracing
+from ttt_bot import BotPlayer
+
+# Maximum size of the JSON description of a single message
+MAX_MESSAGE = 4096
+
+
+def _encode(description):
+    return json.dumps(description, separators=(',', ':')).encode()
+
+
+def send_handoff(channel, listener, queued, games):
+    """
+    Sends everything the new process needs to take over from this one. The sockets are not closed,
+        that is left to the caller after this function returns
+    :param channel: A Unix socket connected to the new process
+    :param listener: The listening socket of the server
+    :param queued: The list of the players waiting for an opponent, as pairs of their connection and their
+        name, None if they have not answered yet
+    :param games: A list of pairs containing the players of a game, and the state of the game
+    """
+    socket.send_fds(channel, [_encode({'kind': 'listener'})], [listener.fileno()])
+
+    for conn, name in queued:
+        socket.send_fds(channel, [_encode({'kind': 'queued', 'name': name, 'trace': tracing.context_of(conn)})],
+                        [conn.fileno()])
+
+    for players, state in games:
+        conns = [p for p in players if not isinstance(p, BotPlayer)]
+        socket.send_fds(channel, [_encode({'kind': 'game', 'state': state,
+                                           'traces': [tracing.context_of(conn) for conn in conns]})],
+                        [conn.fileno() for conn in conns])
+
+    channel.sendall(_encode({'kind': 'done'}))
+
+
+def receive_handoff(channel):
+    """
+    Receives everything sent by send_handoff
+    :param channel: A Unix socket connected to the old process
+    :return: The listening socket, the list of queued players as pairs of their connection and their name,
+        and a list of pairs containing the connections of the players of a game and the state of the game.
+        A game with a single connection is played against the bot
+    """
+    listener = None
+    queued = []
+    games = []
+
+    while True:
+        msg, fds, _, _ = socket.recv_fds(channel, MAX_MESSAGE, 2)
+        if msg == b'':
+            raise ConnectionError('The old process terminated before completing the handoff')
+
+        description = json.loads(msg)
+        conns = [socket.socket(fileno=fd) for fd in fds]
+
+        # the trace contexts of the players follow their connections
+        for conn, context in zip(conns, description.get('traces', [description.get('trace')])):
+            tracing.bind(conn, context)
+
+        match description['kind']:
+            case 'listener':
+                listener = conns[0]
+            case 'queued':
+                queued.append((conns[0], description.get('name')))
+            case 'game':
+                games.append((conns, description['state']))
+            case 'done':
+                return listener, queued, games
@@ -0,0 +1,252 @@
+"""
+This module contains the counters and histograms describing the activity of a game server, and the
+    stats port that reports them
+The values live in shared memory, created when the module is imported, so that in pre-fork mode the
+    workers update the same values that the parent process reports
+"""
+import bisect
+import collections
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of the histograms, the last bucket has no upper bound
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+# Seconds covered by the rates, they are sampled once per second
+RATE_WINDOW = 60
+
+# Seconds a client of the stats port has to send its command
+COMMAND_TIMEOUT = 5
+
+
+class Counter:
+    """
+    This class represents a value that can only grow, like the number of completed games
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._value = multiprocessing.Value('q', 0)
+
+    def add(self, amount=1):
+        with self._value.get_lock():
+            self._value.value += amount
+
+    @property
+    def value(self):
+        return self._value.value
+
+
+class Gauge(Counter):
+    """
+    This class represents a value that can go up and down, like the number of running games
+    """
+
+    def set(self, value):
+        self._value.value = value
+
+
+class Histogram:
+    """
+    This class counts the observed values in buckets, by default the ones defined by BUCKETS, and keeps
+        their sum.
+    Quantiles are estimated with the upper bound of the bucket they fall in
+    """
+
+    def __init__(self, name, buckets=BUCKETS):
+        """
+        :param name: The name of the histogram in the reports
+        :param buckets: The sorted upper bounds of the buckets, the last bucket has no upper bound
+        """
+        self.name = name
+        self._buckets = buckets
+        self._counts = multiprocessing.Array('q', len(buckets) + 1)
+        self._sum = multiprocessing.Value('d', 0, lock=False)
+
+    def observe(self, value):
+        """
+        :param value: The observed value, in seconds for the default buckets
+        """
+        i = bisect.bisect_left(self._buckets, value)
+        with self._counts.get_lock():
+            self._counts[i] += 1
+            self._sum.value += value
+
+    def snapshot(self):
+        """
+        :return: A dictionary with the count, the sum, and the estimated median, 90th and 99th percentile
+        """
+        with self._counts.get_lock():
+            counts = list(self._counts)
+            total = self._sum.value
+
+        count = sum(counts)
+        result = {'count': count, 'sum': round(total, 3)}
+
+        for q in [0.5, 0.9, 0.99]:
+            rank = q * count
+            seen = 0
+            for i, n in enumerate(counts):
+                seen += n
+                if count > 0 and seen >= rank:
+                    result[f'p{int(q * 100)}'] = self._buckets[i] if i < len(self._buckets) else float('inf')
+                    break
+            else:
+                result[f'p{int(q * 100)}'] = 0
+
+        return result
+
+
+# Games and players
+ACTIVE_GAMES = Gauge('active_games')
+QUEUED_PLAYERS = Gauge('queued_players')
+GAMES_COMPLETED = Counter('games_completed')
+GAMES_TIMED_OUT = Counter('games_timed_out')
+GAMES_ABORTED = Counter('games_aborted')
+
+# Answers of the players, the invalid ones are prompted again
+ANSWERS = Counter('answers')
+INVALID_ANSWERS = Counter('invalid_answers')
+
+# Seconds a player waits in the queue, and seconds between a prompt and the answer of the player
+MATCHMAKING_WAIT = Histogram('matchmaking_wait')
+ANSWER_TIME = Histogram('answer_time')
+
+# Rating difference between the players paired by skill, see matchmaking
+MATCH_RATING_GAP = Histogram('match_rating_gap', [10, 25, 50, 100, 150, 200, 300, 400, 600, 800, 1200])
+
+COUNTERS = [ACTIVE_GAMES, QUEUED_PLAYERS, GAMES_COMPLETED, GAMES_TIMED_OUT, GAMES_ABORTED, ANSWERS,
+            INVALID_ANSWERS]
+HISTOGRAMS = [MATCHMAKING_WAIT, ANSWER_TIME, MATCH_RATING_GAP]
+
+# Pairs of time and number of completed games, used to compute the rate of completed games
+_samples = collections.deque(maxlen=RATE_WINDOW + 1)
+
+
+def game_terminated(error):
+    """
+    Counts a game ended by an error instead of by the players
+    :param error: The exception that ended the game
+    """
+    if isinstance(error, socket.timeout):
+        GAMES_TIMED_OUT.add()
+    else:
+        GAMES_ABORTED.add()
+
+
+def start_sampling(wheel):
+    """
+    Samples the number of completed games once per second, on the timer wheel of the process
+    :param wheel: A timeouts.TimerWheel
+    """
+
+    def sample():
+        _samples.append((time.monotonic(), GAMES_COMPLETED.value))
+        wheel.schedule(1, sample)
+
+    sample()
+
+
+def report():
+    """
+    :return: A dictionary with the current value of all the counters and histograms, and the rates
+    """
+    result = {counter.name: counter.value for counter in COUNTERS}
+
+    samples = list(_samples)
+    if len(samples) > 1:
+        (t0, v0), (t1, v1) = samples[0], samples[-1]
+        result['games_per_second'] = round((v1 - v0) / (t1 - t0), 3)
+    else:
+        result['games_per_second'] = 0
+
+    result['invalid_answer_rate'] = round(INVALID_ANSWERS.value / ANSWERS.value, 3) if ANSWERS.value else 0
+
+    for histogram in HISTOGRAMS:
+        for key, value in histogram.snapshot().items():
+            result[f'{histogram.name}_{key}'] = value
+
+    return result
+
+
+def summary():
+    """
+    :return: A short string with the main values, sent to the brokers with the registration
+    """
+    values = report()
+    keys = ['active_games', 'queued_players', 'games_per_second', 'matchmaking_wait_p50']
+    return ';'.join(f'{key}={values[key]:g}' for key in keys)
+
+
+class StatsServer:
+    """
+    This class answers the commands sent on the stats port. A client connects, sends one command on a
+        line, receives the answer and is disconnected, so the port can be used with any TCP tool.
+    The 'stats' command answers with one 'name value' line for each value in report(), more commands
+        can be added with add_command.
+    Connections are handled one at a time by a single thread, the port is meant for monitoring only.
+    The commands are not authenticated and some of them write profiles to the disk, so the port only
+        listens on the loopback interface unless another address is given
+    """
+
+    def __init__(self, port, logger, address='127.0.0.1'):
+        """
+        :param port: The port to listen on
+        :param logger: the logger object to use in this class
+        :param address: The address to listen on, the loopback interface by default
+        """
+        self._port = port
+        self._address = address
+        self._logger = logger
+        self._commands = {'stats': lambda: ''.join(f'{k} {v}\n' for k, v in report().items())}
+        self._listener = None
+
+    def add_command(self, name, function):
+        """
+        :param name: The command, a single word
+        :param function: A function without arguments, returning the string to answer with
+        """
+        self._commands[name] = function
+
+    def start(self):
+        self._listener = socket.create_server((self._address, self._port))
+        threading.Thread(target=self._run, daemon=True).start()
+        self._logger.log(level=logging.INFO, msg=f'Stats available on {self._address} port {self._port}')
+
+    def stop(self):
+        """
+        Stops listening, used for teardown of the class
+        """
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+
+    def _run(self):
+        """
+        Executed by the thread of the class, until stop is called
+        """
+        while True:
+            try:
+                conn, addr = self._listener.accept()
+            except OSError:
+                return
+
+            with conn:
+                try:
+                    conn.settimeout(COMMAND_TIMEOUT)
+                    command = conn.recv(1024).decode().strip()
+                    function = self._commands.get(command)
+
+                    if function is None:
+                        answer = f'Unknown command, available commands: {", ".join(self._commands)}\n'
+                    else:
+                        answer = function()
+
+                    conn.sendall(answer.encode())
+                except (OSError, UnicodeDecodeError) as e:
+                    self._logger.log(level=logging.DEBUG, msg=f'Stats request failed: {e}')
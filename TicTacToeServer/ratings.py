@@ -0,0 +1,370 @@
+"""
+This module contains the store of the ratings of the named players, and the leaderboard
+The ratings are kept in a SQLite database, but the game threads only work on the players cached in
+    memory: the changes are written in batches by a single thread, and the leaderboard is an in-memory
+    list of the best players that is updated at every rated game, so that neither of them waits for
+    the disk or scans the database
+"""
+import bisect
+import collections
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+# Rating of a new player, and maximum change of a rating after a game
+INITIAL_RATING = 1500
+K_FACTOR = 32
+
+# Valid player names, and the answer of the players that do not want to be rated
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,20}')
+ANONYMOUS = 'anonymous'
+
+# Players shown in the leaderboard, and players kept in the in-memory list
+LEADERBOARD_SIZE = 10
+TOP_CAPACITY = 4 * LEADERBOARD_SIZE
+
+# Players kept in the cache, the least recently used are evicted beyond it
+CACHE_CAPACITY = 10000
+
+# Seconds between two writes of the changed ratings
+FLUSH_SECONDS = 1
+
+
+class Player:
+    """
+    This class holds the rating and the results of a player
+    """
+
+    __slots__ = ('name', 'rating', 'wins', 'losses', 'draws')
+
+    def __init__(self, name, rating=INITIAL_RATING, wins=0, losses=0, draws=0):
+        self.name = name
+        self.rating = rating
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+
+    def key(self):
+        """
+        :return: The key of the player in the leaderboard, the best players first
+        """
+        return -self.rating, self.name
+
+
+class RatingStore:
+    """
+    This class stores the ratings of the players.
+    Players are loaded in a cache the first time they are looked up, with a query on the primary key, so
+        the players coming back are paired and rated without reading the store. The cache holds
+        CACHE_CAPACITY players, evicting the least recently used ones, except the players of the
+        leaderboard list and the ones with changes not written yet, that must stay the only copy of their
+        player.
+    Rated games update the cache and mark the players as changed, and the thread of the class writes all
+        the changed players in a single transaction every FLUSH_SECONDS.
+    The leaderboard is a sorted list holding exactly the best players of the whole store, up to
+        TOP_CAPACITY of them. A rated game only moves its two players in the list, and when too many of
+        them have dropped below its last entry the thread refills it with a query on the index of the
+        ratings, that reads no more rows than the list holds
+    """
+
+    def __init__(self, path, logger):
+        """
+        :param path: The path of the SQLite database, created if it does not exist
+        :param logger: the logger object to use in this class
+        """
+        self._path = path
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # Map<String, Player>, the least recently used first
+        self._changed = set()
+        self._writing = set()  # the changed players being written by the thread
+        self._top = []  # sorted list of (key, Player)
+        self._complete = False  # True if the list holds all the players of the store
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        # the database is only written by the thread of the class, the reads use their own connection
+        self._reader = None
+        self._reader_lock = threading.Lock()
+
+    def start(self):
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with sqlite3.connect(self._path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS players (name TEXT PRIMARY KEY, rating REAL NOT NULL, '
+                       'wins INTEGER NOT NULL, losses INTEGER NOT NULL, draws INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS players_rating ON players (rating DESC, name)')
+        db.close()
+
+        self._reader = sqlite3.connect(self._path, check_same_thread=False)
+        self._refill()
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the pending changes and closes the database, used for teardown of the class
+        """
+        self._stop.set()
+        self._thread.join()
+        self._reader.close()
+
+    def lookup(self, name):
+        """
+        Loads a player in the cache
+        :param name: The name of the player
+        :return: The rating of the player
+        """
+        return self._load(name).rating
+
+    def _load(self, name):
+        """
+        :param name: The name of the player
+        :return: The Player, loaded in the cache if needed
+        """
+        with self._lock:
+            player = self._cache.get(name)
+            if player is not None:
+                self._cache.move_to_end(name)
+                return player
+
+        with self._reader_lock:
+            row = self._reader.execute('SELECT rating, wins, losses, draws FROM players WHERE name = ?',
+                                       (name,)).fetchone()
+
+        with self._lock:
+            # the player could have been loaded in the meantime
+            player = self._cache.setdefault(name, Player(name, *row) if row is not None else Player(name))
+            self._evict()
+        return player
+
+    def rate(self, names, score):
+        """
+        Updates the ratings of two players after a game, with the Elo system
+        :param names: The names of the two players, that must be different
+        :param score: The score of the first player: 1 for a win, 0.5 for a draw, 0 for a loss
+        :return: A list with the new rating and the change of the rating of each player
+        """
+        loaded = [self._load(name) for name in names]
+
+        with self._lock:
+            # a player evicted after being loaded is cached again, unless it was loaded again meanwhile
+            players = [self._cache.setdefault(player.name, player) for player in loaded]
+            expected = 1 / (1 + 10 ** ((players[1].rating - players[0].rating) / 400))
+            change = K_FACTOR * (score - expected)
+
+            for player, delta, result in [(players[0], change, score), (players[1], -change, 1 - score)]:
+                self._remove(player)
+                player.rating += delta
+                if result == 1:
+                    player.wins += 1
+                elif result == 0:
+                    player.losses += 1
+                else:
+                    player.draws += 1
+                self._insert(player)
+                self._changed.add(player)
+
+            self._evict()
+            return [(players[0].rating, change), (players[1].rating, -change)]
+
+    def leaderboard(self, size=LEADERBOARD_SIZE):
+        """
+        :param size: The number of players
+        :return: A list of the best players, as tuples of name, rating, wins, losses and draws
+        """
+        with self._lock:
+            return [(p.name, p.rating, p.wins, p.losses, p.draws) for _, p in self._top[:size]]
+
+    def _listed(self, player):
+        """
+        :return: The index of the player in the leaderboard list, or None. Must be called holding self._lock
+        """
+        i = bisect.bisect_left(self._top, player.key(), key=lambda entry: entry[0])
+        if i < len(self._top) and self._top[i][1].name == player.name:
+            return i
+        return None
+
+    def _remove(self, player):
+        """
+        Removes a player from the leaderboard list, if it is there. Must be called holding self._lock
+        """
+        i = self._listed(player)
+        if i is not None:
+            del self._top[i]
+
+    def _insert(self, player):
+        """
+        Puts a player in the leaderboard list, if it belongs there. Must be called holding self._lock
+        """
+        # a player after the last entry could be behind players of the store that are not in the list
+        if not self._complete and (len(self._top) == 0 or player.key() > self._top[-1][0]):
+            return
+
+        bisect.insort(self._top, (player.key(), player), key=lambda entry: entry[0])
+        if len(self._top) > TOP_CAPACITY:
+            self._top.pop()
+            self._complete = False
+
+    def _evict(self):
+        """
+        Evicts the least recently used players beyond CACHE_CAPACITY, but not the players of the
+            leaderboard list or the ones with changes not written yet. Must be called holding self._lock
+        """
+        excess = len(self._cache) - CACHE_CAPACITY
+        if excess <= 0:
+            return
+
+        evicted = []
+        for name, player in self._cache.items():
+            if len(evicted) == excess:
+                break
+            if player not in self._changed and player not in self._writing and self._listed(player) is None:
+                evicted.append(name)
+
+        for name in evicted:
+            del self._cache[name]
+
+    def _refill(self):
+        """
+        Rebuilds the leaderboard list from the best rows of the store, and the cached players
+        """
+        with self._reader_lock:
+            rows = self._reader.execute('SELECT name, rating, wins, losses, draws FROM players '
+                                        'ORDER BY rating DESC, name LIMIT ?', (TOP_CAPACITY,)).fetchall()
+
+        with self._lock:
+            # the cached players are more recent than the store, and the players of the list are cached so
+            #   that their games move them in the list
+            candidates = {name: self._cache.setdefault(name, Player(name, *values)) for name, *values in rows}
+            complete = len(rows) < TOP_CAPACITY
+            threshold = None if complete else candidates[rows[-1][0]].key()
+
+            for name, player in self._cache.items():
+                if player.wins + player.losses + player.draws > 0 and (complete or player.key() <= threshold):
+                    candidates[name] = player
+
+            self._top = sorted(((p.key(), p) for p in candidates.values()
+                                if complete or p.key() <= threshold), key=lambda entry: entry[0])
+            self._top = self._top[:TOP_CAPACITY]
+            self._complete = complete and len(candidates) <= TOP_CAPACITY
+            self._evict()
+
+    def _run(self):
+        """
+        Executed by the thread of the class, until stop is called
+        """
+        db = sqlite3.connect(self._path)
+
+        while True:
+            stopped = self._stop.wait(FLUSH_SECONDS)
+
+            with self._lock:
+                rows = [(p.name, p.rating, p.wins, p.losses, p.draws) for p in self._changed]
+                # until they are written, reloading the players from the store would lose their changes
+                self._writing, self._changed = self._changed, set()
+                refill = not self._complete and len(self._top) < 2 * LEADERBOARD_SIZE
+
+            if len(rows) > 0:
+                try:
+                    with db:
+                        db.executemany('INSERT INTO players (name, rating, wins, losses, draws) '
+                                       'VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                                       'rating = excluded.rating, wins = excluded.wins, '
+                                       'losses = excluded.losses, draws = excluded.draws', rows)
+                except sqlite3.Error as e:
+                    self._logger.log(level=logging.ERROR, msg=f'Cannot write {len(rows)} ratings: {e}')
+
+                with self._lock:
+                    self._writing = set()
+
+            if refill:
+                self._refill()
+
+            if stopped:
+                break
+
+        db.close()
+
+
+# The store of this process, None if the ratings are disabled
+_store = None
+
+
+def open_store(path, logger):
+    """
+    Starts keeping the ratings of the players in a SQLite database
+    """
+    global _store
+    _store = RatingStore(path, logger)
+    _store.start()
+
+
+def close_store():
+    """
+    Writes the pending changes of the ratings
+    """
+    if _store is not None:
+        _store.stop()
+
+
+def enabled():
+    """
+    :return: True if the ratings are kept by this process
+    """
+    return _store is not None
+
+
+def parse_name(answer):
+    """
+    :param answer: The answer of a player asked for their name
+    :return: The name, '' if the player does not want to be rated, or None if the answer is not valid
+    """
+    if answer == ANONYMOUS:
+        return ''
+    if NAME_PATTERN.fullmatch(answer):
+        return answer
+    return None
+
+
+def rating(name):
+    """
+    :param name: The name of a player, '' if anonymous
+    :return: The rating of the player, anonymous players have the initial rating
+    """
+    if _store is None or not name:
+        return INITIAL_RATING
+    return _store.lookup(name)
+
+
+def rate_game(names, score):
+    """
+    Rates a game, if both players have a name and the names are different
+    :param names: A list with the names of the two players, None or '' for anonymous players and the bot
+    :param score: The score of the first player: 1 for a win, 0.5 for a draw, 0 for a loss
+    :return: A list of two messages telling the players their new rating, or two empty strings if the
+        game is not rated
+    """
+    # a player connected twice with the same name cannot rate themselves
+    if _store is None or names is None or not all(names) or names[0] == names[1]:
+        return ['', '']
+
+    return [f'Your rating: {rating:.0f} ({change:+.0f})\n' for rating, change in _store.rate(names, score)]
+
+
+def leaderboard():
+    """
+    :return: The leaderboard as a string, one player per line
+    """
+    if _store is None:
+        return 'Ratings are disabled\n'
+
+    lines = [f'{i + 1:>3}. {name:<20} {rating:6.0f}  {wins}W {losses}L {draws}D\n'
+             for i, (name, rating, wins, losses, draws) in enumerate(_store.leaderboard())]
+    return ''.join(lines) if len(lines) > 0 else 'No rated games yet\n'
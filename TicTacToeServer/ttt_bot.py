@@ -0,0 +1,94 @@
+"""
+This module contains the bot opponent for the Tic-Tac-Toe server, and the table of precomputed
+    perfect moves it plays from
+"""
+
+EMPTY = '-'
+
+
+def _winner(cells):
+    """
+    Returns the sign that has three in a row on the board, if any
+    :param cells: A string of 9 characters representing the board row by row
+    :return: The winning sign, or None if nobody has won
+    """
+    for a, b, c in ((0, 1, 2), (3, 4, 5), (6, 7, 8),
+                    (0, 3, 6), (1, 4, 7), (2, 5, 8),
+                    (0, 4, 8), (2, 4, 6)):
+        if cells[a] == cells[b] == cells[c] != EMPTY:
+            return cells[a]
+    return None
+
+
+def build_table():
+    """
+    Explores every position reachable from the empty board with a memoized negamax search, and
+        stores the best move for the side to move in each of them.
+    Faster wins and slower losses are preferred, so the bot does not toy with its opponent.
+    :return: A dictionary mapping each reachable board (9 characters string, row by row) to the index
+        of the best cell to play, or None if the game is over in that position
+    """
+    table = {}
+    values = {}
+
+    def negamax(cells):
+        if cells in values:
+            return values[cells]
+
+        free = [i for i, cell in enumerate(cells) if cell == EMPTY]
+
+        if _winner(cells) is not None:
+            # the previous player has just won, the faster the worse for the side to move
+            value, move = -(1 + len(free)), None
+        elif not free:
+            value, move = 0, None
+        else:
+            sign = 'X' if cells.count('X') == cells.count('O') else 'O'
+            value, move = None, None
+            for i in free:
+                child = -negamax(cells[:i] + sign + cells[i + 1:])
+                if value is None or child > value:
+                    value, move = child, i
+
+        values[cells] = value
+        table[cells] = move
+        return value
+
+    negamax(EMPTY * 9)
+    return table
+
+
+class BotPlayer:
+    """
+    This class replaces the second player connection when a lone player is paired with the bot.
+    Moves are looked up in the precomputed table, so the bot never loses and answers in constant time.
+    The shutdown and close methods mirror the ones of a socket, so that the game thread can treat the
+        bot like any other player when the game ends.
+    """
+
+    def __init__(self, table):
+        """
+        :param table: The dictionary of best moves, as returned by build_table
+        """
+        self._table = table
+
+    def choose_move(self, board):
+        """
+        :param board: A 3x3 matrix representing the board
+        :return: A pair of integers representing the row and column of the move
+        """
+        index = self._table[''.join(cell for row in board for cell in row)]
+        return divmod(index, 3)
+
+    def play_again(self):
+        """
+        The bot is always up for another game
+        :return: A string representing its decision
+        """
+        return 'yes'
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
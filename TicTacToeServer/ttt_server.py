@@ -2,12 +2,27 @@
 Scripts that launches the Tic-Tac-Toe Server when executed
 """
 import logging
+import multiprocessing
 import os
+import selectors
 import socket
 import sys
 import threading
-from threading import Timer, Thread
-
+import time
+from threading import Thread
+
+import game_records
+import handoff
+import matchmaking
+import metrics
+import profiling
+import ratings
+import rounds
+import registration
+import spectators
+import timeouts
+import tracing
+import ttt_bot
 import ttt_thread
 
 # LOGGING
@@ -23,19 +38,22 @@ file_handler = logging.FileHandler(filePath)
 stdout_handler = logging.StreamHandler(sys.stdout)
 handlers = [file_handler, stdout_handler]
 
-logging.basicConfig(format='%(asctime)s:%(process)d:%(name)s:%(levelname)s:%(message)s',
+logging.basicConfig(format=tracing.LOG_FORMAT,
                     datefmt='%Y-%m-%dT%H:%M:%S%z',
                     level=logging.DEBUG,
                     handlers=handlers)
 logger = logging.getLogger('Tic-Tac-Toe')
+tracing.setup(logger)
 
 # CONSTANTS
 
 N_PLAYERS = 2
-MAX_REGISTRATION_TRIES = 3
-SECONDS_TIMEOUT = 60
 N_MINUTES = 4
 
+# Seconds a new connection waits before it can be paired, so that the connections closed right after
+#   connecting, like the probes of the clients measuring the round trip time, never start a game
+CONNECT_GRACE = 0.1
+
 
 # INPUT PARAMETERS
 
@@ -47,117 +65,768 @@ if len(sys.argv) != 6:
 try:
     localPort = int(sys.argv[3])
     brokerPort = int(sys.argv[5])
+
+    # brokerAddress can be a comma separated list of brokers, each one optionally with its own port
+    brokers = []
+    for entry in sys.argv[4].split(','):
+        address, _, port = entry.partition(':')
+        brokers.append((address, int(port) if port else brokerPort))
 except ValueError:
     logger.log(level=logging.ERROR, msg='Invalid port argument')
     exit(-1)
 
 localAddress = sys.argv[2]
-brokerAddress = sys.argv[4]
 
 serverName = sys.argv[1]
 
+# OPTIONAL FEATURES
+# These are configured through environment variables, so that the positional arguments stay the same
+#   for every deployment
+
+# Seconds a lone player waits for an opponent before being paired with the bot. If not set, the bot
+#   is disabled and players wait for another human indefinitely
+try:
+    botWaitSeconds = os.environ.get('BOT_WAIT_SECONDS')
+    if botWaitSeconds is not None:
+        botWaitSeconds = float(botWaitSeconds)
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid BOT_WAIT_SECONDS value')
+    exit(-1)
+
+# Seconds between two registrations on the same broker, they must be less than the broker's removal period
+try:
+    registrationInterval = float(os.environ.get('REGISTRATION_INTERVAL', N_MINUTES * 60))
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid REGISTRATION_INTERVAL value')
+    exit(-1)
+
+# Region tag sent with the registrations, the brokers list the servers of the same region as the nearest
+#   one to a client first. If not set, the servers are only ordered by the proximity of their address
+region = os.environ.get('REGION')
+if region is not None and (region == '' or any(c in region for c in '|$;= ')):
+    logger.log(level=logging.ERROR, msg='Invalid REGION value')
+    exit(-1)
+
+# Protocol of the registrations, 'text' or 'binary' (see wire), the brokers must support the binary one
+brokerProtocol = os.environ.get('BROKER_PROTOCOL', 'text')
+if brokerProtocol not in ['text', 'binary']:
+    logger.log(level=logging.ERROR, msg='Invalid BROKER_PROTOCOL value')
+    exit(-1)
+
+# Number of worker processes sharing the listening port. With more than one worker, the pre-fork mode
+#   is used
+try:
+    nWorkers = int(os.environ.get('WORKERS', 1))
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid WORKERS value')
+    exit(-1)
+
+# Path of the Unix socket used to hand off the server to a new process, when upgrading it. If not set,
+#   upgrades are disabled
+handoffPath = os.environ.get('HANDOFF_PATH')
+if handoffPath is not None and nWorkers > 1:
+    logger.log(level=logging.ERROR, msg='HANDOFF_PATH is not supported with more than one worker')
+    exit(-1)
+
+# Port the spectators connect to, to watch the running matches. If not set, spectators are disabled
+try:
+    spectatorPort = os.environ.get('SPECTATOR_PORT')
+    if spectatorPort is not None:
+        spectatorPort = int(spectatorPort)
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid SPECTATOR_PORT value')
+    exit(-1)
+
+if spectatorPort is not None and nWorkers > 1:
+    logger.log(level=logging.ERROR, msg='SPECTATOR_PORT is not supported with more than one worker')
+    exit(-1)
+
+# Port answering with the counters and histograms of the server, see metrics.StatsServer. If not set,
+#   the stats are only sent to the brokers with the registrations
+try:
+    statsPort = os.environ.get('STATS_PORT')
+    if statsPort is not None:
+        statsPort = int(statsPort)
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid STATS_PORT value')
+    exit(-1)
+
+# Address the stats port listens on. Its commands are not authenticated, so it is only reachable from
+#   this host unless set, for example to 0.0.0.0
+statsAddress = os.environ.get('STATS_ADDRESS', '127.0.0.1')
+
+# Directory where a binary record of every game is appended, see game_records. If not set, no record
+#   is kept
+recordsPath = os.environ.get('RECORDS_PATH')
+
+# Path of the SQLite database with the ratings of the named players, see ratings. If set, the players are
+#   asked for their name when they connect, otherwise all the players are anonymous
+ratingsPath = os.environ.get('RATINGS_PATH')
+if ratingsPath is not None and nWorkers > 1:
+    logger.log(level=logging.ERROR, msg='RATINGS_PATH is not supported with more than one worker')
+    exit(-1)
+
+# Rating gap accepted between two players as soon as they are queued, see matchmaking.SkillQueue. If set,
+#   the players are paired by rating instead of in order of arrival, and the accepted gap widens by
+#   MATCH_GAP_GROWTH points for every second they wait
+try:
+    matchGap = os.environ.get('MATCH_GAP')
+    if matchGap is not None:
+        matchGap = float(matchGap)
+    matchGapGrowth = float(os.environ.get('MATCH_GAP_GROWTH', 10))
+    # without growth, players whose gap is too large would wait forever
+    if not matchGapGrowth > 0 or (matchGap is not None and not matchGap >= 0):
+        raise ValueError
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid MATCH_GAP or MATCH_GAP_GROWTH value')
+    exit(-1)
+
+if matchGap is not None and ratingsPath is None:
+    logger.log(level=logging.ERROR, msg='MATCH_GAP requires RATINGS_PATH')
+    exit(-1)
+
+# Profiler started and stopped by SIGUSR1, see profiling: 'sample' samples the stacks of all the threads,
+#   'cprofile' profiles the game threads and the thread pairing the players. SIGUSR2 dumps the stacks of
+#   the threads and takes a memory snapshot, the stats port has commands for all of them
+profiler = os.environ.get('PROFILER', 'sample')
+if profiler not in profiling.PROFILERS:
+    logger.log(level=logging.ERROR, msg='Invalid PROFILER value')
+    exit(-1)
+
+profiling.setup(logger, profiler)
+
+# Number of rows and columns of the board, and number of signs in a row needed to win. The classic game
+#   is played on a 3x3 board, Gomoku on a 15x15 board with 5 in a row. The moves are recorded in one
+#   byte each, so the board cannot be larger than 15x15
+try:
+    boardSize = int(os.environ.get('BOARD_SIZE', 3))
+    winLength = int(os.environ.get('WIN_LENGTH', min(boardSize, 5)))
+except ValueError:
+    logger.log(level=logging.ERROR, msg='Invalid BOARD_SIZE or WIN_LENGTH value')
+    exit(-1)
+
+if not 3 <= boardSize <= 15 or not 3 <= winLength <= boardSize:
+    logger.log(level=logging.ERROR, msg='BOARD_SIZE must be between 3 and 15, and WIN_LENGTH between 3 and BOARD_SIZE')
+    exit(-1)
+
+if botWaitSeconds is not None and (boardSize, winLength) != (3, 3):
+    logger.log(level=logging.ERROR, msg='The bot only plays on the 3x3 board, BOT_WAIT_SECONDS is not supported '
+                                        'with BOARD_SIZE or WIN_LENGTH')
+    exit(-1)
+
+# The table of perfect moves is computed only once, and shared by all the bot games
+botTable = None
+if botWaitSeconds is not None:
+    botTable = ttt_bot.build_table()
+    logger.log(level=logging.INFO, msg=f'Bot enabled with {len(botTable)} precomputed positions')
+
+
+# HANDLING CLIENT CONNECTIONS
+
+# Number of running games of each process, the parent process picks the least loaded worker for each
+#   new game. In single process mode there is only one slot
+load = multiprocessing.Array('i', max(nWorkers, 1))
+
+
+# Threads running games in this process
+game_threads = []
+
+
+# The spectators of all the matches are handled by a single hub
+hub = None
+if spectatorPort is not None:
+    hub = spectators.SpectatorHub(spectatorPort, logger)
+
+
+# The stats are reported by the process pairing the players
+stats = None
+if statsPort is not None:
+    stats = metrics.StatsServer(statsPort, logger, statsAddress)
+    stats.add_command('leaderboard', ratings.leaderboard)
+    for command, function in profiling.COMMANDS.items():
+        stats.add_command(command, function)
+
+
+# All the deadlines of this process are enforced by a single timer wheel, started once the process
+#   has been forked
+wheel = None
+
+
+def run_game(players, slot, state, names):
+    """
+    This function runs a game thread, keeping the number of running games of this process up to date
+    :param players: a list containing two player connections, the second one can be a BotPlayer
+    :param slot: The index of this process in load
+    :param state: The state of a game handed off by another process, or None for a new game
+    :param names: A list with the names of the players, or None if the ratings are disabled
+    """
+    with load.get_lock():
+        load[slot] += 1
+    metrics.ACTIVE_GAMES.add(1)
+
+    match = None
+    if hub is not None:
+        titles = [name or 'Player' for name in names] if names is not None else ['Player', 'Player']
+        if isinstance(players[1], ttt_bot.BotPlayer):
+            titles[1] = 'bot'
+        match = hub.open_match(f'{titles[0]} vs {titles[1]}')
+
+    session = timeouts.Session(wheel, players)
+
+    try:
+        ttt_thread.game_thread(players, logger, state, match, session, names, boardSize, winLength)
+    finally:
+        with load.get_lock():
+            load[slot] -= 1
+        metrics.ACTIVE_GAMES.add(-1)
+
+        for player in players:
+            tracing.event('game.end', tracing.context_of(player))
+
+
+def start_game(players, slot=0, state=None, names=None):
+    """
+    Starts a new game thread in this process
+    :param players: a list containing one or two player connections. If there is only one, the game
+        is played against the bot
+    :param slot: The index of this process in load
+    :param state: The state of a game handed off by another process, or None for a new game
+    :param names: A list with the names of the players, or None if the ratings are disabled
+    """
+    global botTable, game_threads
+
+    if len(players) == 1:
+        # a game against the bot can be handed off to a process where the bot is not enabled
+        if botTable is None:
+            botTable = ttt_bot.build_table()
+        players = players + [ttt_bot.BotPlayer(botTable)]
+        if names is not None:
+            names = names[:1] + [None]
+        logger.log(level=logging.INFO, msg='Started new game thread against the bot')
+    else:
+        logger.log(level=logging.INFO, msg='Started new game thread')
+
+    game_instance = Thread(target=run_game, args=(players, slot, state, names,))
+    game_instance.start()
+
+    game_threads = [t for t in game_threads if t.is_alive()] + [game_instance]
+
+
+def receive_connections(channel):
+    """
+    Receives the player connections sent by another process on a Unix socket
+    :param channel: The Unix socket
+    :return: The message that came with the connections, and the list of connections. The message is
+        empty if the other process has terminated
+    """
+    msg, fds, _, _ = socket.recv_fds(channel, 128, N_PLAYERS)
+    conns = [socket.socket(fileno=fd) for fd in fds]
+
+    # the message is followed by the trace context of each connection, '-' if it is not traced
+    kind, *contexts = msg.decode().split(' ')
+    for conn, context in zip(conns, contexts):
+        tracing.bind(conn, context if context != '-' else None)
+
+    return kind.encode(), conns
+
+
+def send_connections(channel, msg, conns):
+    """
+    Sends player connections to another process on a Unix socket. The connections are then closed in
+        this process, without shutting them down, so that the other process keeps them open
+    :param channel: The Unix socket
+    :param msg: A short message identifying the kind of request
+    :param conns: The list of connections
+    """
+    contexts = [tracing.context_of(conn) or '-' for conn in conns]
+    socket.send_fds(channel, [b' '.join([msg] + [context.encode() for context in contexts])],
+                    [conn.fileno() for conn in conns])
+
+    for conn in conns:
+        conn.close()
+
+
+def forward_connections(listener, channel):
+    """
+    Executed by a thread of each worker process: accepts the incoming connections on the worker's own
+        listening socket and forwards them to the parent process, that pairs all the players
+    :param listener: The listening socket of the worker
+    :param channel: The Unix socket connected to the parent process
+    """
+    while True:
+        conn, addr = listener.accept()
+        logger.log(level=logging.INFO, msg='Accepted connection from Client')
+        send_connections(channel, b'conn', [conn])
+
+
+def worker(slot, channel):
+    """
+    This function is executed by each worker process. The listening socket is bound with SO_REUSEPORT,
+        so that the kernel spreads the incoming connections over all the workers. Accepted connections
+        are forwarded to the parent, and the games the parent assigns to this worker are run here
+    :param slot: The index of this process in load
+    :param channel: The Unix socket connected to the parent process
+    """
+    global wheel
+    wheel = timeouts.TimerWheel(logger)
+    wheel.start()
+
+    if recordsPath is not None:
+        game_records.open_log(recordsPath, logger)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(('0.0.0.0', localPort))
+        listener.listen()
+
+        Thread(target=forward_connections, args=(listener, channel,), daemon=True).start()
+        logger.log(level=logging.INFO, msg=f'Worker {slot} started')
+
+        try:
+            while True:
+                profiling.checkpoint()
+                msg, players = receive_connections(channel)
+                if msg == b'':
+                    break
+                start_game(players, slot)
+        except KeyboardInterrupt:
+            pass
+
+    join_game_threads()
+    wheel.stop()
+    game_records.close_log()
+
+
+def join_game_threads():
+    """
+    Waits for all game threads to finish
+    """
+    main_thread = threading.current_thread()
+    for t in threading.enumerate():
+        if t is main_thread or t.daemon:
+            continue
+        t.join()
+
+
+def take_over():
+    """
+    If another server process is listening on handoffPath, this process takes over from it: the
+        listening socket, the queued players and the running games are received, and the games are
+        resumed. Then this process listens on handoffPath, waiting for its own replacement
+    :return: The Unix socket listening for the replacement, the listening socket received (or None if
+        there was no process to take over from) and the list of queued players, as pairs of their
+        connection and their name
+    """
+    listener = None
+    queued = []
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as channel:
+        try:
+            channel.connect(handoffPath)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        else:
+            listener, queued, games = handoff.receive_handoff(channel)
+
+            # the old process has written all its ratings before completing the handoff
+            if ratingsPath is not None:
+                ratings.open_store(ratingsPath, logger)
+
+            for conns, state in games:
+                start_game(conns, state=state, names=state.get('names'))
+
+            logger.log(level=logging.INFO,
+                       msg=f'Took over from the old process, {len(queued)} queued players and {len(games)} games')
+
+    # the path is either stale, or still bound by the old process that is terminating
+    if os.path.exists(handoffPath):
+        os.unlink(handoffPath)
+
+    upgrade_listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    upgrade_listener.bind(handoffPath)
+    upgrade_listener.listen()
+
+    return upgrade_listener, listener, queued
+
+
+def hand_off(channel, listener, queued):
+    """
+    Hands off this server to the new process connected on channel. All the game threads are interrupted
+        at their current question, and their state is sent with the listening socket and the queued players
+    :param channel: A Unix socket connected to the new process
+    :param listener: The listening socket of the server
+    :param queued: The list of the players waiting for an opponent, as pairs of their connection and their
+        name
+    """
+    # the spectators are dropped and the stats port is closed, so that the new process can listen on
+    #   the same ports
+    if hub is not None:
+        hub.stop()
+    if stats is not None:
+        stats.stop()
+
+    rounds.request_handoff()
+
+    for t in game_threads:
+        t.join()
+
+    # the records and the ratings of the games that ended before the handoff are written by this process
+    game_records.close_log()
+    ratings.close_store()
+
+    handoff.send_handoff(channel, listener, queued, ttt_thread.handed_off)
+    logger.log(level=logging.INFO,
+               msg=f'Handed off {len(queued)} queued players and {len(ttt_thread.handed_off)} games')
+
+    # closing the sockets in this process does not affect the new one
+    for conn, _ in queued:
+        conn.close()
+    for players, state in ttt_thread.handed_off:
+        for player in players:
+            player.close()
+
+
+# PRE-FORK MODE
+# If more than one worker is requested, the worker processes are forked before any thread is started.
+# The parent process only pairs the players and registers on the broker, while the workers accept the
+#   connections and run the games, so that all the cores of the host can be used
+
+workers = []
+channels = []
+
+if nWorkers > 1:
+    context = multiprocessing.get_context('fork')
+
+    for i in range(nWorkers):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = context.Process(target=worker, args=(i, child_end,))
+        process.start()
+        child_end.close()
+
+        workers.append(process)
+        channels.append(parent_end)
+
+wheel = timeouts.TimerWheel(logger)
+wheel.start()
+metrics.start_sampling(wheel)
+
+# In pre-fork mode the games are recorded by the workers
+if recordsPath is not None and nWorkers == 1:
+    game_records.open_log(recordsPath, logger)
+
+
+# UPGRADES
+# If upgrades are enabled, this process first tries to take over from a running server, and then waits
+#   for the connection of its own replacement
+
+upgrade_listener = None
+listener = None
+taken_over = []
+
+if handoffPath is not None:
+    upgrade_listener, listener, taken_over = take_over()
+
+if ratingsPath is not None and not ratings.enabled():
+    ratings.open_store(ratingsPath, logger)
+
+if listener is None:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    # In pre-fork mode the listening socket of the parent is left unbound, the workers bind their own
+    if nWorkers == 1:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('0.0.0.0', localPort))
+        listener.listen()
+
+if hub is not None:
+    hub.start()
+
+if stats is not None:
+    stats.start()
 
 # CONNECTING TO BROKER
+# The registration is sent to all the brokers as soon as the server starts, then it is periodically
+#   renewed so that this server will not be removed from the registries, as long as the interval is
+#   smaller than the brokers' removal period
+# Brokers that are not responding are retried with backoff, so the server is registered again soon after
+#   they come back
+
+broker_registration = registration.BrokerRegistration(serverName, localAddress, localPort, brokers,
+                                                      registrationInterval, logger,
+                                                      metrics.summary, region, brokerProtocol == 'binary')
+broker_registration.start()
+
+# MATCHMAKING
+# Players are stored in a queue, and paired as soon as there are enough of them to start a game.
+# In single process mode the players are accepted directly on the listening socket, in pre-fork mode
+#   they are received from the workers, and each game is then assigned to the least loaded worker
+# Queued players are watched by the selector too, so that the ones closing their connection leave the
+#   queue, and the ones waiting longer than timeouts.IDLE_SECONDS are disconnected
+# If the ratings are enabled, the players are asked for their name first, and they are paired only once
+#   they have answered. The answer is read by the selector like any other message of a queued player
+# If skill matching is enabled, only players whose ratings are close enough are paired, the others wait
+#   until their accepted gap has widened, or until they are paired with the bot
+
+NAME_PROMPT = f"Choose your player name, or '{ratings.ANONYMOUS}' to play without a rating " \
+              f"[up to 20 letters, digits, '-', '_']: "
+
+conns = []  # the players ready to be paired
+waiting = {}  # Map<socket, (float, Timer)>, the time each player was queued and their idle deadline
+names = {}  # Map<socket, String>, the name of each player ready to be paired, '' if anonymous
+fresh = {}  # Map<socket, float>, the new anonymous players and the time they can be paired
+
+skill = None
+if matchGap is not None:
+    skill = matchmaking.SkillQueue(matchGap, matchGapGrowth)
+
+
+def expire_queued(conn):
+    """
+    Called by the timer wheel when a player has waited too long for an opponent. The connection is shut
+        down, and the player is removed from the queue when the selector reports it
+    :param conn: The connection of the player
+    """
+    logger.log(level=logging.INFO, msg='Queued player waited too long, disconnecting')
+    timeouts.shutdown_quietly(conn)
 
-# Perpetual timer with set delay
-# SOURCE: https://stackoverflow.com/a/48741004
-class RepeatTimer(Timer):
+
+def enqueue(conn, name=None, asked=False):
     """
-    When instantiated (and run) this class repeats the function contained in self.function every
-        self.interval seconds.
+    Adds a player to the queue. If the ratings are enabled and the name of the player is not known, they
+        are asked for it
+    :param conn: The connection of the player
+    :param name: The name of the player, '' if anonymous, or None if not known yet
+    :param asked: True if the player has already been asked for their name, by the process handing off
     """
+    waiting[conn] = (time.monotonic(), wheel.schedule(timeouts.IDLE_SECONDS, lambda: expire_queued(conn)))
+    metrics.QUEUED_PLAYERS.set(len(waiting))
+    selector.register(conn, selectors.EVENT_READ)
+
+    if name is None and ratingsPath is not None:
+        if not asked:
+            ask_name(conn)
+    elif name is None:
+        fresh[conn] = time.monotonic() + CONNECT_GRACE
+    else:
+        make_ready(conn, name)
 
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
 
+def ask_name(conn, error=False):
+    """
+    Asks a queued player for their name, a player that cannot be reached is removed by the selector
+    :param conn: The connection of the player
+    :param error: True if the previous answer of the player was not a valid name
+    """
+    prompt = f'Invalid name!\n{NAME_PROMPT}' if error else NAME_PROMPT
+    try:
+        conn.sendall(prompt.encode())
+    except OSError:
+        timeouts.shutdown_quietly(conn)
 
-def register_on_broker():
+
+def make_ready(conn, name):
     """
-    This function attempts to register the server on the broker. Once called sends a message containing
-        the name of the server to the broker, and awaits a response. The response is logged.
-        Possible outcomes are 'okay', 'taken' and 'renewed'
-    If the broker is not available, the connection will be attempted MAX_REGISTRATION_TRIES at intervals
-        given by the socket timeout set at SECONDS_TIMEOUT seconds.
+    Makes a queued player available for pairing, their wait starts now
+    :param conn: The connection of the player
+    :param name: The name of the player, '' if anonymous
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(SECONDS_TIMEOUT)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        success = False
+    names[conn] = name
+    conns.append(conn)
+    waiting[conn] = (time.monotonic(), waiting[conn][1])
 
-        # attempts a set number of times
-        for i in range(0, MAX_REGISTRATION_TRIES):
-            sock.sendto(bytes(f'{serverName}|{localAddress}|{localPort}', "utf-8"), (brokerAddress, brokerPort))
+    if skill is not None:
+        skill.add(conn, ratings.rating(name), waiting[conn][0])
 
-            try:
-                received = str(sock.recv(1024), "utf-8")
-                match received:
-                    case "okay":
-                        logger.log(level=logging.INFO, msg='Registered on Broker')
-                    case "taken":
-                        logger.log(level=logging.WARN, msg='Name already taken on Broker')
-                    case "renewed":
-                        logger.log(level=logging.INFO, msg='Renewed on Broker')
-                success = True
-                break
-            except socket.timeout:
-                logger.log(level=logging.DEBUG, msg=f'Try number {i + 1} failed')
-                continue
-            except KeyboardInterrupt:
-                return
 
-        if not success:
-            logger.log(level=logging.WARN, msg='Could not connect to Broker')
+def dequeue(conn):
+    """
+    Removes a player from the queue, without closing their connection
+    :param conn: The connection of the player
+    :return: The name of the player, '' if anonymous, or None if they had not answered yet
+    """
+    if conn in names:
+        conns.remove(conn)
+        if skill is not None:
+            skill.remove(conn)
+    fresh.pop(conn, None)
+    _, timer = waiting.pop(conn)
+    metrics.QUEUED_PLAYERS.set(len(waiting))
+    wheel.cancel(timer)
+    selector.unregister(conn)
+    return names.pop(conn, None)
+
+
+def promote_fresh():
+    """
+    Makes the new anonymous players available for pairing once they have waited CONNECT_GRACE, unless
+        they have already closed their connection
+    """
+    now = time.monotonic()
+    while len(fresh) > 0:
+        conn, ready = next(iter(fresh.items()))
+        if ready > now:
+            break
+
+        del fresh[conn]
+        if timeouts.peer_closed(conn):
+            dequeue(conn)
+            conn.close()
+            logger.log(level=logging.INFO, msg='Connection closed before pairing')
+        else:
+            make_ready(conn, '')
+
+
+def next_players():
+    """
+    Chooses the players of the next game, they are left in the queue
+    :return: A list of two players, or of one player that has waited long enough for the bot, or None if
+        no game can start yet
+    """
+    if skill is not None:
+        pair = skill.pop_pair(time.monotonic())
+        if pair is not None:
+            players, gap = pair
+            metrics.MATCH_RATING_GAP.observe(gap)
+            return list(players)
+    elif len(conns) >= N_PLAYERS:
+        return conns[:N_PLAYERS]
+
+    if botWaitSeconds is not None and len(conns) > 0 and \
+            time.monotonic() - waiting[conns[0]][0] >= botWaitSeconds:
+        return conns[:1]
 
+    return None
 
-# REPEATTIMER
-# A RepeatTime is activated, periodically creating a new thread that executes register_on_broker
-# This will make sure this server will not be removed from the registry if the period is smaller
-#   that the broker's removal period
-# It will also attempt to register if the broker is not reliable and is not responding or
-#   periodically shutting down
 
-timer = RepeatTimer(N_MINUTES * 60, register_on_broker)
-timer.start()
+with selectors.DefaultSelector() as selector, listener as s:
+    if nWorkers > 1:
+        for channel in channels:
+            selector.register(channel, selectors.EVENT_READ)
+    else:
+        selector.register(s, selectors.EVENT_READ)
 
-# HANDLING CLIENT CONNECTIONS
+    if upgrade_listener is not None:
+        selector.register(upgrade_listener, selectors.EVENT_READ)
 
-conns = []
+    for conn, name in taken_over:
+        enqueue(conn, name, asked=True)
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(('0.0.0.0', localPort))
-    s.listen()
     try:
-        # The server sequentially accepts all incoming connections and stores the handles in a queue
         while True:
-            conn, addr = s.accept()
-            logger.log(level=logging.INFO, msg='Accepted connection from Client')
+            profiling.checkpoint()
+
+            # If the bot is enabled, waiting only blocks until the first queued player has waited
+            #   long enough, then that player starts a game against the bot
+            timeout = None
+            if botWaitSeconds is not None and len(conns) > 0:
+                timeout = max(waiting[conns[0]][0] + botWaitSeconds - time.monotonic(), 0)
+
+            # New players become available for pairing after a short grace period
+            if len(fresh) > 0:
+                grace = max(next(iter(fresh.values())) - time.monotonic(), 0)
+                timeout = grace if timeout is None else min(timeout, grace)
 
-            conn.settimeout(90)
+            # With skill matching, waiting also ends when the gap between two queued players is accepted
+            if skill is not None and skill.next_deadline() is not None:
+                deadline = max(skill.next_deadline() - time.monotonic(), 0)
+                timeout = deadline if timeout is None else min(timeout, deadline)
 
-            conns.append(conn)
+            events = selector.select(timeout)
 
-            # If there are enough players to start a game, then a new thread is started and
-            #   the queue is emptied
-            if len(conns) == N_PLAYERS:
-                game_instance = Thread(target=ttt_thread.game_thread, args=(conns, logger,))
-                game_instance.start()
+            # A new process is taking over, this one terminates once the handoff is complete
+            if any(key.fileobj is upgrade_listener for key, _ in events):
+                broker_registration.stop()
 
-                logger.log(level=logging.INFO, msg='Started new game thread')
+                queued = [(conn, dequeue(conn)) for conn in list(waiting)]
 
-                conns = []
+                channel, _ = upgrade_listener.accept()
+                with channel:
+                    hand_off(channel, s, queued)
+                upgrade_listener.close()
+
+                logger.log(level=logging.INFO, msg="Tic-Tac-Toe Server terminated after handoff")
+                break
+
+            for key, _ in events:
+                if key.fileobj is s:
+                    conn, addr = s.accept()
+                    logger.log(level=logging.INFO, msg='Accepted connection from Client')
+
+                    new_conns = [conn]
+                elif key.fileobj in waiting:
+                    # only the name and the trace context are expected from a queued player, anything else
+                    #   they send before the game starts is discarded
+                    conn = key.fileobj
+                    try:
+                        data = conn.recv(1024)
+                    except OSError:
+                        data = b''
+
+                    if data == b'':
+                        dequeue(conn)
+                        conn.close()
+                        logger.log(level=logging.INFO, msg='Queued player left')
+                    elif len(data := tracing.receive_handshake(conn, data)) == 0:
+                        pass
+                    elif conn not in names:
+                        name = ratings.parse_name(data.decode(errors='replace').strip())
+                        if name is None:
+                            ask_name(conn, error=True)
+                        else:
+                            make_ready(conn, name)
+                            logger.log(level=logging.DEBUG, msg=f'Queued player {name or "anonymous"}')
+                    continue
+                else:
+                    msg, new_conns = receive_connections(key.fileobj)
+                    if msg == b'':
+                        selector.unregister(key.fileobj)
+                        logger.log(level=logging.ERROR, msg='A worker process terminated')
+
+                for conn in new_conns:
+                    enqueue(conn)
+
+            # As long as there are enough players to start a game, or a lone player has waited too long,
+            #   a new game is started with the players at the head of the queue, or with the closest
+            #   ratings. More players than needed are queued when several workers forward a connection
+            #   at the same time
+            promote_fresh()
+            while (players := next_players()) is not None:
+
+                player_names = []
+                for conn in players:
+                    wait = time.monotonic() - waiting[conn][0]
+                    metrics.MATCHMAKING_WAIT.observe(wait)
+                    tracing.event('session.paired', tracing.context_of(conn), wait_us=int(wait * 1e6),
+                                  bot=len(players) == 1)
+                    player_names.append(dequeue(conn))
+
+                if nWorkers > 1:
+                    slot = min(range(nWorkers), key=lambda j: load[j])
+                    send_connections(channels[slot], b'game', players)
+                    logger.log(level=logging.DEBUG,
+                               msg=f'Game assigned to worker {slot}, running games: '
+                                   f'{sum(load)} ({", ".join(str(n) for n in load)})')
+                else:
+                    start_game(players, names=player_names if ratingsPath is not None else None)
 
     except KeyboardInterrupt:
 
-        # Stopping the timer and waiting for all game threads to finish before terminating
-        timer.cancel()
+        # Stopping the registration and waiting for all game threads and workers to finish before terminating
+        broker_registration.stop()
+
+        if hub is not None:
+            hub.stop()
+        if stats is not None:
+            stats.stop()
+
+        join_game_threads()
+        for process in workers:
+            process.join()
 
-        main_thread = threading.current_thread()
-        for t in threading.enumerate():
-            if t is main_thread:
-                continue
-            t.join()
+        wheel.stop()
+        game_records.close_log()
+        ratings.close_store()
 
         print("Terminated")
         logger.log(level=logging.INFO, msg="Tic-Tac-Toe Server terminated")
@@ -3,208 +3,312 @@ This module contains the game logic for the Tic-Tac-Toe server
 """
 import logging
 import socket
+import time
 
+import game_records
+import metrics
+import ratings
+from rounds import ask_players, HandoffRequested
+from timeouts import shutdown_quietly
+from ttt_bot import BotPlayer
 
-def game_thread(players, logger):
+
+# Signs of the first and second player
+SIGNS = ['X', 'O']
+
+# Directions of the lines through a cell: row, column, diagonal and anti-diagonal
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+# Games interrupted by a handoff, as pairs of the list of players and the state of the game
+handed_off = []
+
+
+def game_thread(players, logger, state=None, match=None, session=None, names=None, size=3, length=3):
     """
     This function is called when the new thread is launched. It will run a new game unless
         the players communicate otherwise
-    :param players: a list containing two player connections
+    If the game is handed off to another process, the connections are left open and stored in handed_off
+        together with the state of the game
+    :param players: a list containing two player connections, the second one can be a BotPlayer
     :param logger: The logger object to use in these functions
+    :param state: The state of a game handed off by another process, to resume it
+    :param match: The Match object to publish the updates for spectators on, or None
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param names: A list with the names of the players, None or '' for the bot and the anonymous players
+    :param size: The number of rows and columns of the board of the new games
+    :param length: The number of signs in a row needed to win the new games
     """
     try:
-        while game_loop(players, logger):
-            pass
+        while game_loop(players, logger, state, match, session, names, size, length):
+            state = None
+    except HandoffRequested as e:
+        handed_off.append((players, dict(e.state, names=names)))
+        logger.log(level=logging.INFO, msg='Thread handed off its game')
+        return
     except OSError:
         pass
     finally:
-        players[0].shutdown(socket.SHUT_RDWR)
-        players[0].close()
-        players[1].shutdown(socket.SHUT_RDWR)
-        players[1].close()
+        if match is not None:
+            match.close()
+        if session is not None:
+            session.close()
+
+    for player in players:
+        shutdown_quietly(player)
+        player.close()
 
     logger.log(level=logging.INFO, msg='Thread terminated')
 
 
-def game_has_winner(board):
+def game_has_winner(board, row, col, length=3):
     """
-    This function detects whether the current board has a winner
-    :param board: 3x3 matrix representing the board
-    :return: boolean meaning whether a player has won
+    This function detects whether the last move has completed a line. Only the four lines through the
+        cell of the move are checked, and each of them for at most length cells on either side, so the
+        cost does not depend on the size of the board
+    :param board: NxN matrix representing the board
+    :param row: The row of the last move
+    :param col: The column of the last move
+    :param length: The number of signs in a row needed to win
+    :return: boolean meaning whether the player of the last move has won
     """
+    sign = board[row][col]
+    size = len(board)
 
-    if board[0][0] == board[0][1] == board[0][2] != '-' or \
-            board[1][0] == board[1][1] == board[1][2] != '-' or \
-            board[2][0] == board[2][1] == board[2][2] != '-' or \
-            board[0][0] == board[1][0] == board[2][0] != '-' or \
-            board[0][1] == board[1][1] == board[2][1] != '-' or \
-            board[0][2] == board[1][2] == board[2][2] != '-' or \
-            board[0][0] == board[1][1] == board[2][2] != '-' or \
-            board[0][2] == board[1][1] == board[2][0] != '-':
-        return True
-
+    for dr, dc in DIRECTIONS:
+        count = 1
+        for step in [1, -1]:
+            r, c = row + step * dr, col + step * dc
+            while count < length and 0 <= r < size and 0 <= c < size and board[r][c] == sign:
+                count += 1
+                r, c = r + step * dr, c + step * dc
 
-def game_finished(board):
-    """
-    Returns if the game has ended, either because a player has won, or because there are no free spaces left
-    :param board: 3x3 matrix representing the board
-    :return: boolean meaning whether the game has neded
-    """
+        if count >= length:
+            return True
 
-    if game_has_winner(board):
-        return True
+    return False
 
-    for row in board:
-        for cell in row:
-            if cell == '-':
-                return False
 
-    return True
+def board_to_string(board):
+    """
+    :param board: NxN matrix representing the board
+    :return: The string showing the board to the players, one row per line
+    """
+    return ''.join(' '.join(row) + '\n' for row in board)
 
 
-def game_loop(players, logger):
+def game_loop(players, logger, state=None, match=None, session=None, names=None, size=3, length=3):
     """
-    This function executes a single game of Tic-Tac-Toe.
+    This function executes a single game of Tic-Tac-Toe, on a board of size x size cells where length
+        signs in a row are needed to win (3 and 3 for the classic game, 15 and 5 for Gomoku).
     Each turn player_1 is shown the current board and asked for their move. The same then happens for
         player_2. This happens until one player wins or the board is full.
     Then, both players are asked if they want to play again. If both want to then True
         is returned
     :param players: a list containing two player connections
     :param logger: The logger object to use in these functions
-    :return: A bool representing whether the players want to play again
+    :param state: The state of a game handed off by another process, to resume it. It is a dictionary with
+        the 'phase' of the game ('move' or 'again'); for the 'move' phase the 'board' as a string of
+        size x size characters, its 'size', the 'length' of the winning lines, the index of the player
+        to move in 'turn', and the 'moves', the time the game
+        'started' and the 'think' time of the players for its record; for the 'again' phase the
+        'outcomes', the 'notes' with the new ratings and the 'answers' already received
+    :param match: The Match object to publish the updates for spectators on, or None
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param names: A list with the names of the players, the game is rated only if both have one
+    :param size: The number of rows and columns of the board, for a new game
+    :param length: The number of signs in a row needed to win, for a new game
+    :return: A bool representing whether the players want to play again. If False, the connections
+        must be closed by the caller
+    :raises HandoffRequested: if the game has to be handed off to another process, with its state
     """
-    board = [
-        ['-', '-', '-'],
-        ['-', '-', '-'],
-        ['-', '-', '-']
-    ]
+    resume = state is not None
+    if not resume:
+        state = {'phase': 'move', 'board': '-' * (size * size), 'size': size, 'length': length, 'turn': 0}
+
+    if state['phase'] == 'move':
+        size = state.get('size', 3)
+        length = state.get('length', 3)
+        board = [list(state['board'][i:i + size]) for i in range(0, size * size, size)]
+        turn = state['turn']
+
+        # the game is drawn when the last free cell is taken without completing a line
+        free = state['board'].count('-')
+
+        # the record of the game, the moves are stored as the index of the cell
+        moves = state.get('moves', [])
+        started = state.get('started', time.time())
+        think = state.get('think', [0.0, 0.0])
+        against_bot = isinstance(players[1], BotPlayer)
+
+        winner = 0
+        loser = 0
+
+        if match is not None:
+            match.publish(f'Current board:\n{board_to_string(board)}')
+
+        while free > 0:
+
+            # Ask the current player for their move
+            asked = time.monotonic()
+            try:
+                move = ask_for_move(players[turn], board, SIGNS[turn], resume, session)
+            except (socket.timeout, socket.error) as e:
+                logger.log(level=logging.WARN, msg=f'Game terminated, player {turn + 1} not responding: {e}')
+                metrics.game_terminated(e)
+                game_records.record(game_records.TIC_TAC_TOE,
+                                    game_records.TIMED_OUT if isinstance(e, socket.timeout) else game_records.ABORTED,
+                                    started, moves, think, size, against_bot)
+                return False
+            except HandoffRequested as e:
+                think[turn] += time.monotonic() - asked
+                e.state = {'phase': 'move', 'board': ''.join(''.join(row) for row in board), 'size': size,
+                           'length': length, 'turn': turn, 'moves': moves, 'started': started, 'think': think}
+                raise
 
-    p1 = players[0]
-    p2 = players[1]
+            think[turn] += time.monotonic() - asked
+            moves.append(move[0] * size + move[1])
 
-    winner = 0
-    loser = 0
+            resume = False
+            board[move[0]][move[1]] = SIGNS[turn]
+            free -= 1
 
-    while not game_finished(board):
+            if match is not None:
+                match.publish(f'{SIGNS[turn]} played {move_to_string(move, size)}\n{board_to_string(board)}')
 
-        # Ask player_1 for their move
-        try:
-            p1_move = ask_for_move(p1, board, 'X')
-        except (socket.timeout, socket.error):
-            logger.log(level=logging.WARN, msg='Game terminated, player 1 not responding')
-            p1.shutdown(socket.SHUT_RDWR)
-            p1.close()
-            p2.shutdown(socket.SHUT_RDWR)
-            p2.close()
-            return False
-
-        board[p1_move[0]][p1_move[1]] = 'X'
-
-        if game_has_winner(board):
-            winner = 1
-            loser = 2
-            break
-        elif game_finished(board):
-            break
-
-        # Ask player_2 for their move
-        try:
-            p2_move = ask_for_move(p2, board, 'O')
-        except (socket.timeout, socket.error):
-            logger.log(level=logging.WARN, msg='Game terminated, player 2 not responding')
-            p1.shutdown(socket.SHUT_RDWR)
-            p1.close()
-            p2.shutdown(socket.SHUT_RDWR)
-            p2.close()
-            return False
-
-        board[p2_move[0]][p2_move[1]] = 'O'
-
-        if game_has_winner(board):
-            winner = 2
-            loser = 1
-            break
-        elif game_finished(board):
-            break
+            if game_has_winner(board, move[0], move[1], length):
+                winner = turn + 1
+                loser = 2 - turn
+                break
+
+            turn = 1 - turn
+
+        metrics.GAMES_COMPLETED.add()
+        game_records.record(game_records.TIC_TAC_TOE,
+                            [game_records.DRAW, game_records.PLAYER_1, game_records.PLAYER_2][winner],
+                            started, moves, think, size, against_bot)
+
+        if match is not None:
+            match.publish('The game was drawn!\n' if winner == 0 else f'{SIGNS[winner - 1]} won!\n')
 
-    try:
         if winner == 0:
-            winner_dec = play_again(p1, 'D')
-            loser_dec = play_again(p2, 'D')
+            outcomes = ['D', 'D']
         else:
-            winner_dec = play_again(players[winner - 1], 'W')
-            loser_dec = play_again(players[loser - 1], 'L')
-    except (socket.timeout, socket.error):
-        logger.log(level=logging.WARN, msg='Game terminated, players not responding')
-        p1.shutdown(socket.SHUT_RDWR)
-        p1.close()
-        p2.shutdown(socket.SHUT_RDWR)
-        p2.close()
+            outcomes = [None, None]
+            outcomes[winner - 1] = 'W'
+            outcomes[loser - 1] = 'L'
+        notes = ratings.rate_game(names, [0.5, 1, 0][winner])
+        answers = None
+    else:
+        outcomes = state['outcomes']
+        notes = state.get('notes')
+        answers = state['answers']
+
+    # Ask both players if they want to play again
+    try:
+        p1_dec, p2_dec = play_again(players, outcomes, answers, resume, session, notes)
+    except (socket.timeout, socket.error) as e:
+        logger.log(level=logging.WARN, msg=f'Game terminated, {e}')
+        metrics.game_terminated(e)
         return False
+    except HandoffRequested as e:
+        e.state = {'phase': 'again', 'outcomes': outcomes, 'notes': notes, 'answers': e.answers}
+        raise
 
-    return (winner_dec == loser_dec) and (winner_dec == 'yes')
+    return (p1_dec == p2_dec) and (p1_dec == 'yes')
 
 
-def play_again(player, winner):
+def play_again(players, outcomes, answers=None, resume=False, session=None, notes=None):
     """
-    This function asks a player whether they want to play another game.
-    :param player: A socket connection
-    :param winner: A one charcter string representing the end condition of the game ('W': winner, 'L': loser, 'D', draw)
-    :return: A string representing their decision
+    This function asks both players at the same time whether they want to play another game.
+    :param players: A list containing two player connections
+    :param outcomes: A list of two one charcter strings representing the end condition of the game for
+        each player ('W': winner, 'L': loser, 'D', draw)
+    :param answers: The answers already received before a handoff, if the question is being resumed
+    :param resume: True if the question was interrupted by a handoff
+    :param session: The Session enforcing the deadlines of the game, or None
+    :param notes: An optional list of two strings shown to each player before the question, like their
+        new rating
+    :return: A list of two strings representing their decisions
     """
-    while True:
-        message = ''
-        match winner:
+
+    def prompt(i, error):
+        message = notes[i] if notes is not None and not error else ''
+        match outcomes[i]:
             case 'W':
-                message = 'You won! Do you want to play again? [yes, no] '
+                message += 'You won! Do you want to play again? [yes, no] '
             case 'L':
-                message = 'You lost! Do you want to play again? [yes, no] '
+                message += 'You lost! Do you want to play again? [yes, no] '
             case 'D':
-                message = 'The game was drawn! Do you want to play again? [yes, no] '
-
-        player.sendall(message.encode())
-
-        response = player.recv(1024).decode().strip()
+                message += 'The game was drawn! Do you want to play again? [yes, no] '
+        return message
 
+    def parse(i, response):
         if response in ['yes', 'no']:
             return response
 
+    if answers is None:
+        answers = [p.play_again() if isinstance(p, BotPlayer) else None for p in players]
+
+    return ask_players(players, prompt, parse, answers=answers, resume=resume, session=session)
 
-def ask_for_move(player, board, sign):
+
+def move_to_string(move, size):
+    """
+    :param move: A pair of integers representing the row and column of a move
+    :param size: The number of rows and columns of the board
+    :return: The move as the players type it: row and column digits on boards up to 9x9 ('13'), and
+        separated by a space on larger boards ('8 12')
+    """
+    if size <= 9:
+        return f'{move[0] + 1}{move[1] + 1}'
+    return f'{move[0] + 1} {move[1] + 1}'
+
+
+def ask_for_move(player, board, sign, resume=False, session=None):
     """
     This function shows the current board to a player and asks for their move for
         the current turn
     :param sign: The sign of the current player
     :param player: A socket connection
-    :param board: A 3x3 matrix representing the board
+    :param board: An NxN matrix representing the board
+    :param resume: True if the move was asked before a handoff, and the player has not answered yet
+    :param session: The Session enforcing the deadlines of the game, or None
     :return: A pair of integers representing the row and column of the valid move
     """
+    if isinstance(player, BotPlayer):
+        return player.choose_move(board)
 
-    error = False
+    size = len(board)
+    if size == 3:
+        accepted = '11, 12, 13, 21, ... , 32, 33'
+    else:
+        accepted = f'{move_to_string((0, 0), size)}, {move_to_string((0, 1), size)}, ... , ' \
+                   f'{move_to_string((size - 1, size - 1), size)}'
 
-    while True:
+    def prompt(i, error):
         if error:
             error_string = 'Invalid move!\n'
         else:
             error_string = ''
 
-        player.sendall(f'{error_string}Your sign: {sign}\nCurrent board:\n'
-                       f'{board[0][0]} {board[0][1]} {board[0][2]}\n'
-                       f'{board[1][0]} {board[1][1]} {board[1][2]}\n'
-                       f'{board[2][0]} {board[2][1]} {board[2][2]}\n'
-                       f'Your move: [11, 12, 13, 21, ... , 32, 33] '.encode())
-
-        move = player.recv(1024).decode().strip()
+        return f'{error_string}Your sign: {sign}\nCurrent board:\n{board_to_string(board)}' \
+               f'Your move: [{accepted}] '
 
+    def parse(i, move):
         try:
-            row = int(move[0]) - 1
-            col = int(move[1]) - 1
-
-            # if cell is already taken
-            if board[row][col] == '-':
+            # row and column are either two digits, or two numbers separated by spaces
+            parts = move.split()
+            if len(parts) == 1 and len(move) == 2:
+                parts = list(move)
+            row, col = [int(part) - 1 for part in parts]
+
+            # if cell is on the board and not already taken
+            if 0 <= row < size and 0 <= col < size and board[row][col] == '-':
                 return row, col
-        except (IndexError, ValueError):
+        except ValueError:
             pass
-        finally:
-            # either the spot is already taken or the move is invalid (not int, or out of bounds)
-            error = True
+
+        # either the spot is already taken or the move is invalid (not int, or out of bounds)
+        return None
+
+    return ask_players([player], prompt, parse, resume=resume, session=session)[0]
@@ -0,0 +1,361 @@
+"""
+Script that measures the performance of the whole system on localhost when executed, and compares it with
+    stored baselines
+A broker and the requested number of Tic-Tac-Toe and Rock-Paper-Scissors servers are started as separate
+    processes, in a temporary directory that holds their logs. Then the suite measures:
+    - how long the servers take to appear on the broker after starting
+    - the latency of the broker queries
+    - the games per second played by the simulated players of load_generator.py, that discover the
+      servers through the broker, and the memory the servers use for each of them
+    - how long the servers take to register again after the broker is restarted
+Each result is compared with the baseline of the same metric, and the script exits with status 1 if any
+    of them is worse than the baseline by more than its tolerance. The baselines depend on the machine,
+    so they are recorded with --save on the machine running the suite
+Usage: python benchmark.py [--ttt <n>] [--rps <n>] [--players <n>] [--duration <s>] [--save]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import load_generator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BROKER = os.path.join(ROOT, 'Broker', 'broker.py')
+SERVERS = {'ttt': os.path.join(ROOT, 'TicTacToeServer', 'ttt_server.py'),
+           'rps': os.path.join(ROOT, 'RockPaperScissorsServer', 'rps_server.py')}
+
+DEFAULT_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# The metrics, whether lower values are better, and the default tolerance: the relative change from the
+#   baseline accepted before reporting a regression, and the absolute change always accepted, since the
+#   smallest values are dominated by the noise of the machine. The servers register again at their next
+#   registration, so the restart convergence varies between 0 and the REGISTRATION_INTERVAL of 2 s
+METRICS = {
+    'startup_convergence_s': {'lower': True, 'tolerance': 0.5, 'slack': 0.5},
+    'discovery_p50_ms': {'lower': True, 'tolerance': 0.5, 'slack': 0.2},
+    'discovery_p99_ms': {'lower': True, 'tolerance': 1.0, 'slack': 1.0},
+    'games_per_second': {'lower': False, 'tolerance': 0.25, 'slack': 0},
+    'move_latency_p99_ms': {'lower': True, 'tolerance': 0.5, 'slack': 5},
+    'memory_per_session_kib': {'lower': True, 'tolerance': 0.5, 'slack': 4},
+    'restart_convergence_s': {'lower': True, 'tolerance': 0.5, 'slack': 2.5},
+    'errors': {'lower': True, 'tolerance': 0, 'slack': 0},
+}
+
+# Seconds to wait for the servers to register, and for a process to terminate after SIGINT
+READY_TIMEOUT = 30
+STOP_TIMEOUT = 10
+
+# Queries sent to measure the latency of the broker
+DISCOVERY_QUERIES = 1000
+
+
+class System:
+    """
+    This class starts and stops the processes of the system, all on localhost
+    """
+
+    def __init__(self, options, directory):
+        """
+        :param options: The parsed command line options
+        :param directory: The working directory of the processes, where their logs are written
+        """
+        self.directory = directory
+        self.broker_port = options.base_port
+        self.interval = options.interval
+        self.broker = None
+        self.servers = []  # the Popen of each server, in the order of names
+
+        port = options.base_port + 1
+        self.names = []
+        for kind, count in [('ttt', options.ttt), ('rps', options.rps)]:
+            for i in range(count):
+                self.names.append((f'bench-{kind}-{i}', kind, port))
+                port += 1
+
+    def start_broker(self):
+        self.broker = self._spawn([BROKER, str(self.broker_port)], {})
+
+    def start_servers(self):
+        env = {'REGISTRATION_INTERVAL': str(self.interval)}
+        for name, kind, port in self.names:
+            self.servers.append(self._spawn([SERVERS[kind], name, '127.0.0.1', str(port), '127.0.0.1',
+                                             str(self.broker_port)], env))
+
+    def stop_broker(self):
+        _stop(self.broker)
+        self.broker = None
+
+    def stop(self):
+        for process in self.servers + [self.broker]:
+            if process is not None:
+                _stop(process)
+
+    def server_pids(self):
+        return [process.pid for process in self.servers]
+
+    def registered(self):
+        """
+        :return: The number of servers of this system listed by the broker, or None if it does not answer
+        """
+        servers = query(('127.0.0.1', self.broker_port), 1)
+        if servers is None:
+            return None
+        expected = {name for name, _, _ in self.names}
+        return len(expected.intersection(servers))
+
+    def wait_registered(self):
+        """
+        :return: The seconds taken until the broker lists all the servers
+        """
+        start = time.monotonic()
+        while self.registered() != len(self.names):
+            if time.monotonic() - start > READY_TIMEOUT:
+                raise TimeoutError(f'The servers did not register within {READY_TIMEOUT} s')
+            time.sleep(0.05)
+        return time.monotonic() - start
+
+    def _spawn(self, args, env):
+        log = open(os.path.join(self.directory, f'{os.path.basename(args[0])}-{len(self.servers)}.out'), 'a')
+        return subprocess.Popen([sys.executable] + args, cwd=self.directory, env=dict(os.environ, **env),
+                                stdout=log, stderr=subprocess.STDOUT)
+
+
+def _stop(process):
+    """
+    Terminates a process like the user would, with SIGINT, and kills it if it does not terminate
+    """
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def query(broker, timeout):
+    """
+    :return: The names of the servers registered on the broker, or None if it does not answer
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(b'query\n', broker)
+            received = sock.recv(65536).decode()
+        except OSError:
+            return None
+    if received == 'empty':
+        return []
+    return [entry.split('|')[0] for entry in received.split('$')]
+
+
+def rss_kib(pid):
+    """
+    :return: The resident memory of a process in KiB, read from /proc, or None if it is not available
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if len(values) > 0 else 0
+
+
+def measure_discovery(broker):
+    """
+    :return: The 50th and 99th percentile of the latency of the broker queries, in milliseconds
+    """
+    latencies = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        for _ in range(DISCOVERY_QUERIES):
+            start = time.perf_counter()
+            sock.sendto(b'query\n', broker)
+            sock.recv(65536)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+async def measure_load(options, broker, pids):
+    """
+    Plays games with the players of load_generator.py, discovering the servers through the broker
+    :return: The Stats of load_generator, the seconds elapsed, and the peak of the total resident memory
+        of the servers in KiB
+    """
+    load = argparse.Namespace(server=None, broker=broker, players=options.players, duration=options.duration,
+                              ramp=options.ramp, think=load_generator.think_time(options.think),
+                              invalid=0.05, rematch=0.5, bot=False, timeout=30)
+    stats = load_generator.Stats()
+    start = time.monotonic()
+    end = start + options.duration
+    peak = 0
+
+    async def sample_memory():
+        nonlocal peak
+        while True:
+            peak = max(peak, sum(rss_kib(pid) or 0 for pid in pids))
+            await asyncio.sleep(0.2)
+
+    seed = random.Random(options.seed)
+    players = [load_generator.player(i, random.Random(seed.random()), load, stats, end)
+               for i in range(options.players)]
+
+    sampler = asyncio.create_task(sample_memory())
+    try:
+        await asyncio.gather(*players)
+    finally:
+        sampler.cancel()
+
+    return stats, time.monotonic() - start, peak, load
+
+
+def run(options):
+    """
+    Runs the whole suite
+    :return: A dict with the value of each metric
+    """
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    system = System(options, directory)
+    broker = ('127.0.0.1', options.base_port)
+    results = {}
+
+    try:
+        system.start_broker()
+        while system.registered() is None:
+            time.sleep(0.05)
+
+        print(f'Starting {options.ttt} Tic-Tac-Toe and {options.rps} Rock-Paper-Scissors servers')
+        system.start_servers()
+        results['startup_convergence_s'] = system.wait_registered()
+
+        print(f'Sending {DISCOVERY_QUERIES} queries to the broker')
+        results['discovery_p50_ms'], results['discovery_p99_ms'] = measure_discovery(broker)
+
+        print(f'Playing with {options.players} players for {options.duration:g} s')
+        idle = sum(rss_kib(pid) or 0 for pid in system.server_pids())
+        stats, elapsed, peak, load = asyncio.run(measure_load(options, broker, system.server_pids()))
+        results['games_per_second'] = load_generator.games(stats, load) / elapsed
+        results['move_latency_p99_ms'] = percentile(stats.move_latency, 0.99) * 1000
+        results['memory_per_session_kib'] = max(peak - idle, 0) / options.players
+        results['errors'] = sum(stats.errors.values())
+
+        print('Restarting the broker')
+        system.stop_broker()
+        system.start_broker()
+        results['restart_convergence_s'] = system.wait_registered()
+    finally:
+        system.stop()
+        if options.keep:
+            print(f'Logs kept in {directory}')
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def configuration(options):
+    """
+    :return: The options that change the results, a baseline is only valid for the same configuration
+    """
+    return {'ttt': options.ttt, 'rps': options.rps, 'players': options.players, 'duration': options.duration,
+            'ramp': options.ramp, 'think': options.think, 'interval': options.interval, 'seed': options.seed}
+
+
+def compare(results, baselines):
+    """
+    Prints the results next to their baselines
+    :return: The list of the metrics that regressed
+    """
+    regressions = []
+
+    print(f'\n{"Metric":<26} {"Value":>12} {"Baseline":>12} {"Change":>9}')
+    for metric, value in results.items():
+        settings = dict(METRICS[metric], **baselines.get('tolerances', {}).get(metric, {}))
+        baseline = baselines.get('metrics', {}).get(metric)
+
+        if baseline is None:
+            print(f'{metric:<26} {value:>12.3f} {"-":>12} {"":>9}')
+            continue
+
+        change = (value - baseline) / baseline if baseline != 0 else 0
+        worse = value - baseline if settings['lower'] else baseline - value
+        regressed = worse > settings['slack'] and worse > settings['tolerance'] * abs(baseline)
+        if regressed:
+            regressions.append(metric)
+
+        print(f'{metric:<26} {value:>12.3f} {baseline:>12.3f} {change:>+8.0%}{"  REGRESSION" if regressed else ""}')
+
+    return regressions
+
+
+def main(options):
+    baselines = {}
+    if os.path.exists(options.baselines):
+        with open(options.baselines) as f:
+            baselines = json.load(f)
+
+    if baselines and not options.save and baselines.get('configuration') != configuration(options):
+        print(f'The baselines in {options.baselines} were recorded with a different configuration: '
+              f'{baselines.get("configuration")}', file=sys.stderr)
+        exit(2)
+
+    results = run(options)
+
+    if options.save:
+        # the tolerances edited in the file are kept
+        baselines = {'configuration': configuration(options),
+                     'metrics': {metric: round(value, 3) for metric, value in results.items()},
+                     'tolerances': baselines.get('tolerances', {})}
+        with open(options.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2)
+            f.write('\n')
+        compare(results, {})
+        print(f'\nBaselines saved to {options.baselines}')
+        return
+
+    regressions = compare(results, baselines)
+    if len(regressions) > 0:
+        print(f'\n{len(regressions)} regressions: {", ".join(regressions)}')
+        exit(1)
+    print('\nNo regressions' if baselines else '\nNo baselines to compare with, run with --save to record them')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end performance suite of the broker and the game servers')
+    parser.add_argument('--ttt', type=int, default=2, help='number of Tic-Tac-Toe servers (default 2)')
+    parser.add_argument('--rps', type=int, default=2, help='number of Rock-Paper-Scissors servers (default 2)')
+    parser.add_argument('--players', type=int, default=200, help='number of concurrent players (default 200)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of play (default 20)')
+    parser.add_argument('--ramp', type=float, default=2, help='seconds over which the players start (default 2)')
+    parser.add_argument('--think', default='const:0.05',
+                        help='think time distribution of the players, as in load_generator.py (default const:0.05)')
+    parser.add_argument('--interval', type=float, default=2,
+                        help='REGISTRATION_INTERVAL of the servers, in seconds (default 2)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random choices of the players (default 1)')
+    parser.add_argument('--base-port', type=int, default=23000,
+                        help='port of the broker, the servers use the following ones (default 23000)')
+    parser.add_argument('--baselines', default=DEFAULT_BASELINES,
+                        help='JSON file with the baselines (default Tools/benchmark_baselines.json)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baselines')
+    parser.add_argument('--keep', action='store_true', help='keep the logs of the processes')
+    options = parser.parse_args()
+
+    load_generator.raise_file_limit(options.players)
+    main(options)
@@ -0,0 +1,474 @@
+"""
+Script that forwards UDP and TCP traffic between the entities when executed, injecting network faults
+Each proxied port listens locally and forwards to a target: the clients or the game servers are pointed at
+    the proxy instead of the broker, or the load generator at the proxy instead of a game server. The
+    faults are drawn independently for every datagram, or every chunk of a TCP stream:
+    - loss, duplication and reordering of UDP datagrams
+    - delay, jitter and latency spikes, in both protocols. A TCP stream is never reordered, a chunk waits
+      for the previous ones
+    - resets of TCP connections, both sides are closed at once as if the connection was lost
+Every few seconds and at the end, the traffic, the faults injected and the fate of the TCP connections
+    are reported for each proxied port. With --watch the registry of a broker is queried at every report,
+    to count how many servers dropped out of it and came back under these conditions
+Usage: python fault_proxy.py --udp <port>=<host>:<port> --tcp <port>=<host>:<port> [--loss <p>] ...
+"""
+import argparse
+import asyncio
+import collections
+import random
+import socket
+import struct
+import sys
+import time
+
+import load_generator
+
+# Seconds a reordered datagram is held back, so that the following ones overtake it
+REORDER_HOLD = 0.05
+
+# Seconds after which the upstream socket of a UDP peer that sent nothing is closed
+UDP_IDLE = 60
+
+# Bytes read at once from a TCP connection
+CHUNK = 4096
+
+
+class Faults:
+    """
+    This class draws the faults to inject, from a seeded random generator so that runs can be repeated
+    """
+
+    def __init__(self, options):
+        self.rng = random.Random(options.seed)
+        self.loss = options.loss
+        self.duplicate = options.duplicate
+        self.reorder = options.reorder
+        self.reset = options.reset
+        self.delay = options.delay / 1000
+        self.jitter = options.jitter / 1000
+        self.spike_probability, self.spike = options.spike
+
+    def happens(self, probability):
+        return probability > 0 and self.rng.random() < probability
+
+    def latency(self):
+        """
+        :return: The seconds a datagram or chunk is delayed, and whether it hit a latency spike
+        """
+        spiked = self.happens(self.spike_probability)
+        seconds = self.delay + self.rng.uniform(0, self.jitter) + (self.spike if spiked else 0)
+        return seconds, spiked
+
+
+class Stats:
+    """
+    This class counts the traffic and the faults of a proxied port
+    """
+
+    def __init__(self, protocol, port, target):
+        self.protocol = protocol
+        self.port = port
+        self.target = target
+        self.counts = collections.Counter()
+        self.closed = collections.Counter()  # how the TCP connections ended
+        self.delays = []  # seconds each datagram or chunk was held by the proxy
+        self.durations = []  # seconds each TCP connection lasted
+
+    def forwarded(self, size, delay):
+        self.counts['forwarded'] += 1
+        self.counts['bytes'] += size
+        self.delays.append(delay)
+
+
+class UDPProxy(asyncio.DatagramProtocol):
+    """
+    This class forwards the datagrams received on a port to the target, each peer through its own upstream
+        socket so that the answers can be sent back to it from the proxied port
+    """
+
+    def __init__(self, target, faults, stats):
+        self.target = target
+        self.faults = faults
+        self.stats = stats
+        self.transport = None
+        self.upstreams = {}  # the _Upstream of each peer
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stats.counts['received'] += 1
+        upstream = self.upstreams.get(addr)
+
+        if upstream is None:
+            upstream = _Upstream(self, addr)
+            self.upstreams[addr] = upstream
+            asyncio.get_running_loop().create_task(self._open(upstream))
+
+        upstream.last = time.monotonic()
+        upstream.send(data)
+
+    async def _open(self, upstream):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_datagram_endpoint(lambda: upstream, remote_addr=self.target)
+        except OSError:
+            self.stats.counts['errors'] += 1
+            self.upstreams.pop(upstream.peer, None)
+
+    def send(self, data, send):
+        """
+        Forwards a datagram after injecting the faults
+        :param data: The bytes of the datagram
+        :param send: A function sending bytes to the destination
+        """
+        if self.faults.happens(self.faults.loss):
+            self.stats.counts['lost'] += 1
+            return
+
+        copies = 2 if self.faults.happens(self.faults.duplicate) else 1
+        if copies > 1:
+            self.stats.counts['duplicated'] += 1
+
+        loop = asyncio.get_running_loop()
+        for _ in range(copies):
+            delay, spiked = self.faults.latency()
+            if spiked:
+                self.stats.counts['spikes'] += 1
+            if self.faults.happens(self.faults.reorder):
+                self.stats.counts['reordered'] += 1
+                delay += REORDER_HOLD
+
+            self.stats.forwarded(len(data), delay)
+            if delay > 0:
+                loop.call_later(delay, send, data)
+            else:
+                send(data)
+
+    def expire(self):
+        """
+        Closes the upstream sockets of the peers that have been idle for UDP_IDLE seconds
+        """
+        now = time.monotonic()
+        for addr, upstream in list(self.upstreams.items()):
+            if now - upstream.last > UDP_IDLE:
+                self.upstreams.pop(addr)
+                if upstream.transport is not None:
+                    upstream.transport.close()
+
+
+class _Upstream(asyncio.DatagramProtocol):
+    """
+    The socket connected to the target on behalf of one peer of a UDPProxy
+    """
+
+    def __init__(self, proxy, peer):
+        self.proxy = proxy
+        self.peer = peer
+        self.transport = None
+        self.pending = []  # the datagrams received from the peer before the socket was open
+        self.last = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for data in self.pending:
+            self.send(data)
+        self.pending = []
+
+    def send(self, data):
+        """
+        Forwards a datagram of the peer to the target
+        """
+        if self.transport is None:
+            self.pending.append(data)
+        else:
+            self.proxy.send(data, self._to_target)
+
+    def datagram_received(self, data, addr):
+        self.proxy.stats.counts['answers'] += 1
+        self.proxy.send(data, self._to_peer)
+
+    def error_received(self, exc):
+        # the target is not listening, the peer will time out as it would without the proxy
+        self.proxy.stats.counts['errors'] += 1
+
+    def _to_target(self, data):
+        if not self.transport.is_closing():
+            self.transport.sendto(data)
+
+    def _to_peer(self, data):
+        if not self.proxy.transport.is_closing():
+            self.proxy.transport.sendto(data, self.peer)
+
+
+class TCPProxy:
+    """
+    This class forwards the connections accepted on a port to the target, chunk by chunk in both directions
+    """
+
+    def __init__(self, target, faults, stats):
+        self.target = target
+        self.faults = faults
+        self.stats = stats
+
+    async def handle(self, client_reader, client_writer):
+        self.stats.counts['connections'] += 1
+        start = time.monotonic()
+
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError:
+            self.stats.closed['target unreachable'] += 1
+            client_writer.close()
+            return
+
+        reset = asyncio.Event()
+        directions = [asyncio.create_task(self._pipe(client_reader, server_writer, reset, 'client')),
+                      asyncio.create_task(self._pipe(server_reader, client_writer, reset, 'server'))]
+        reset_task = asyncio.create_task(reset.wait())
+
+        # the connection ends when either side closes it, or when the proxy resets it
+        done, _ = await asyncio.wait(directions + [reset_task], return_when=asyncio.FIRST_COMPLETED)
+
+        if reset_task in done:
+            self.stats.closed['reset by the proxy'] += 1
+            for writer in [client_writer, server_writer]:
+                _abort(writer)
+        else:
+            self.stats.closed[f'closed by the {next(iter(done)).result()}'] += 1
+            # the other direction still delivers the chunks it holds, then closes
+            await asyncio.wait(directions, timeout=self.faults.delay + self.faults.jitter + self.faults.spike + 1)
+
+        for task in directions + [reset_task]:
+            task.cancel()
+        for writer in [client_writer, server_writer]:
+            writer.close()
+        self.stats.durations.append(time.monotonic() - start)
+
+    async def _pipe(self, reader, writer, reset, side):
+        """
+        Forwards the chunks read from one side to the other, keeping their order
+        :return: The side that closed the connection
+        """
+        loop = asyncio.get_running_loop()
+        deliveries = asyncio.Queue()
+        sender = asyncio.create_task(self._deliver(deliveries, writer))
+
+        try:
+            while True:
+                try:
+                    data = await reader.read(CHUNK)
+                except OSError:
+                    data = b''
+                if not data:
+                    break
+
+                self.stats.counts['received'] += 1
+                if self.faults.happens(self.faults.reset):
+                    # the chunks not delivered yet are lost with the connection
+                    reset.set()
+                    return side
+
+                delay, spiked = self.faults.latency()
+                if spiked:
+                    self.stats.counts['spikes'] += 1
+                self.stats.forwarded(len(data), delay)
+                await deliveries.put((loop.time() + delay, data))
+
+            await deliveries.put(None)
+            await sender
+        finally:
+            sender.cancel()
+        return side
+
+    @staticmethod
+    async def _deliver(deliveries, writer):
+        """
+        Writes the chunks at their delivery time, a chunk never overtakes the previous one
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await deliveries.get()
+            if item is None:
+                if writer.can_write_eof():
+                    writer.write_eof()
+                return
+
+            at, data = item
+            if at > loop.time():
+                await asyncio.sleep(at - loop.time())
+            writer.write(data)
+            try:
+                await writer.drain()
+            except OSError:
+                return
+
+
+def _abort(writer):
+    """
+    Closes a connection with a RST instead of a FIN, as a lost connection is seen by the other side
+    """
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+    writer.transport.abort()
+
+
+class Watcher:
+    """
+    This class queries the registry of a broker, and counts the servers that drop out of it and come back
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.servers = None
+        self.dropped = 0
+        self.returned = 0
+        self.unanswered = 0
+
+    async def check(self):
+        try:
+            servers = set(await load_generator.query_broker(self.broker, 1))
+        except (OSError, asyncio.TimeoutError, ValueError):
+            self.unanswered += 1
+            return
+
+        if self.servers is not None:
+            self.dropped += len(self.servers - servers)
+            self.returned += len(servers - self.servers)
+        self.servers = servers
+
+    def report(self):
+        listed = len(self.servers) if self.servers is not None else 0
+        return f'Broker {self.broker[0]}:{self.broker[1]}: {listed} servers listed, {self.dropped} dropped out, ' \
+               f'{self.returned} appeared, {self.unanswered} queries unanswered'
+
+
+def report(proxies, watcher, elapsed):
+    print(f'--- {elapsed:.0f} s')
+    for stats in proxies:
+        counts = stats.counts
+        rate = counts['forwarded'] / elapsed if elapsed > 0 else 0
+        line = f'{stats.protocol.upper()} {stats.port} -> {stats.target[0]}:{stats.target[1]}: ' \
+               f'{counts["forwarded"]} forwarded ({rate:.1f}/s, {counts["bytes"]} bytes)'
+
+        if stats.protocol == 'udp':
+            line += f', {counts["answers"]} answers, {counts["lost"]} lost, {counts["duplicated"]} duplicated, ' \
+                    f'{counts["reordered"]} reordered'
+        else:
+            ends = ', '.join(f'{count} {end}' for end, count in stats.closed.most_common())
+            line += f', {counts["connections"]} connections ({ends or "none ended"})'
+        line += f', {counts["spikes"]} latency spikes, {counts["errors"]} errors'
+        print(line)
+
+        print(f'    added latency: {load_generator.percentiles(stats.delays)}')
+        if stats.protocol == 'tcp' and len(stats.durations) > 0:
+            print(f'    connection duration: {load_generator.percentiles(stats.durations)}')
+
+    if watcher is not None:
+        print(watcher.report())
+    sys.stdout.flush()
+
+
+def mapping(text):
+    """
+    :param text: A string formatted as '<port>=<host>:<port>'
+    :return: The pair of the local port and the target address
+    """
+    port, separator, target = text.partition('=')
+    if not separator or not port.isdigit():
+        raise argparse.ArgumentTypeError(f'Invalid mapping {text}, the format is <port>=<host>:<port>')
+    return int(port), load_generator.address(target)
+
+
+def probability(text):
+    value = float(text)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError(f'Invalid probability {text}')
+    return value
+
+
+def spike(text):
+    """
+    :param text: A string formatted as '<probability>:<ms>'
+    :return: The pair of the probability and the seconds of a latency spike
+    """
+    value, _, ms = text.partition(':')
+    try:
+        return probability(value), float(ms) / 1000
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid spike {text}, the format is <probability>:<ms>')
+
+
+async def main(options):
+    loop = asyncio.get_running_loop()
+    faults = Faults(options)
+    proxies = []
+    udp = []
+
+    for port, target in options.udp:
+        stats = Stats('udp', port, target)
+        proxy = UDPProxy(target, faults, stats)
+        await loop.create_datagram_endpoint(lambda: proxy, local_addr=(options.host, port))
+        proxies.append(stats)
+        udp.append(proxy)
+
+    for port, target in options.tcp:
+        stats = Stats('tcp', port, target)
+        await asyncio.start_server(TCPProxy(target, faults, stats).handle, options.host, port)
+        proxies.append(stats)
+
+    watcher = Watcher(options.watch) if options.watch is not None else None
+    print(f'Proxying {len(proxies)} ports, press Ctrl+C to stop')
+
+    start = time.monotonic()
+    try:
+        while options.duration is None or time.monotonic() - start < options.duration:
+            await asyncio.sleep(options.report if options.duration is None
+                                else min(options.report, options.duration - (time.monotonic() - start)))
+            for proxy in udp:
+                proxy.expire()
+            if watcher is not None:
+                await watcher.check()
+            report(proxies, watcher, time.monotonic() - start)
+    except asyncio.CancelledError:
+        report(proxies, watcher, time.monotonic() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UDP and TCP proxy injecting loss, latency and resets')
+    parser.add_argument('--udp', type=mapping, action='append', default=[],
+                        help='UDP port to proxy, as <port>=<host>:<port> (repeatable), for example a broker')
+    parser.add_argument('--tcp', type=mapping, action='append', default=[],
+                        help='TCP port to proxy, as <port>=<host>:<port> (repeatable), for example a game server')
+    parser.add_argument('--host', default='127.0.0.1', help='address the proxied ports listen on (default 127.0.0.1)')
+    parser.add_argument('--loss', type=probability, default=0, help='probability of dropping a UDP datagram')
+    parser.add_argument('--duplicate', type=probability, default=0,
+                        help='probability of sending a UDP datagram twice')
+    parser.add_argument('--reorder', type=probability, default=0,
+                        help=f'probability of holding a UDP datagram back {REORDER_HOLD * 1000:g} ms, so that the '
+                             f'following ones overtake it')
+    parser.add_argument('--delay', type=float, default=0, help='milliseconds added to every datagram and chunk')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='maximum milliseconds added at random to every datagram and chunk')
+    parser.add_argument('--spike', type=spike, default=(0, 0),
+                        help='latency spikes, as <probability>:<ms>, for example 0.01:2000')
+    parser.add_argument('--reset', type=probability, default=0,
+                        help='probability of resetting a TCP connection at each chunk')
+    parser.add_argument('--seed', type=int, help='seed of the faults, to repeat a run')
+    parser.add_argument('--watch', type=load_generator.address,
+                        help='broker whose registry is queried at every report, as <host>:<port>')
+    parser.add_argument('--report', type=float, default=10, help='seconds between two reports (default 10)')
+    parser.add_argument('--duration', type=float, help='seconds to run, until Ctrl+C by default')
+    options = parser.parse_args()
+
+    if len(options.udp) + len(options.tcp) == 0:
+        parser.error('At least one --udp or --tcp port is needed')
+
+    try:
+        asyncio.run(main(options))
+    except KeyboardInterrupt:
+        pass
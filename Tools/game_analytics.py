@@ -0,0 +1,230 @@
+"""
+Script that computes statistics over the game records written by the game servers when executed
+The record files (see game_records.py in the server folders) are memory-mapped as NumPy structured
+    arrays, so only the pages of the fields that are used are read, and every statistic is computed with
+    vectorized operations over chunks of records. The totals are kept in small arrays of counts, so the
+    memory used does not depend on the number of games
+Usage: python game_analytics.py <path> [<path> ...], where each path is a record file or a directory
+"""
+import argparse
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Format of the files, it must match game_records.py
+MAGIC = b'GAMEREC\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sHH4x')
+MAX_MOVES = 32
+
+RECORD = np.dtype({
+    'names': ['game', 'outcome', 'flags', 'board_size', 'n_moves', 'started', 'duration_ms', 'think_ms',
+              'moves'],
+    'formats': ['u1', 'u1', 'u1', 'u1', '<u2', '<f8', '<u4', ('<u4', 2), ('u1', MAX_MOVES)],
+    'offsets': [0, 1, 2, 3, 4, 8, 16, 20, 32],
+    'itemsize': 64,
+})
+
+GAMES = {1: 'Tic-Tac-Toe', 2: 'Rock-Paper-Scissors'}
+RPS_MOVES = ['rock', 'paper', 'scissors']
+
+# Outcomes, in the order of their codes
+OUTCOMES = ['draws', 'player 1 wins', 'player 2 wins', 'timed out', 'aborted']
+DRAW, PLAYER_1, PLAYER_2 = 0, 1, 2
+COMPLETED = 3
+
+AGAINST_BOT = 1
+
+# Records processed at once
+CHUNK = 1 << 22
+
+# Bounds of the buckets of the durations in milliseconds, logarithmic from 10 ms to about 28 hours
+BINS_PER_DECADE = 20
+DURATION_BINS = np.concatenate([[0], np.logspace(1, 8, 7 * BINS_PER_DECADE + 1)])
+
+# Openings are identified by the size of the board and the first move
+OPENINGS = 256 * 256
+
+# Games codes that are counted, the records of other games are ignored
+N_GAMES = 4
+
+
+class Totals:
+    """
+    This class accumulates the statistics of all the games. Each statistic is an array indexed by the
+        code of the game, and a chunk of records is added with a few calls to np.bincount whose keys
+        combine the game with the other fields, so that the records are never filtered or copied by game
+    """
+
+    def __init__(self):
+        self.outcomes = np.zeros((N_GAMES, 2, len(OUTCOMES)), dtype=np.int64)  # game, against the bot, outcome
+        self.durations = np.zeros((N_GAMES, len(DURATION_BINS) - 1), dtype=np.int64)
+        self.duration_sum = np.zeros(N_GAMES)
+        self.moves_sum = np.zeros(N_GAMES)
+        self.think_sum = np.zeros((N_GAMES, 2))
+        self.openings = np.zeros((N_GAMES, len(OUTCOMES), OPENINGS), dtype=np.int64)
+
+    def add(self, records):
+        """
+        Adds the statistics of a chunk of records
+        :param records: A structured array of records
+        """
+        game = records['game'].astype(np.intp)
+        known = game < N_GAMES
+        if not known.all():
+            records = records[known]
+            game = game[known]
+
+        outcome = records['outcome'].astype(np.intp)
+        bot = (records['flags'] & AGAINST_BOT).astype(np.intp)
+        self.outcomes += np.bincount((game * 2 + bot) * len(OUTCOMES) + outcome,
+                                     minlength=self.outcomes.size).reshape(self.outcomes.shape)
+
+        # the buckets are logarithmic, so the bucket of each duration is computed from its logarithm
+        duration = records['duration_ms']
+        with np.errstate(divide='ignore'):
+            bins = np.floor((np.log10(duration) - 1) * BINS_PER_DECADE)
+        bins = np.clip(np.nan_to_num(bins, neginf=-1), -1, self.durations.shape[1] - 2).astype(np.intp) + 1
+        self.durations += np.bincount(game * self.durations.shape[1] + bins,
+                                      minlength=self.durations.size).reshape(self.durations.shape)
+
+        self.duration_sum += np.bincount(game, weights=duration, minlength=N_GAMES)
+        self.moves_sum += np.bincount(game, weights=records['n_moves'], minlength=N_GAMES)
+        think = records['think_ms']
+        for player in range(2):
+            self.think_sum[:, player] += np.bincount(game, weights=think[:, player], minlength=N_GAMES)
+
+        # the first move of each game with at least one, by outcome
+        played = records['n_moves'] > 0
+        opening = records['board_size'].astype(np.intp) * 256 + records['moves'][:, 0]
+        key = (game * len(OUTCOMES) + outcome) * OPENINGS + opening
+        self.openings += np.bincount(key[played], minlength=self.openings.size).reshape(self.openings.shape)
+
+
+def duration_quantile(histogram, q):
+    """
+    :return: The upper bound of the bucket containing the quantile q, in seconds
+    """
+    cumulative = np.cumsum(histogram)
+    if cumulative[-1] == 0:
+        return 0
+    return DURATION_BINS[np.searchsorted(cumulative, q * cumulative[-1]) + 1] / 1000
+
+
+def open_records(path):
+    """
+    Maps a record file in memory
+    :param path: The path of the file
+    :return: The structured array of its records, a partially written last record is ignored
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+
+    if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION, RECORD.itemsize):
+        raise ValueError(f'not a game record file of version {VERSION}')
+
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.itemsize
+    if count == 0:
+        return np.empty(0, dtype=RECORD)
+    return np.memmap(path, dtype=RECORD, mode='r', offset=HEADER.size, shape=(count,))
+
+
+def find_files(paths):
+    """
+    :param paths: A list of files and directories
+    :return: The list of the record files, the directories are searched recursively
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.rec'))
+        else:
+            files.append(path)
+    return files
+
+
+def opening_name(game, opening):
+    """
+    :return: The readable name of an opening
+    """
+    size, move = divmod(opening, 256)
+    if game == 2:
+        return f'{RPS_MOVES[move // 3]} vs {RPS_MOVES[move % 3]}'
+    return f'{move // size + 1}{move % size + 1} on {size}x{size}'
+
+
+def print_summary(totals, game, top):
+    """
+    Prints the statistics of the games of one type
+    """
+    outcomes = totals.outcomes[game].sum(axis=0)
+    bot_outcomes = totals.outcomes[game, 1]
+    count = outcomes.sum()
+    bot = bot_outcomes.sum()
+    completed = outcomes[:COMPLETED].sum()
+
+    print(f'{GAMES.get(game, f"Game {game}")}: {count} games, {bot} against the bot')
+
+    for label, values, total in [('All games', outcomes, count), ('Against the bot', bot_outcomes, bot)]:
+        if total > 0:
+            print(f'  {label}: ' + ', '.join(f'{name} {100 * n / total:.1f}%' for name, n in zip(OUTCOMES, values)))
+
+    print(f'  Duration: mean {totals.duration_sum[game] / count / 1000:.1f} s, '
+          f'p50 {duration_quantile(totals.durations[game], 0.5):.1f} s, '
+          f'p90 {duration_quantile(totals.durations[game], 0.9):.1f} s, '
+          f'p99 {duration_quantile(totals.durations[game], 0.99):.1f} s')
+    print(f'  Moves per game: {totals.moves_sum[game] / count:.1f}, answer time per game: '
+          f'player 1 {totals.think_sum[game, 0] / count / 1000:.1f} s, '
+          f'player 2 {totals.think_sum[game, 1] / count / 1000:.1f} s')
+
+    if completed == 0:
+        return
+
+    # openings of the completed games, by popularity
+    finished = totals.openings[game, :COMPLETED]
+    played = finished.sum(axis=0)
+    best = np.argsort(played)[::-1][:top]
+
+    print('  Openings of the completed games:')
+    for opening in best[played[best] > 0]:
+        n = played[opening]
+        print(f'    {opening_name(game, opening):<24} {n:>12} games ({100 * n / completed:5.1f}%), '
+              f'player 1 wins {100 * finished[PLAYER_1, opening] / n:5.1f}%, '
+              f'player 2 wins {100 * finished[PLAYER_2, opening] / n:5.1f}%, '
+              f'draws {100 * finished[DRAW, opening] / n:5.1f}%')
+
+
+def main(options):
+    totals = Totals()
+
+    files = find_files(options.paths)
+    if len(files) == 0:
+        print('No record files found')
+        exit(-1)
+
+    total = 0
+    for path in files:
+        try:
+            records = open_records(path)
+        except (OSError, ValueError) as e:
+            print(f'Skipping {path}: {e}', file=sys.stderr)
+            continue
+
+        for start in range(0, len(records), CHUNK):
+            totals.add(records[start:start + CHUNK])
+        total += len(records)
+
+    print(f'{total} games in {len(files)} files\n')
+    for game in np.flatnonzero(totals.outcomes.sum(axis=(1, 2))):
+        print_summary(totals, int(game), options.top)
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statistics over the game records of the game servers')
+    parser.add_argument('paths', nargs='+', help='record files, or directories containing them')
+    parser.add_argument('--top', type=int, default=10, help='number of openings to show (default 10)')
+    main(parser.parse_args())
@@ -0,0 +1,391 @@
+"""
+Script that simulates games of the game servers without any socket when executed
+Batches of games are played at once, with the boards, scores and bot models of all the games held in
+    NumPy arrays, so that every turn of the batch (choosing the moves, applying them and detecting the
+    winners) is a handful of vectorized operations. The reported games per second are a baseline of the
+    cost of the game rules, independent of the network.
+A sample of the simulated games is then replayed move by move through the functions of the servers
+    (ttt_thread.game_has_winner, rps_thread.round_winner and the bots), and any disagreement is reported,
+    so the script is also a regression check of the game engines: it exits with status 1 on a mismatch
+Usage: python game_simulator.py [--game ttt|rps|both] [--games N] [--players random|bot] ..., run --help
+    for all the options
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# The game engines are imported from the server folders, the modules shared by the servers are the same
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'RockPaperScissorsServer'))
+sys.path.insert(0, os.path.join(ROOT, 'TicTacToeServer'))
+
+import rps_bot  # noqa: E402
+import rps_thread  # noqa: E402
+import ttt_bot  # noqa: E402
+import ttt_thread  # noqa: E402
+
+# Outcomes, with the same codes as game_records
+OUTCOMES = ['draws', 'player 1 wins', 'player 2 wins']
+DRAW, PLAYER_1, PLAYER_2 = 0, 1, 2
+
+# Directions of the lines through a cell, as in ttt_thread
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+# Signs on the boards of the simulation, the index is the value of the cell
+EMPTY, X, O = 0, 1, 2
+SIGNS = ['-', 'X', 'O']
+
+# Points needed to win a game of Rock-Paper-Scissors, as in rps_thread
+OBJECTIVE = 3
+
+
+def bot_moves():
+    """
+    Converts the table of the Tic-Tac-Toe bot to an array indexed by the board, encoded in base 3 with
+        the first cell as the least significant digit
+    :return: An array with the cell the bot plays on each board, -1 for the boards it never sees
+    """
+    moves = np.full(3 ** 9, -1, dtype=np.int16)
+    for cells, move in ttt_bot.build_table().items():
+        if move is not None:
+            moves[sum(SIGNS.index(cell) * 3 ** i for i, cell in enumerate(cells))] = move
+    return moves
+
+
+def simulate_ttt(count, size, length, bot, rng, table=None):
+    """
+    Plays a batch of Tic-Tac-Toe games where the first player plays random moves, and the second player
+        either random moves or the moves of the bot
+    :param count: The number of games
+    :param size: The number of rows and columns of the board
+    :param length: The number of signs in a row needed to win
+    :param bot: True if the second player is the bot, only on the 3x3 board
+    :param rng: The numpy.random.Generator to use
+    :param table: The array returned by bot_moves, if bot is True
+    :return: The array of the outcomes, the array of the number of moves, and the moves of each game as
+        the indexes of the cells, padded with -1
+    """
+    cells = size * size
+    boards = np.zeros((count, cells), dtype=np.int8)
+    moves = np.full((count, cells), -1, dtype=np.int16)
+    outcomes = np.zeros(count, dtype=np.int8)
+    lengths = np.full(count, cells, dtype=np.int16)
+
+    # Random players play the cells of a random permutation in order, skipping the cells already taken
+    #   only when playing against the bot
+    order = None if bot else np.argsort(rng.random((count, cells)), axis=1).astype(np.int16)
+
+    active = np.arange(count)
+    for turn in range(cells):
+        sign = X if turn % 2 == 0 else O
+
+        if bot and sign == O:
+            codes = (boards[active].astype(np.int32) * 3 ** np.arange(9)).sum(axis=1)
+            cell = table[codes]
+        elif bot:
+            scores = rng.random((len(active), cells))
+            scores[boards[active] != EMPTY] = -1
+            cell = scores.argmax(axis=1)
+        else:
+            cell = order[active, turn]
+
+        boards[active, cell] = sign
+        moves[active, turn] = cell
+
+        won = line_completed(boards[active], cell, sign, size, length)
+        outcomes[active[won]] = PLAYER_1 if sign == X else PLAYER_2
+        lengths[active[won]] = turn + 1
+        active = active[~won]
+
+        if len(active) == 0:
+            break
+
+    return outcomes, lengths, moves
+
+
+def line_completed(boards, cell, sign, size, length):
+    """
+    Vectorized version of ttt_thread.game_has_winner: checks the four lines through the last move of
+        each game, for at most length cells on either side
+    :param boards: The boards of the games, one row of size x size cells for each game
+    :param cell: The array of the cells of the last moves
+    :param sign: The sign of the last moves
+    :return: A boolean array, True for the games the last move has won
+    """
+    rows, cols = np.divmod(cell.astype(np.int32), size)
+    games = np.arange(len(boards))
+    won = np.zeros(len(boards), dtype=bool)
+
+    for dr, dc in DIRECTIONS:
+        count = np.ones(len(boards), dtype=np.int32)
+        for step in [1, -1]:
+            running = np.ones(len(boards), dtype=bool)
+            for k in range(1, length):
+                r = rows + step * k * dr
+                c = cols + step * k * dc
+                inside = (r >= 0) & (r < size) & (c >= 0) & (c < size)
+                running &= inside
+                running[running] &= boards[games[running], r[running] * size + c[running]] == sign
+                count += running
+        won |= count >= length
+
+    return won
+
+
+def simulate_rps(count, bot, rng):
+    """
+    Plays a batch of Rock-Paper-Scissors games, to OBJECTIVE points, where the first player plays random
+        moves, and the second player either random moves or the moves of the bot
+    :param count: The number of games
+    :param bot: True if the second player is the bot
+    :param rng: The numpy.random.Generator to use
+    :return: The array of the outcomes, the array of the number of rounds, the moves of each round as
+        an array of pairs of indexes in rps_bot.MOVES padded with -1, and the final model of each bot
+    """
+    scores = np.zeros((count, 2), dtype=np.int8)
+    rounds = []
+    lengths = np.zeros(count, dtype=np.int16)
+
+    # the model of the bot, see rps_bot.BotPlayer: 27 order 2 counts and 9 order 1 counts, and the
+    #   last two moves of the opponent, -1 while unknown
+    counts = np.zeros((count, 36), dtype=np.int16)
+    prev = np.full(count, -1, dtype=np.int16)
+    last = np.full(count, -1, dtype=np.int16)
+    counter = np.array(rps_bot.COUNTER, dtype=np.int16)
+
+    active = np.arange(count)
+    while len(active) > 0:
+        p1 = rng.integers(0, 3, len(active), dtype=np.int16)
+
+        if bot:
+            p2 = bot_choose(counts[active], prev[active], last[active], counter, rng)
+            bot_observe(counts, prev, last, active, p1)
+        else:
+            p2 = rng.integers(0, 3, len(active), dtype=np.int16)
+
+        played = np.full((count, 2), -1, dtype=np.int8)
+        played[active, 0] = p1
+        played[active, 1] = p2
+        rounds.append(played)
+
+        # (p1 - p2) % 3 is 1 when the first player wins the round, and 2 when the second one does
+        winner = (p1 - p2) % 3
+        scores[active[winner == 1], 0] += 1
+        scores[active[winner == 2], 1] += 1
+        lengths[active] += 1
+
+        active = active[(scores[active] < OBJECTIVE).all(axis=1)]
+
+    outcomes = np.where(scores[:, 0] == OBJECTIVE, PLAYER_1, PLAYER_2).astype(np.int8)
+    return outcomes, lengths, np.stack(rounds, axis=1), counts
+
+
+def bot_choose(counts, prev, last, counter, rng):
+    """
+    Vectorized version of rps_bot.BotPlayer.choose_move
+    :return: The array of the moves of the bots
+    """
+    moves = rng.integers(0, 3, len(counts), dtype=np.int16)
+    chosen = np.zeros(len(counts), dtype=bool)
+
+    # the longest known context first, the ties between the most frequent moves are broken at random
+    for base, known in [((prev * 3 + last) * 3, (prev >= 0) & (last >= 0)), (27 + last * 3, last >= 0)]:
+        rows = np.flatnonzero(known & ~chosen)
+        context = counts[rows[:, None], base[rows, None] + np.arange(3)]
+        best = context.max(axis=1)
+        rows, context = rows[best > 0], context[best > 0]
+
+        noise = rng.random(context.shape)
+        predicted = np.where(context == context.max(axis=1, keepdims=True), noise, -1).argmax(axis=1)
+        moves[rows] = counter[predicted]
+        chosen[rows] = True
+
+    return moves
+
+
+def bot_observe(counts, prev, last, active, move):
+    """
+    Vectorized version of rps_bot.BotPlayer.observe, updates the models of the active games in place
+    """
+    for base, known in [((prev[active] * 3 + last[active]) * 3, (prev[active] >= 0) & (last[active] >= 0)),
+                        (27 + last[active] * 3, last[active] >= 0)]:
+        rows = active[known]
+        cells = base[known] + move[known]
+        counts[rows, cells] += 1
+
+        # the counts of a context are halved when one of them reaches the maximum
+        full = counts[rows, cells] == rps_bot.MAX_COUNT
+        for i in range(3):
+            counts[rows[full], base[known][full] + i] //= 2
+
+    prev[active] = last[active]
+    last[active] = move
+
+
+def check_ttt(outcomes, lengths, moves, size, length, bot, sample):
+    """
+    Replays games through ttt_thread.game_has_winner, and the moves of the bot through ttt_bot.BotPlayer
+    :return: The number of games that do not match, and the seconds taken by the replay. Against the
+        bot, every game of the batch won by the first player counts as a mismatch, as the bot plays
+        perfect moves
+    """
+    start = time.perf_counter()
+    player = ttt_bot.BotPlayer(ttt_bot.build_table()) if bot else None
+    mismatches = int((outcomes == PLAYER_1).sum()) if bot else 0
+
+    for game in sample:
+        board = [['-'] * size for _ in range(size)]
+        outcome, played = DRAW, size * size
+        valid = True
+
+        for turn in range(size * size):
+            row, col = divmod(int(moves[game, turn]), size)
+
+            if player is not None and turn % 2 == 1 and player.choose_move(board) != (row, col):
+                valid = False
+
+            board[row][col] = ttt_thread.SIGNS[turn % 2]
+            if ttt_thread.game_has_winner(board, row, col, length):
+                outcome, played = PLAYER_1 + turn % 2, turn + 1
+                break
+
+        if not valid or (outcome, played) != (outcomes[game], lengths[game]):
+            mismatches += 1
+
+    return mismatches, time.perf_counter() - start
+
+
+def check_rps(outcomes, lengths, rounds, counts, bot, sample):
+    """
+    Replays games through rps_thread.round_winner, checking that each move of the bot is one that
+        rps_bot.BotPlayer could have chosen, and that its model ends up the same
+    :return: The number of games that do not match, and the seconds taken by the replay
+    """
+    start = time.perf_counter()
+    mismatches = 0
+
+    for game in sample:
+        player = rps_bot.BotPlayer()
+        wins = [0, 0]
+        valid = True
+
+        for p1, p2 in rounds[game, :lengths[game]]:
+            if bot and p2 not in allowed_moves(player):
+                valid = False
+            player.observe(rps_bot.MOVES[p1])
+
+            winner = rps_thread.round_winner(rps_bot.MOVES[p1], rps_bot.MOVES[p2])
+            if winner > 0:
+                wins[winner - 1] += 1
+
+        outcome = PLAYER_1 if wins[0] == OBJECTIVE else PLAYER_2
+        if bot and list(player._counts) != counts[game].tolist():
+            valid = False
+        if not valid or max(wins) != OBJECTIVE or outcome != outcomes[game]:
+            mismatches += 1
+
+    return mismatches, time.perf_counter() - start
+
+
+def allowed_moves(player):
+    """
+    :param player: A rps_bot.BotPlayer
+    :return: The indexes of the moves the bot can choose in its current state
+    """
+    # the model is read from the private fields of the bot, this is a test of its implementation
+    for base in player._contexts():
+        counts = player._counts[base:base + 3]
+        best = max(counts)
+        if best > 0:
+            return {rps_bot.COUNTER[i] for i in range(3) if counts[i] == best}
+    return {0, 1, 2}
+
+
+def run(name, simulate, check, options, rng):
+    """
+    Simulates the requested number of games of one type in batches, then replays a sample of the last
+        batch, and prints the results
+    :return: The number of mismatches
+    """
+    outcomes = np.zeros(3, dtype=np.int64)
+    total_length = 0
+    elapsed = 0
+    result = None
+
+    for start in range(0, options.games, options.batch):
+        count = min(options.batch, options.games - start)
+        began = time.perf_counter()
+        result = simulate(count)
+        elapsed += time.perf_counter() - began
+
+        outcomes += np.bincount(result[0], minlength=3)
+        total_length += int(result[1].sum())
+
+    sample = rng.choice(len(result[0]), min(options.check, len(result[0])), replace=False)
+    mismatches, replay = check(*result, sample)
+
+    print(f'{name}: {options.games} games in {elapsed:.2f} s ({options.games / elapsed:,.0f} games/s), '
+          f'{total_length / options.games:.2f} moves per game')
+    print('  ' + ', '.join(f'{label} {100 * n / options.games:.2f}%' for label, n in zip(OUTCOMES, outcomes)))
+    if len(sample) > 0:
+        print(f'  Replayed {len(sample)} games through the server functions in {replay:.2f} s '
+              f'({len(sample) / replay:,.0f} games/s): {mismatches} mismatches')
+
+    return mismatches
+
+
+def main(options):
+    rng = np.random.default_rng(options.seed)
+    mismatches = 0
+
+    if options.game in ['ttt', 'both']:
+        bot = options.players == 'bot'
+        table = bot_moves() if bot else None
+
+        mismatches += run(f'Tic-Tac-Toe {options.size}x{options.size}, {options.length} in a row',
+                          lambda count: simulate_ttt(count, options.size, options.length, bot, rng, table),
+                          lambda outcomes, lengths, moves, sample: check_ttt(
+                              outcomes, lengths, moves, options.size, options.length, bot, sample),
+                          options, rng)
+
+    if options.game in ['rps', 'both']:
+        bot = options.players == 'bot'
+        mismatches += run(f'Rock-Paper-Scissors to {OBJECTIVE}',
+                          lambda count: simulate_rps(count, bot, rng),
+                          lambda outcomes, lengths, rounds, counts, sample: check_rps(
+                              outcomes, lengths, rounds, counts, bot, sample),
+                          options, rng)
+
+    if mismatches > 0:
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulation of the games of the game servers')
+    parser.add_argument('--game', choices=['ttt', 'rps', 'both'], default='both', help='games to simulate (default both)')
+    parser.add_argument('--games', type=int, default=1000000, help='number of games of each type (default 1000000)')
+    parser.add_argument('--batch', type=int, default=None,
+                        help='games simulated at once (default about a million cells of boards)')
+    parser.add_argument('--players', choices=['random', 'bot'], default='random',
+                        help='the second player plays random moves, or is the bot of the server (default random)')
+    parser.add_argument('--size', type=int, default=3, help='rows and columns of the Tic-Tac-Toe board (default 3)')
+    parser.add_argument('--length', type=int, default=None,
+                        help='signs in a row needed to win (default 3, or 5 on boards of 5x5 and more)')
+    parser.add_argument('--check', type=int, default=10000,
+                        help='games replayed through the functions of the servers (default 10000)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random moves')
+    options = parser.parse_args()
+
+    if options.length is None:
+        options.length = min(options.size, 5)
+    if options.batch is None:
+        options.batch = max((1 << 20) // (options.size * options.size), 1000)
+    if not 3 <= options.length <= options.size:
+        parser.error('--length must be between 3 and --size')
+    if options.players == 'bot' and options.game != 'rps' and (options.size, options.length) != (3, 3):
+        parser.error('the Tic-Tac-Toe bot only plays on the 3x3 board')
+
+    main(options)
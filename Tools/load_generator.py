@@ -0,0 +1,422 @@
+"""
+Script that generates load on the game servers when executed
+Many scripted players connect at the same time, and play full games answering the real prompts of the
+    servers: valid moves, invalid moves with a configurable probability, and rematches. The servers are
+    either given directly or discovered through a broker, in which case every session queries the broker
+    first, so that the whole discovery and play path is exercised.
+All the players run in a single process with asyncio. At the end the number of games per second, the
+    percentiles of the move latency and the errors are reported
+"""
+import argparse
+import asyncio
+import collections
+import random
+import re
+import resource
+import sys
+import time
+
+# A prompt is complete when it ends with the list of the accepted answers
+PROMPT_END = re.compile(r'\]:? $')
+
+# A row of a Tic-Tac-Toe board
+BOARD_ROW = re.compile(r'^[XO-](?: [XO-])+$', re.MULTILINE)
+
+# Seconds to wait before opening a new session after an error
+ERROR_BACKOFF = 1
+
+# Seconds a player still waiting for an opponent keeps waiting after the end of the test
+END_GRACE = 5
+
+
+class Stats:
+    """
+    This class collects the results of all the players
+    """
+
+    def __init__(self):
+        self.sessions = 0
+        self.results = 0
+        self.answers = 0
+        self.invalid = 0
+        self.rematches = 0
+        self.errors = collections.Counter()
+        self.move_latency = []  # seconds between an answer and the next prompt
+        self.first_prompt = []  # seconds between connecting and the first prompt, including matchmaking
+        self.discovery = []  # seconds taken by the broker to answer a query
+
+
+def percentiles(values):
+    """
+    :param values: A list of durations in seconds
+    :return: A string with the median, 90th, 99th percentile and the maximum in milliseconds
+    """
+    if len(values) == 0:
+        return 'no samples'
+
+    values = sorted(values)
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)] * 1000
+
+    return f'p50 {at(0.5):.1f} ms, p90 {at(0.9):.1f} ms, p99 {at(0.99):.1f} ms, max {values[-1] * 1000:.1f} ms ' \
+           f'({len(values)} samples)'
+
+
+def think_time(spec):
+    """
+    Parses a think time distribution
+    :param spec: A string among 'const:<s>', 'uniform:<min>,<max>', 'exp:<mean>' and 'normal:<mean>,<stddev>'
+    :return: A function taking a random.Random and returning the seconds to think
+    """
+    kind, _, params = spec.partition(':')
+    try:
+        values = [float(v) for v in params.split(',')] if params else []
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid think time parameters: {params}')
+
+    match kind, len(values):
+        case 'const', 1:
+            return lambda rng: values[0]
+        case 'uniform', 2:
+            return lambda rng: rng.uniform(values[0], values[1])
+        case 'exp', 1:
+            return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0
+        case 'normal', 2:
+            return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+
+    raise argparse.ArgumentTypeError(f'Invalid think time distribution: {spec}')
+
+
+def address(text):
+    """
+    :param text: A string formatted as '<host>:<port>'
+    :return: The pair of host and integer port
+    """
+    host, _, port = text.rpartition(':')
+    try:
+        return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid address: {text}')
+
+
+def parse_servers(received):
+    """
+    :param received: The answer of the broker to a query
+    :return: A list of pairs of address and port of the registered servers
+    """
+    if received == 'empty':
+        return []
+
+    servers = []
+    for entry in received.split('$'):
+        name, host, port = entry.split('|')[:3]
+        servers.append((host, int(port)))
+    return servers
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def query_broker(broker, timeout):
+    """
+    Asks a broker for the list of the registered servers
+    :param broker: The pair of address and port of the broker
+    :param timeout: Seconds to wait for the answer
+    :return: A list of pairs of address and port of the servers
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _QueryProtocol(future), remote_addr=broker)
+    try:
+        transport.sendto(b'query\n')
+        data = await asyncio.wait_for(future, timeout)
+    finally:
+        transport.close()
+
+    return parse_servers(data.decode())
+
+
+def choose_answer(prompt, rng, options, stop, name):
+    """
+    Chooses the answer to a prompt of one of the game servers
+    :param prompt: The complete prompt received
+    :param rng: The random.Random of the player
+    :param options: The parsed command line options
+    :param stop: True if the player should not accept a rematch
+    :param name: The name of the player, sent when the server keeps the ratings
+    :return: The answer, and whether it is a deliberately invalid answer
+    """
+    if 'player name' in prompt:
+        return name, False
+
+    if 'play again' in prompt:
+        return 'yes' if not stop and rng.random() < options.rematch else 'no', False
+
+    invalid = rng.random() < options.invalid
+
+    if 'rock, paper, scissors' in prompt:
+        return 'lizard' if invalid else rng.choice(['rock', 'paper', 'scissors']), invalid
+
+    # Tic-Tac-Toe, the last board in the prompt is the current one
+    rows = BOARD_ROW.findall(prompt)
+    size = len(rows[-1].split()) if rows else 3
+    rows = [row.split() for row in rows[-size:]]
+
+    cells = [(r, c) for r in range(len(rows)) for c in range(size) if rows[r][c] == '-']
+    taken = [(r, c) for r in range(len(rows)) for c in range(size) if rows[r][c] != '-']
+
+    # moves are typed as two digits, or as two numbers separated by a space on boards larger than 9x9
+    separator = '' if size <= 9 else ' '
+
+    if invalid or len(cells) == 0:
+        if len(taken) > 0 and rng.random() < 0.5:
+            r, c = rng.choice(taken)
+            return f'{r + 1}{separator}{c + 1}', True
+        return f'{size + 1} {size + 1}', True
+
+    r, c = rng.choice(cells)
+    return f'{r + 1}{separator}{c + 1}', False
+
+
+async def read_prompt(reader, timeout):
+    """
+    :param reader: The asyncio.StreamReader of the connection
+    :param timeout: Seconds to wait for the whole prompt
+    :return: The prompt, or None if the server closed the connection
+    """
+    buffer = ''
+    deadline = time.monotonic() + timeout
+
+    while not PROMPT_END.search(buffer):
+        data = await asyncio.wait_for(reader.read(4096), max(deadline - time.monotonic(), 0))
+        if data == b'':
+            return None
+        buffer += data.decode()
+
+    return buffer
+
+
+async def play_session(server, name, rng, options, stats, end):
+    """
+    Plays on a server until the connection is closed, answering all the prompts
+    :param server: The pair of address and port of the server
+    :param name: The name of the player
+    :param rng: The random.Random of the player
+    :param options: The parsed command line options
+    :param stats: The Stats object to update
+    :param end: The time after which rematches are refused
+    """
+    start = time.monotonic()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*server), options.timeout)
+    stats.sessions += 1
+
+    try:
+        sent = None
+        last = ''
+
+        while True:
+            timeout = options.timeout
+            if sent is None:
+                timeout = min(timeout, max(end - time.monotonic(), 0) + END_GRACE)
+
+            try:
+                prompt = await read_prompt(reader, timeout)
+            except asyncio.TimeoutError:
+                # the last players connected may not find an opponent before the end of the test
+                if sent is None and time.monotonic() >= end:
+                    return
+                raise
+
+            now = time.monotonic()
+
+            if prompt is None:
+                # the connection is closed after the players decide whether to play again
+                if 'play again' not in last:
+                    stats.errors['closed during a game'] += 1
+                return
+
+            # the player waits for an opponent after sending their name, like after connecting
+            if 'player name' in prompt:
+                writer.write(choose_answer(prompt, rng, options, False, name)[0].encode())
+                await writer.drain()
+                continue
+
+            if sent is None:
+                stats.first_prompt.append(now - start)
+            else:
+                stats.move_latency.append(now - sent)
+
+            if 'play again' in prompt:
+                stats.results += 1
+
+            stop = now >= end
+            answer, invalid = choose_answer(prompt, rng, options, stop, name)
+
+            await asyncio.sleep(options.think(rng))
+
+            writer.write(answer.encode())
+            await writer.drain()
+            sent = time.monotonic()
+            last = prompt
+
+            stats.answers += 1
+            if invalid:
+                stats.invalid += 1
+            if answer == 'yes':
+                stats.rematches += 1
+    finally:
+        writer.close()
+
+
+async def player(index, rng, options, stats, end):
+    """
+    Executed by each player: opens sessions one after the other until the end of the test
+    :param index: The index of the player, used to spread the players over the servers
+    :param rng: The random.Random of the player
+    :param options: The parsed command line options
+    :param stats: The Stats object to update
+    :param end: The time at which the test ends
+    """
+    await asyncio.sleep(options.ramp * index / options.players)
+
+    while time.monotonic() < end:
+        try:
+            if options.broker is not None:
+                start = time.monotonic()
+                servers = await query_broker(options.broker, options.timeout)
+                stats.discovery.append(time.monotonic() - start)
+
+                if len(servers) == 0:
+                    stats.errors['no servers registered'] += 1
+                    await asyncio.sleep(ERROR_BACKOFF)
+                    continue
+
+                server = rng.choice(servers)
+            else:
+                server = options.server[index % len(options.server)]
+
+            await play_session(server, f'loadgen-{index}', rng, options, stats, end)
+
+        except asyncio.TimeoutError:
+            stats.errors['timeout'] += 1
+            await asyncio.sleep(ERROR_BACKOFF)
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            stats.errors[type(e).__name__] += 1
+            await asyncio.sleep(ERROR_BACKOFF)
+
+
+def games(stats, options):
+    """
+    :return: The number of finished games, every game is seen by all of its generated players
+    """
+    return stats.results / (1 if options.bot else 2)
+
+
+async def progress(stats, options, start):
+    """
+    Prints the progress of the test every options.interval seconds
+    """
+    while True:
+        await asyncio.sleep(options.interval)
+        elapsed = time.monotonic() - start
+        print(f'[{elapsed:6.1f}s] sessions {stats.sessions}, games {games(stats, options):g}, answers {stats.answers}, '
+              f'errors {sum(stats.errors.values())}', flush=True)
+
+
+def report(stats, options, elapsed):
+    """
+    Prints the final results of the test
+    """
+    finished = games(stats, options)
+
+    print(f'Duration:           {elapsed:.1f} s')
+    print(f'Sessions:           {stats.sessions}')
+    print(f'Games:              {finished:g} ({finished / elapsed:.2f} games/s)')
+    print(f'Answers:            {stats.answers} ({stats.answers / elapsed:.1f} answers/s), '
+          f'{stats.invalid} invalid, {stats.rematches} rematches')
+    print(f'Move latency:       {percentiles(stats.move_latency)}')
+    print(f'First prompt:       {percentiles(stats.first_prompt)}')
+    if len(stats.discovery) > 0:
+        print(f'Broker query:       {percentiles(stats.discovery)}')
+    print(f'Errors:             {sum(stats.errors.values())}')
+    for error, count in stats.errors.most_common():
+        print(f'    {error}: {count}')
+
+
+async def main(options):
+    stats = Stats()
+    start = time.monotonic()
+    end = start + options.duration
+
+    seed = random.Random(options.seed)
+    players = [player(i, random.Random(seed.random()), options, stats, end) for i in range(options.players)]
+
+    reporter = asyncio.create_task(progress(stats, options, start))
+    try:
+        await asyncio.gather(*players)
+    finally:
+        reporter.cancel()
+
+    report(stats, options, time.monotonic() - start)
+
+
+def raise_file_limit(players):
+    """
+    Raises the limit of open files of this process, so that thousands of players can connect
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = players + 64
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        if target < needed:
+            print(f'Warning: only {target} files can be opened, some players will fail to connect', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the game servers')
+    targets = parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument('--server', type=address, action='append',
+                         help='<host>:<port> of a game server, can be repeated')
+    targets.add_argument('--broker', type=address,
+                         help='<host>:<port> of a broker, queried before every session')
+    parser.add_argument('--players', type=int, default=100, help='number of concurrent players (default 100)')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds after which the players stop accepting rematches and opening sessions '
+                             '(default 60)')
+    parser.add_argument('--ramp', type=float, default=5,
+                        help='seconds over which the players are started (default 5)')
+    parser.add_argument('--think', type=think_time, default=think_time('uniform:0.1,0.5'),
+                        help="think time distribution: 'const:<s>', 'uniform:<min>,<max>', 'exp:<mean>' or "
+                             "'normal:<mean>,<stddev>' (default uniform:0.1,0.5)")
+    parser.add_argument('--invalid', type=float, default=0.05,
+                        help='probability of sending an invalid move (default 0.05)')
+    parser.add_argument('--rematch', type=float, default=0.5,
+                        help='probability of asking for a rematch (default 0.5)')
+    parser.add_argument('--bot', action='store_true',
+                        help='the servers pair every player with their bot (BOT_WAIT_SECONDS=0), used to count '
+                             'the games')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for a connection, a prompt or the broker (default 120)')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between progress lines (default 5)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random choices')
+    options = parser.parse_args()
+
+    raise_file_limit(options.players)
+
+    try:
+        asyncio.run(main(options))
+    except KeyboardInterrupt:
+        print('Terminated')
@@ -0,0 +1,316 @@
+"""
+Script that simulates the registrations of many game servers on a broker when executed, on a virtual clock
+The real Registry of the broker is used, without its timer: the removals of stale entries are events of
+    the simulation, as are the attempts of the servers to register, scheduled by the real BrokerRegistration
+    on the virtual clock, with its timeouts, backoff and jitter. Servers crash and come back, the broker restarts with an empty registry,
+    and datagrams are lost, so hours of operation are simulated in seconds.
+At the end it reports:
+    - how long crashed servers stay listed until they are removed (staleness), and until they restart
+      when they come back before being removed
+    - the servers removed while alive (spurious evictions), and how long alive servers are missing from
+      the registry after starting, after an eviction and after a restart of the broker
+    - the fraction of the listed servers that are down, and of the servers up that are not listed, sampled
+      at regular intervals as a client querying the broker would see them
+    - the mean and peak rates of the registrations received by the broker
+Usage: python registry_simulator.py [--servers <n>] [--duration <s>] [--interval <s>] [--sweep <s>] ...
+"""
+import argparse
+import collections
+import heapq
+import logging
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'TicTacToeServer'))
+sys.path.insert(0, os.path.join(ROOT, 'Broker'))
+
+import registration  # noqa: E402
+import registry  # noqa: E402
+
+# The default REGISTRATION_INTERVAL of the servers
+DEFAULT_INTERVAL = 240
+
+# Kinds of the events
+ATTEMPT = 'attempt'  # a server sends its registration
+ANSWER = 'answer'  # the answer of the broker reaches a server, or its timeout expires
+SWEEP = 'sweep'  # the broker removes the stale entries
+CRASH = 'crash'
+START = 'start'
+BROKER_DOWN = 'broker down'
+BROKER_UP = 'broker up'
+SAMPLE = 'sample'
+
+
+class Server:
+    """
+    The state of a simulated server, its registration being the registration.Broker of its only broker
+    """
+
+    def __init__(self, index):
+        self.name = f'server-{index}'
+        self.address = f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}|6000'
+        self.alive = False
+        self.epoch = 0  # incremented when the server crashes, to discard its pending events
+        self.broker = None
+        self.crashed = None  # the time of the crash while still listed, or None
+        self.missing = None  # the time since it is up and not listed, and why, or None
+
+
+class Simulation:
+    """
+    This class runs the events in the order of their virtual time
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+
+        # the registry does not log, the simulation makes millions of registrations
+        logger = logging.getLogger('RegistrySimulator')
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.CRITICAL)
+        logger.propagate = False
+        self.logger = logger
+
+        # it only schedules the attempts of the servers on their Broker objects, its thread is never started
+        self.registration = registration.BrokerRegistration('simulator', '127.0.0.1', 1, [], options.interval,
+                                                            logger, clock=lambda: self.now, rng=self.rng)
+
+        self.registry = registry.Registry(logger, timer=False)
+        self.broker_up = True
+        self.listed = set()
+        self.servers = [Server(i) for i in range(options.servers)]
+
+        self.staleness = []  # crash to removal
+        self.relisted = []  # crash to restart, of the servers still listed when they restart
+        self.missing = collections.defaultdict(list)
+        self.evictions = 0
+        self.spurious = 0
+        self.crashes = 0
+        self.registrations = collections.Counter()  # registrations received in each second
+        self.stale_samples = []
+        self.missing_samples = []
+
+    def schedule(self, delay, kind, server=None, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, kind, server, args))
+
+    def lost(self):
+        return self.options.loss > 0 and self.rng.random() < self.options.loss
+
+    def run(self):
+        for server in self.servers:
+            self.schedule(self.rng.uniform(0, self.options.startup), START, server)
+        self.schedule(self.options.sweep, SWEEP, None, self.registry)
+        if self.options.restart_every is not None:
+            self.schedule(self.options.restart_every, BROKER_DOWN)
+        self.schedule(self.options.sample, SAMPLE)
+
+        while len(self.events) > 0:
+            time, _, kind, server, args = heapq.heappop(self.events)
+            if time > self.options.duration:
+                break
+            self.now = time
+
+            if server is not None and len(args) > 0 and kind in (ATTEMPT, ANSWER) and args[0] != server.epoch:
+                continue  # the server crashed after scheduling the event
+            getattr(self, f'on_{kind.replace(" ", "_")}')(server, *args)
+
+    # EVENTS OF THE SERVERS
+
+    def on_start(self, server):
+        server.alive = True
+        server.broker = registration.Broker(('broker', 0))
+        if server.crashed is not None:
+            # restarted before being removed, it is listed again with the same address
+            self.relisted.append(self.now - server.crashed)
+            server.crashed = None
+        if server.name not in self.listed:
+            server.missing = (self.now, 'start')
+
+        self.schedule(0, ATTEMPT, server, server.epoch)
+        if self.options.crash_rate > 0:
+            self.schedule(self.rng.expovariate(self.options.crash_rate / 3600), CRASH, server)
+
+    def on_crash(self, server):
+        self.crashes += 1
+        server.alive = False
+        server.epoch += 1
+        server.missing = None
+        if server.name in self.listed:
+            server.crashed = self.now
+        self.schedule(self.rng.expovariate(1 / self.options.downtime), START, server)
+
+    def on_attempt(self, server, epoch):
+        """
+        The server sends its registration, the broker handles it if it is up and the datagram is not lost
+        """
+        result = None
+        if self.broker_up and not self.lost():
+            self.registrations[int(self.now)] += 1
+            result = self.registry.add_server(server.name, server.address)
+            if result == 'okay':
+                self.listed.add(server.name)
+                if server.missing is not None:
+                    start, reason = server.missing
+                    self.missing[reason].append(self.now - start)
+                    server.missing = None
+            if self.lost():
+                result = None
+
+        if result is None:
+            self.schedule(registration.answer_timeout(server.broker.failures), ANSWER, server, epoch, None)
+        else:
+            self.schedule(self.options.rtt, ANSWER, server, epoch, result)
+
+    def on_answer(self, server, epoch, result):
+        """
+        Schedules the next attempt with BrokerRegistration, after an answer or a timeout
+        """
+        if result is None:
+            self.registration._failed(server.broker)
+        else:
+            self.registration._answered(server.broker, result)
+        self.schedule(server.broker.next_attempt - self.now, ATTEMPT, server, epoch)
+
+    # EVENTS OF THE BROKER
+
+    def on_sweep(self, _, current):
+        if current is not self.registry:
+            return  # the timer of a registry lost in a restart
+
+        self.registry.remove_old()
+        listed = {name for name, _ in self.registry.get_status()}
+
+        for name in self.listed - listed:
+            self.evictions += 1
+            server = self.servers[int(name.rsplit('-', 1)[1])]
+            if server.alive:
+                self.spurious += 1
+                server.missing = (self.now, 'eviction')
+            elif server.crashed is not None:
+                self.staleness.append(self.now - server.crashed)
+                server.crashed = None
+
+        self.listed = listed
+        self.schedule(self.options.sweep, SWEEP, None, current)
+
+    def on_broker_down(self, _):
+        self.broker_up = False
+        self.registry.stop_timer()
+        self.schedule(self.options.restart_downtime, BROKER_UP)
+
+    def on_broker_up(self, _):
+        # the registry starts empty, and its timer starts with the process
+        self.broker_up = True
+        self.registry = registry.Registry(self.logger, timer=False)
+
+        for server in self.servers:
+            if server.crashed is not None:
+                self.staleness.append(self.now - self.options.restart_downtime - server.crashed)
+                server.crashed = None
+            if server.alive and server.missing is None:
+                server.missing = (self.now - self.options.restart_downtime, 'broker restart')
+        self.listed = set()
+
+        self.schedule(self.options.sweep, SWEEP, None, self.registry)
+        self.schedule(self.options.restart_every, BROKER_DOWN)
+
+    def on_sample(self, _):
+        """
+        Samples what a client querying the broker would see
+        """
+        if self.broker_up:
+            alive = {server.name for server in self.servers if server.alive}
+            if len(self.listed) > 0:
+                self.stale_samples.append(len(self.listed - alive) / len(self.listed))
+            if len(alive) > 0:
+                self.missing_samples.append(len(alive - self.listed) / len(alive))
+        self.schedule(self.options.sample, SAMPLE)
+
+
+def percentiles(values):
+    """
+    :param values: A list of durations in seconds
+    :return: A string with the median, 90th, 99th percentile and the maximum in seconds
+    """
+    if len(values) == 0:
+        return 'no samples'
+
+    values = sorted(values)
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    return f'p50 {at(0.5):.1f} s, p90 {at(0.9):.1f} s, p99 {at(0.99):.1f} s, max {values[-1]:.1f} s ' \
+           f'({len(values)} samples)'
+
+
+def mean(values):
+    return sum(values) / len(values) if len(values) > 0 else 0
+
+
+def report(simulation, options):
+    duration = min(simulation.now, options.duration)
+    print(f'Simulated {len(simulation.servers)} servers for {duration / 3600:.1f} h: registration interval '
+          f'{options.interval:g} s, sweep every {options.sweep:g} s, loss {options.loss:.0%}, '
+          f'{simulation.crashes} crashes')
+
+    print('Staleness of the crashed servers (crash to removal):')
+    print(f'    {percentiles(simulation.staleness)}')
+    print('Crashed servers still listed when they restart (crash to restart):')
+    print(f'    {percentiles(simulation.relisted)}')
+
+    print(f'Evictions:          {simulation.evictions}, {simulation.spurious} of servers that were up')
+    for reason in ['start', 'eviction', 'broker restart']:
+        print(f'Missing after {reason + ":":<16}{percentiles(simulation.missing[reason])}')
+
+    print(f'Listed servers down:     mean {mean(simulation.stale_samples):.2%}, '
+          f'max {max(simulation.stale_samples, default=0):.2%}')
+    print(f'Servers up not listed:   mean {mean(simulation.missing_samples):.2%}, '
+          f'max {max(simulation.missing_samples, default=0):.2%}')
+
+    counts = simulation.registrations
+    peak_second = max(counts.values(), default=0)
+    peak_window = max((sum(counts.get(s + i, 0) for i in range(10)) for s in counts), default=0)
+    print(f'Registrations:      {sum(counts.values())}, mean {sum(counts.values()) / duration:.1f}/s, '
+          f'peak {peak_second}/s, peak {peak_window / 10:.1f}/s over 10 s')
+
+
+def main(options):
+    simulation = Simulation(options)
+    simulation.run()
+    report(simulation, options)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Discrete-event simulation of the registrations on a broker')
+    parser.add_argument('--servers', type=int, default=2000, help='number of servers (default 2000)')
+    parser.add_argument('--duration', type=float, default=6 * 3600,
+                        help='simulated seconds (default 21600, 6 hours)')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help=f'REGISTRATION_INTERVAL of the servers (default {DEFAULT_INTERVAL})')
+    parser.add_argument('--sweep', type=float, default=registry.N_MINUTES * 60,
+                        help=f'seconds between two removals of stale entries (default {registry.N_MINUTES * 60})')
+    parser.add_argument('--loss', type=float, default=0, help='probability of losing a datagram (default 0)')
+    parser.add_argument('--rtt', type=float, default=0.001,
+                        help='seconds between a registration and its answer (default 0.001)')
+    parser.add_argument('--crash-rate', type=float, default=0.1,
+                        help='crashes of each server per hour (default 0.1)')
+    parser.add_argument('--downtime', type=float, default=60,
+                        help='mean seconds a crashed server stays down (default 60)')
+    parser.add_argument('--restart-every', type=float,
+                        help='seconds between two restarts of the broker, never by default')
+    parser.add_argument('--restart-downtime', type=float, default=5,
+                        help='seconds the broker is down when restarting (default 5)')
+    parser.add_argument('--startup', type=float, default=60,
+                        help='seconds over which the servers start (default 60)')
+    parser.add_argument('--sample', type=float, default=10,
+                        help='seconds between two samples of the listed servers (default 10)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the simulation (default 1)')
+    main(parser.parse_args())
@@ -0,0 +1,169 @@
+"""
+Script that merges the logs of the clients, the brokers and the game servers into one timeline per traced
+    session when executed
+The traced events (see tracing.py in the folder of each entity) are collected from all the log files,
+    grouped by trace and ordered by their monotonic timestamp. CLOCK_MONOTONIC is shared by all the
+    processes and containers of a machine, so the order is only meaningful for the logs of one machine.
+Each timeline is followed by where the time went: discovery, connection, matchmaking wait, and every
+    answer of the player
+Usage: python trace_timeline.py <path> [<path> ...], where each path is a log file or a directory
+"""
+import argparse
+import collections
+import os
+import re
+import sys
+
+# A traced event, the lines of the logs written before the timestamps were added do not match
+LINE = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d[+-]\d{4}:(?P<mono>\d+):(?P<pid>\d+):(?P<entity>[^:]*):[A-Z]+:'
+                  r'trace=(?P<trace>[0-9a-f]{16})-(?P<span>[0-9a-f]{8}) event=(?P<name>\S+)(?P<fields>.*)$')
+
+Event = collections.namedtuple('Event', ['mono', 'pid', 'entity', 'span', 'name', 'fields'])
+
+# Events that only the sessions of the players have, the other traces are the registrations of the servers
+SESSION_EVENTS = {'connect.start', 'session.join'}
+
+
+def find_files(paths):
+    """
+    :param paths: A list of files and directories
+    :return: The list of the log files, the directories are searched recursively
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith('.log'))
+        else:
+            files.append(path)
+    return files
+
+
+def read_traces(files):
+    """
+    :param files: A list of log files
+    :return: A dict mapping each trace to the list of its events, sorted by time
+    """
+    traces = collections.defaultdict(list)
+
+    for path in files:
+        try:
+            with open(path, errors='replace') as f:
+                for line in f:
+                    match = LINE.match(line)
+                    if match is None:
+                        continue
+
+                    fields = dict(item.split('=', 1) for item in match['fields'].split() if '=' in item)
+                    traces[match['trace']].append(Event(int(match['mono']), int(match['pid']), match['entity'],
+                                                        match['span'], match['name'], fields))
+        except OSError as e:
+            print(f'Skipping {path}: {e}', file=sys.stderr)
+
+    for events in traces.values():
+        events.sort(key=lambda event: event.mono)
+    return traces
+
+
+def span_duration(events, start, end):
+    """
+    :return: The microseconds between the first event named start and the next event of the same span
+        named end, or None if either is missing
+    """
+    first = next((e for e in events if e.name == start), None)
+    if first is None:
+        return None
+
+    last = next((e for e in events if e.name == end and e.span == first.span and e.mono >= first.mono), None)
+    return last.mono - first.mono if last is not None else None
+
+
+def phases(events):
+    """
+    :param events: The events of a session, sorted by time
+    :return: A list of pairs of the name of a phase and its duration in microseconds
+    """
+    result = []
+
+    for label, start, end in [('discovery', 'discovery.start', 'discovery.end'),
+                              ('connect', 'connect.start', 'connect.end')]:
+        duration = span_duration(events, start, end)
+        if duration is not None:
+            result.append((label, duration))
+
+    # the handshake can reach the server after the pairing, the wait measured by the server is used then
+    paired = next((e for e in events if e.name == 'session.paired'), None)
+    if paired is not None:
+        join = next((e for e in events if e.name == 'session.join'), None)
+        if join is not None and join.mono <= paired.mono:
+            result.append(('matchmaking wait', paired.mono - join.mono))
+        elif paired.fields.get('wait_us', '').isdigit():
+            result.append(('matchmaking wait', int(paired.fields['wait_us'])))
+
+    answers = 0
+    for event in events:
+        if event.name == 'answer' and event.fields.get('wait_us', '').isdigit():
+            if event.fields.get('valid') == 'True':
+                answers += 1
+                result.append((f'answer {answers}', int(event.fields['wait_us'])))
+            else:
+                result.append(('invalid answer', int(event.fields['wait_us'])))
+
+    return result
+
+
+def print_trace(trace, events):
+    """
+    Prints the timeline of a trace, and where its time went
+    """
+    start = events[0].mono
+    total = events[-1].mono - start
+    entities = sorted({f'{e.entity}[{e.pid}]' for e in events})
+    print(f'Trace {trace}: {len(events)} events in {total / 1000:.1f} ms, {", ".join(entities)}')
+
+    for event in events:
+        values = ' '.join(f'{key}={value}' for key, value in event.fields.items())
+        print(f'  +{(event.mono - start) / 1000:>10.3f} ms  {f"{event.entity}[{event.pid}]":<28} '
+              f'{event.name:<16} {values}')
+
+    breakdown = phases(events)
+    if len(breakdown) > 0:
+        print('  Where the time went:')
+        for label, duration in breakdown:
+            share = f' ({100 * duration / total:4.1f}%)' if total > 0 else ''
+            print(f'    {label:<18} {duration / 1000:>10.3f} ms{share}')
+    print()
+
+
+def main(options):
+    files = find_files(options.paths)
+    if len(files) == 0:
+        print('No log files found')
+        exit(-1)
+
+    traces = read_traces(files)
+
+    if options.trace is not None:
+        selected = [trace for trace in traces if trace.startswith(options.trace)]
+    elif options.all:
+        selected = list(traces)
+    else:
+        selected = [trace for trace, events in traces.items() if any(e.name in SESSION_EVENTS for e in events)]
+
+    if len(selected) == 0:
+        print(f'No traced sessions in {len(files)} files')
+        exit(-1)
+
+    # the sessions in the order they started
+    for trace in sorted(selected, key=lambda t: traces[t][0].mono):
+        print_trace(trace, traces[trace])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merges the logs of all the entities into one timeline per '
+                                                 'traced session')
+    parser.add_argument('paths', nargs='+', help='log files, or directories containing them')
+    parser.add_argument('--trace', help='only show the trace with this identifier, or prefix of it')
+    parser.add_argument('--all', action='store_true',
+                        help='also show the traces of the registrations of the servers')
+    main(parser.parse_args())